@@ -1,15 +1,191 @@
-import os, random
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+import os, atexit, hashlib, json, math, secrets, threading, time, uuid
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from types import SimpleNamespace
+from array import array
+from bisect import bisect_right
+from functools import lru_cache, wraps
+import click
+import numpy as np
+from flask import (Blueprint, Flask, render_template, request, redirect, url_for, session, flash, jsonify,
+                   has_request_context, g, get_flashed_messages, make_response, Response)
 from flask_sqlalchemy import SQLAlchemy
+from markupsafe import Markup
+from sqlalchemy import event, func, case, make_url
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from battle_store import create_battle_store
+from rng import RngStream, StreamCache, new_seed
+from metrics import init_metrics, CallbackMetric
+from profiler import init_profiler
+from assets import init_assets
+
+try:
+    import fcntl
+except ImportError:  # Windows: workers then only meet in SQLite's busy handler
+    fcntl = None
 
 app = Flask(__name__)
 
 # Configure SQLite database
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.join(basedir, "game.db")
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DATABASE_URL", "sqlite:///" + os.path.join(basedir, "game.db"))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Opt-in SQLite profile for several concurrent workers (SQLITE_TUNED=1):
+# WAL journal so readers don't block the writer, synchronous=NORMAL (safe
+# with WAL, one fsync per checkpoint instead of per commit), a busy timeout
+# instead of failing straight away with "database is locked", and a
+# connection pool so the PRAGMAs are paid once per connection.
+app.config['SQLITE_TUNED'] = os.environ.get("SQLITE_TUNED", "0") == "1"
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 5000
+if app.config['SQLITE_TUNED']:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "connect_args": {"timeout": app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000, "check_same_thread": False},
+    }
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite(dbapi_connection, connection_record):
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite"):
+        return
+    # Level curve helpers for set-based EXP grants (see grant_exp)
+    dbapi_connection.create_function("levels_gained", 2, levels_gained, deterministic=True)
+    dbapi_connection.create_function("level_exp_cost", 2, level_exp_cost, deterministic=True)
+    if not app.config['SQLITE_TUNED']:
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.close()
+
 db = SQLAlchemy(app)
 
+# Fingerprinted static assets under /assets/, plus gzip/brotli compression
+# and ETag/304 for pages; see assets.py. Installed first so its after_request
+# hook runs last and compresses the final response.
+app.config['ASSETS_COMPRESS'] = os.environ.get("ASSETS_COMPRESS", "1") == "1"
+app.config['ASSETS_COMPRESS_MIN_SIZE'] = 500  # bytes; smaller bodies aren't worth it
+app.config['ASSETS_COMPRESS_LEVEL'] = 5  # brotli quality / gzip level for pages
+app.config['ASSETS_WATCH'] = os.environ.get("ASSETS_WATCH", "0") == "1"  # re-hash edited files (development)
+# Third-party files are served only from static/vendor/; 1 links the CDN for
+# any that aren't vendored yet (development only, never in production)
+app.config['ASSETS_CDN_FALLBACK'] = os.environ.get("ASSETS_CDN_FALLBACK", "0") == "1"
+assets = init_assets(app)
+
+# Request/SQL/template/session metrics on /metrics (METRICS_ENABLED=0 turns
+# all of it off). Installed before the unit-of-work hooks so the request
+# timing includes the commit.
+app.config['METRICS_ENABLED'] = os.environ.get("METRICS_ENABLED", "1") == "1"
+metrics = init_metrics(app, db) if app.config['METRICS_ENABLED'] else None
+
+# Sampled cProfile (and optionally tracemalloc) dumps of whole requests; see
+# profiler.py. `flask profile-top` summarizes the dumps.
+app.config['PROFILE_ENABLED'] = os.environ.get("PROFILE_ENABLED", "0") == "1"
+app.config['PROFILE_SAMPLE_RATE'] = int(os.environ.get("PROFILE_SAMPLE_RATE", "100"))
+app.config['PROFILE_HEADER_TOKEN'] = os.environ.get("PROFILE_HEADER_TOKEN")
+app.config['PROFILE_TRACEMALLOC'] = os.environ.get("PROFILE_TRACEMALLOC", "0") == "1"
+app.config['PROFILE_DIR'] = os.environ.get("PROFILE_DIR", os.path.join(basedir, "profiles"))
+app.config['PROFILE_KEEP'] = 200
+app.config['PROFILE_EXCLUDE'] = {"pvp_online_events"}  # long-lived streams; profiling would buffer them
+init_profiler(app)
+
+# -------------------------------
+# Unit of Work (one commit per request)
+# -------------------------------
+# Routes and model methods only change objects (and flush when they need a
+# new row's ID). The commit happens once, after the view returns, and only
+# if something was added, changed, deleted, flushed or written with an
+# INSERT/UPDATE/DELETE statement during the request.
+@event.listens_for(db.session, "after_flush")
+def mark_flushed(session, flush_context):
+    session.info["writes"] = True
+
+@event.listens_for(db.session, "do_orm_execute")
+def mark_statement_writes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["writes"] = True
+        take_write_lock(orm_execute_state.session)
+
+# SQLite has one writer at a time, and a writer that finds the database
+# locked polls for it (busy_timeout) with growing sleeps: under load a
+# waiting request can keep missing the lock for seconds while others take
+# it in between, until it fails with "database is locked". Sessions queue
+# for it here instead, from their first write until their transaction ends:
+# on an RLock within the process, and on an fcntl lock on a file next to the
+# database across worker processes. Waiters block and are woken as soon as
+# the writer before them is done, so SQLite's busy handler is only left
+# with writers that don't use the session (the battle event flusher).
+class WriteQueue:
+    def __init__(self, path):
+        self.path = path  # None: in-process only
+        self._lock = threading.RLock()
+        self._depth = 0  # nested holds by the thread that has it
+        self._file = None
+
+    def acquire(self, timeout):
+        if not self._lock.acquire(timeout=timeout):
+            return False
+        if self._depth == 0 and self.path and fcntl is not None:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            fcntl.lockf(self._file, fcntl.LOCK_EX)
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            fcntl.lockf(self._file, fcntl.LOCK_UN)
+        self._lock.release()
+
+_database = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+app.config['SQLITE_WRITE_QUEUE'] = _database.get_backend_name() == "sqlite"
+sqlite_writer = WriteQueue(_database.database + "-lock" if _database.database not in (None, "", ":memory:") else None)
+
+def take_write_lock(session):
+    if app.config['SQLITE_WRITE_QUEUE'] and "write_lock" not in session.info:
+        # After a timeout, go ahead and leave it to SQLite's busy timeout
+        session.info["write_lock"] = sqlite_writer.acquire(timeout=app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000)
+
+@event.listens_for(db.session, "before_flush")
+def queue_flush_writes(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        take_write_lock(session)
+
+@event.listens_for(db.session, "after_transaction_end")
+def release_write_lock(session, transaction):
+    if transaction.parent is None and session.info.pop("write_lock", False):
+        sqlite_writer.release()
+
+def session_has_changes():
+    return bool(db.session.new or db.session.dirty or db.session.deleted or db.session.info.get("writes"))
+
+@app.after_request
+def commit_unit_of_work(response):
+    if response.status_code < 400 and session_has_changes():
+        db.session.commit()
+    db.session.info.pop("writes", None)
+    return response
+
+@app.teardown_request
+def rollback_unit_of_work(exc):
+    if exc is not None:
+        db.session.rollback()
+    db.session.info.pop("writes", None)
+
+# Battle state (enemy, PvP turn, logs) lives server-side; the cookie only holds IDs.
+# "memory" is per-process; use "sqlite" when running several workers.
+app.config['BATTLE_STORE'] = os.environ.get("BATTLE_STORE", "memory")
+app.config['BATTLE_STORE_PATH'] = os.environ.get("BATTLE_STORE_PATH", os.path.join(basedir, "battle_state.db"))
+app.config['BATTLE_LOG_LIMIT'] = 100
+app.config['BATTLE_LOG_PAGE_SIZE'] = 20
+battle_store = create_battle_store(app.config['BATTLE_STORE'], path=app.config['BATTLE_STORE_PATH'],
+                                   log_limit=app.config['BATTLE_LOG_LIMIT'], wal=app.config['SQLITE_TUNED'])
+
 # -------------------------------
 # Configuration for Base Stats & Abilities
 # -------------------------------
@@ -193,24 +369,25 @@ EVOLUTION_MAP = {
     },
     "Kaosborne": {
          "race": "Anarchic Kaosborne",
-         "base_health": lambda base: base + random(0,1)*100,
-         "mana": lambda mana: mana + random(0,1)*100,
-         "strength": lambda s: s + random(0,1)*100,
-         "intelligence": lambda i: i + random(0,1)*100,
-         "wisdom": lambda w: w + random(0,1)*100,
-         "constitution": lambda c: c + random(0,1)*100,
-         "speed": lambda spd: spd + random(0,1)*100,
+         "base_health": lambda base, rng: base + rng.randint(0, 1)*100,
+         "mana": lambda mana, rng: mana + rng.randint(0, 1)*100,
+         "strength": lambda s, rng: s + rng.randint(0, 1)*100,
+         "intelligence": lambda i, rng: i + rng.randint(0, 1)*100,
+         "wisdom": lambda w, rng: w + rng.randint(0, 1)*100,
+         "constitution": lambda c, rng: c + rng.randint(0, 1)*100,
+         "speed": lambda spd, rng: spd + rng.randint(0, 1)*100,
          "ability": "Chaotic Surge",
-         "secondary_ability": "Anarchic Onslaught"
+         "secondary_ability": "Anarchic Onslaught",
+         "rolls": True  # the stat lambdas above also take the character's RNG stream
     }
 }
 
 # -------------------------------
 # Function to Calculate Kaosborne Stats
 # -------------------------------
-def calculate_kaosborne_stat():
-    mult = random.randint(1, 101)
-    div = random.randint(1, 3)
+def calculate_kaosborne_stat(rng):
+    mult = rng.randint(1, 101)
+    div = rng.randint(1, 3)
     if div == 1:
         value = 100 * mult
     elif div == 2 and mult == 0:
@@ -220,29 +397,83 @@ def calculate_kaosborne_stat():
     return value
 
 # -------------------------------
-# Function for Type Advantages (Multiplier based on matchup)
+# Type Advantages (precomputed race-by-race multiplier matrix)
 # -------------------------------
-def type_multiplier(attacker, defender):
-    multiplier = 1.0
-    # Use the first word of the race name (if evolved, this should reflect its base type)
-    attacker_base = attacker.race.split()[0]
-    defender_base = defender.race.split()[0]
-    if attacker_base == "Demon" and defender_base == "Angel":
-        multiplier = 1.5
-    elif attacker_base == "Angel" and defender_base == "Demon":
-        multiplier = 1.5
-    elif attacker_base == "Dwarf" and defender_base == "Dragon":
-        multiplier = 1.3
-    elif attacker_base == "Elf" and defender_base == "Beastman":
-        multiplier = 1.3
-    elif attacker_base == "Demigod" and defender_base == "Human":
-        multiplier = 1.2
+# Matchups are decided by the first word of the race name, so evolved forms
+# ("Champion Human", "High Elf", ...) only keep an advantage if their first
+# word still names the base race.
+TYPE_ADVANTAGES = {
+    ("Demon", "Angel"): 1.5,
+    ("Angel", "Demon"): 1.5,
+    ("Dwarf", "Dragon"): 1.3,
+    ("Elf", "Beastman"): 1.3,
+    ("Demigod", "Human"): 1.2,
     # You can add more rules here
-    return multiplier
+}
+
+RACE_NAMES = list(RACE_STATS.keys()) + [evolution["race"] for evolution in EVOLUTION_MAP.values()]
+RACE_IDS = {race: i for i, race in enumerate(RACE_NAMES)}
+
+def _advantage(attacker_race, defender_race):
+    return TYPE_ADVANTAGES.get((attacker_race.split()[0], defender_race.split()[0]), 1.0)
+
+TYPE_MATRIX = [[_advantage(a, d) for d in RACE_NAMES] for a in RACE_NAMES]
+
+def race_multiplier(attacker_race, defender_race):
+    a = RACE_IDS.get(attacker_race)
+    d = RACE_IDS.get(defender_race)
+    if a is None or d is None:
+        return _advantage(attacker_race, defender_race)
+    return TYPE_MATRIX[a][d]
+
+def type_multiplier(attacker, defender):
+    return race_multiplier(attacker.race, defender.race)
+
+app.config['LAST_SEEN_RESOLUTION'] = 300  # seconds
+
+# -------------------------------
+# Level Curve (level L -> L+1 costs L * 100 EXP)
+# -------------------------------
+def level_exp_cost(level, levels):
+    # EXP needed to go from `level` up `levels` levels: 100 * (L + ... + L+k-1)
+    return 100 * (levels * level + levels * (levels - 1) // 2)
+
+def levels_gained(level, exp):
+    # Largest k with level_exp_cost(level, k) <= exp, from
+    # k^2 + (2L - 1)k - 2 * (exp // 100) <= 0
+    if exp < level * 100:
+        return 0
+    b = 2 * level - 1
+    k = (math.isqrt(b * b + 8 * (exp // 100)) - b) // 2
+    while level_exp_cost(level, k + 1) <= exp:
+        k += 1
+    while k > 0 and level_exp_cost(level, k) > exp:
+        k -= 1
+    return k
+
+# Flash for the player when there is one (bulk grants run outside requests).
+# API requests have no cookie session; their notices go back in the response.
+def notify(message, category):
+    if not has_request_context():
+        return
+    if "api_notices" in g:
+        g.api_notices.append([category, message])
+    else:
+        flash(message, category)
+
+def take_notices():
+    if "api_notices" in g:
+        notices, g.api_notices = g.api_notices, []
+        return notices
+    return get_flashed_messages(with_categories=True)
 
 # -------------------------------
 # Character Model
 # -------------------------------
+# Sub-streams of a character's seed (see rng.py)
+CHARACTER_ROLL_STREAM = 0
+CHARACTER_EVOLVE_STREAM = 1
+
 class Character(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     race = db.Column(db.String(50))
@@ -260,16 +491,22 @@ class Character(db.Model):
     gold = db.Column(db.Integer, default=100)
     evolved = db.Column(db.Boolean, default=False)
     ability = db.Column(db.String(200), default="")  # Will store one or two abilities
+    last_seen = db.Column(db.Float, index=True)  # Unix time of the last request that used this character
+    seed = db.Column(db.Integer)  # the character's RNG streams: its initial roll and its evolution
+    version = db.Column(db.Integer, nullable=False)  # bumped by every write (see Concurrent Updates)
+    __mapper_args__ = {"version_id_col": version}
 
-    def __init__(self):
-        self.race = self.choose_race()
+    def __init__(self, seed=None):
+        self.seed = new_seed() if seed is None else seed
+        rng = RngStream(self.seed, CHARACTER_ROLL_STREAM)
+        self.race = self.choose_race(rng)
         self.level = 1
         self.exp = 0
         stats = RACE_STATS[self.race]
         # For Kaosborne, use special calculations
         if self.race == "Kaosborne":
-            self.base_health = calculate_kaosborne_stat()
-            self.speed = calculate_kaosborne_stat()
+            self.base_health = calculate_kaosborne_stat(rng)
+            self.speed = calculate_kaosborne_stat(rng)
         else:
             self.base_health = stats["base_health"]
             self.speed = stats["speed"]
@@ -283,68 +520,999 @@ class Character(db.Model):
         self.gold = 100
         self.evolved = False
         self.ability = stats["ability"]
+        self.last_seen = time.time()
 
         # Apply stat variance unique to each race
         if self.race in STAT_VARIANCE:
             var = STAT_VARIANCE[self.race]
-            self.strength += random.randint(*var["strength"])
-            self.intelligence += random.randint(*var["intelligence"])
-            self.wisdom += random.randint(*var["wisdom"])
-            self.constitution += random.randint(*var["constitution"])
-            self.speed += random.randint(*var["speed"])
-            self.mana += random.randint(*var["mana"])
-
-    def choose_race(self):
-        roll = random.randint(1, 10)
+            self.strength += rng.randint(*var["strength"])
+            self.intelligence += rng.randint(*var["intelligence"])
+            self.wisdom += rng.randint(*var["wisdom"])
+            self.constitution += rng.randint(*var["constitution"])
+            self.speed += rng.randint(*var["speed"])
+            self.mana += rng.randint(*var["mana"])
+
+    def touch(self):
+        # Throttled so that page views don't turn into a write on every click
+        now = time.time()
+        if self.last_seen is None or now - self.last_seen > app.config['LAST_SEEN_RESOLUTION']:
+            self.last_seen = now
+
+    def choose_race(self, rng):
+        roll = rng.randint(1, 10)
         races = list(RACE_STATS.keys())
         return races[roll - 1]
 
     def gain_exp(self, amount):
         self.exp += amount
-        leveled_up = False
-        while self.exp >= self.level * 100:
-            self.exp -= self.level * 100
-            self.level += 1
-            # Increase stats on level up (non-evolved)
-            self.strength += 2
-            self.intelligence += 2
-            self.wisdom += 2
-            self.constitution += 2
-            self.base_health += 20
+        gained = levels_gained(self.level, self.exp)
+        if gained:
+            self.exp -= level_exp_cost(self.level, gained)
+            self.level += gained
+            # Increase stats on level up: +2 core stats and +20 HP per level
+            self.strength += 2 * gained
+            self.intelligence += 2 * gained
+            self.wisdom += 2 * gained
+            self.constitution += 2 * gained
+            self.base_health += 20 * gained
             self.current_health = self.base_health  # Heal fully on level up
-            leveled_up = True
-            flash(f"You leveled up! You are now level {self.level}.", "success")
+            if gained == 1:
+                notify(f"You leveled up! You are now level {self.level}.", "success")
+            else:
+                notify(f"You gained {gained} levels! You are now level {self.level}.", "success")
         # Evolve automatically at level 10 (if not already evolved)
         if self.level >= 10 and not self.evolved:
             self.evolve()
-        if leveled_up:
-            db.session.commit()
 
     def evolve(self):
         if self.race in EVOLUTION_MAP:
             evolution = EVOLUTION_MAP[self.race]
+            if evolution.get("rolls"):
+                rng = RngStream(self.seed, CHARACTER_EVOLVE_STREAM)
+                change = lambda stat, value: evolution[stat](value, rng)
+            else:
+                change = lambda stat, value: evolution[stat](value)
             old_race = self.race
             self.race = evolution["race"]
-            self.base_health = evolution["base_health"](self.base_health)
+            self.base_health = change("base_health", self.base_health)
             # For demons and angels, HP remains unchanged per specification
             if old_race in ["Demon", "Angel"]:
                 self.base_health = RACE_STATS[old_race]["base_health"]
-            self.mana = evolution["mana"](self.mana)
-            self.strength = evolution["strength"](self.strength)
-            self.intelligence = evolution["intelligence"](self.intelligence)
-            self.wisdom = evolution["wisdom"](self.wisdom)
-            self.constitution = evolution["constitution"](self.constitution)
-            self.speed = evolution["speed"](self.speed)
+            self.mana = change("mana", self.mana)
+            self.strength = change("strength", self.strength)
+            self.intelligence = change("intelligence", self.intelligence)
+            self.wisdom = change("wisdom", self.wisdom)
+            self.constitution = change("constitution", self.constitution)
+            self.speed = change("speed", self.speed)
             # Set two abilities for evolved forms
             primary = evolution["ability"]
             secondary = evolution.get("secondary_ability", "")
             self.ability = f"{primary} | {secondary}" if secondary else primary
             self.evolved = True
-            flash(f"Evolution complete! You have evolved into a {self.race}!", "info")
+            notify(f"Evolution complete! You have evolved into a {self.race}!", "info")
+
+# -------------------------------
+# Bulk EXP Grants (event rewards etc.)
+# -------------------------------
+# One set-based UPDATE applies the level curve to every matching row using the
+# levels_gained/level_exp_cost SQL functions registered on each connection.
+# Only rows that crossed level 10 unevolved are loaded, to run evolve().
+# Pass character_ids=None to grant to every claimed character; the unclaimed
+# ones in the pool stay at level 1. The caller commits.
+def grant_exp(amount, character_ids=None):
+    new_exp = Character.exp + amount
+    gained = func.levels_gained(Character.level, new_exp)
+    stmt = db.update(Character).values(
+        level=Character.level + gained,
+        exp=new_exp - func.level_exp_cost(Character.level, gained),
+        strength=Character.strength + 2 * gained,
+        intelligence=Character.intelligence + 2 * gained,
+        wisdom=Character.wisdom + 2 * gained,
+        constitution=Character.constitution + 2 * gained,
+        base_health=Character.base_health + 20 * gained,
+        current_health=case((gained > 0, Character.base_health + 20 * gained), else_=Character.current_health),
+        version=Character.version + 1,
+    ).where(Character.id.not_in(db.select(CharacterPool.character_id)))
+    if character_cache is not None:
+        character_cache.invalidate(character_ids)  # pending writes first, then drop cached copies
+    evolving = db.select(Character).where(Character.level >= 10, Character.evolved.is_(False),
+                                          Character.id.not_in(db.select(CharacterPool.character_id)))
+    if character_ids is not None:
+        stmt = stmt.where(Character.id.in_(character_ids))
+        evolving = evolving.where(Character.id.in_(character_ids))
+    updated = db.session.execute(stmt.execution_options(synchronize_session=False)).rowcount
+    db.session.expire_all()
+    evolved = 0
+    for character in db.session.scalars(evolving):
+        if character.race in EVOLUTION_MAP:
+            character.evolve()
+            evolved += 1
+    return updated, evolved
+
+@app.cli.command("grant-exp")
+@click.argument("amount", type=int)
+@click.argument("character_ids", nargs=-1, type=int)
+def grant_exp_command(amount, character_ids):
+    """Grant AMOUNT EXP to the given character IDs (or to every claimed character)."""
+    updated, evolved = grant_exp(amount, list(character_ids) or None)
+    db.session.commit()
+    click.echo(f"Granted {amount} EXP to {updated} characters ({evolved} evolved).")
+
+# -------------------------------
+# Pre-rolled Character Pool
+# -------------------------------
+# Fresh level-1 characters are rolled in batches and bulk inserted ahead of
+# time; character_pool lists the ones nobody has claimed yet. /roll and /pvp
+# claim one with a single DELETE ... RETURNING (atomic under SQLite's write
+# lock, so two workers can never get the same row) and only fall back to
+# Character() when the pool is empty.
+class CharacterPool(db.Model):
+    __tablename__ = "character_pool"
+    character_id = db.Column(db.Integer, db.ForeignKey("character.id"), primary_key=True)
+
+app.config['CHARACTER_POOL_SIZE'] = 200
+app.config['CHARACTER_POOL_LOW_WATER'] = 50
+app.config['CHARACTER_POOL_BACKGROUND'] = os.environ.get("CHARACTER_POOL_BACKGROUND", "1") == "1"
+_pool_refill_lock = threading.Lock()
+
+def roll_character_rows(n, seed=None):
+    # Same race distribution (uniform over RACE_STATS) and STAT_VARIANCE rolls
+    # as Character(), drawn with the simulator's vectorized roller. Every row
+    # still gets its own seed for its later streams (evolution), generated in
+    # bulk from the batch's SeedSequence.
+    from simulator import roll_characters
+    sequence = np.random.SeedSequence(new_seed() if seed is None else seed)
+    seeds = sequence.generate_state(n, np.uint64) >> np.uint64(1)  # 63 bits, like new_seed()
+    rng = np.random.default_rng(sequence.spawn(1)[0])
+    race_ids = rng.integers(0, len(RACE_STATS), n)
+    columns = ["base_health", "current_health", "mana", "strength", "intelligence", "wisdom", "constitution", "speed"]
+    stats = {column: np.zeros(n, dtype=np.int64) for column in columns}
+    races, abilities = np.empty(n, dtype=object), np.empty(n, dtype=object)
+    for race_id, race in enumerate(RACE_STATS):
+        rows = np.flatnonzero(race_ids == race_id)
+        if not len(rows):
+            continue
+        rolled = roll_characters(race, 1, len(rows), rng)
+        for column in columns:
+            stats[column][rows] = rolled[column]
+        races[rows], abilities[rows] = race, rolled["ability"]
+    now = time.time()
+    values = [stats[column].tolist() for column in columns]
+    return [{"race": race, "level": 1, "exp": 0, **dict(zip(columns, row)), "potions": 3, "gold": 100,
+             "evolved": False, "ability": ability, "last_seen": now, "seed": row_seed}
+            for race, ability, row_seed, *row in zip(races.tolist(), abilities.tolist(), seeds.tolist(), *values)]
+
+def refill_character_pool(target=None):
+    # Tops the pool up to `target` rows with two executemany INSERTs. Returns
+    # how many characters were added; the caller commits.
+    target = target or app.config['CHARACTER_POOL_SIZE']
+    missing = target - db.session.scalar(db.select(func.count()).select_from(CharacterPool))
+    if missing <= 0:
+        return 0
+    ids = db.session.scalars(db.insert(Character).returning(Character.id), roll_character_rows(missing)).all()
+    db.session.execute(db.insert(CharacterPool), [{"character_id": character_id} for character_id in ids])
+    return len(ids)
+
+def _refill_character_pool_in_background():
+    if not _pool_refill_lock.acquire(blocking=False):
+        return  # a refill is already running in this process
+    try:
+        with app.app_context():
+            refill_character_pool()
+            db.session.commit()
+    finally:
+        _pool_refill_lock.release()
+
+def claim_character():
+    # Returns an unclaimed pooled character or a freshly created one.
+    oldest = db.select(CharacterPool.character_id).order_by(CharacterPool.character_id).limit(1).scalar_subquery()
+    character_id = db.session.scalar(
+        db.delete(CharacterPool).where(CharacterPool.character_id == oldest).returning(CharacterPool.character_id))
+    character = db.session.get(Character, character_id) if character_id else None
+    if character is None:
+        character = Character()
+        db.session.add(character)
+        db.session.flush()  # assigns character.id; committed with the request
+    character.last_seen = time.time()
+    if character_id is None or db.session.scalar(db.select(func.count()).select_from(CharacterPool)) < app.config['CHARACTER_POOL_LOW_WATER']:
+        if app.config['CHARACTER_POOL_BACKGROUND']:
+            threading.Thread(target=_refill_character_pool_in_background, daemon=True).start()
+        else:
+            refill_character_pool()
+    return character
+
+@app.cli.command("refill-pool")
+@click.option("--size", type=int, help="Target pool size (default CHARACTER_POOL_SIZE).")
+def refill_pool_command(size):
+    """Top up the pre-rolled character pool."""
+    added = refill_character_pool(size)
+    db.session.commit()
+    click.echo(f"Added {added} characters to the pool.")
+
+# -------------------------------
+# Reaper (garbage-collect abandoned characters)
+# -------------------------------
+# Characters not seen for CHARACTER_TTL seconds are deleted in batches (PvP
+# pairs are touched together, so they expire together), pooled characters
+# are never touched, and stale battle state is pruned from the battle store.
+# Afterwards freed pages are returned with an incremental VACUUM and the
+# query planner statistics are refreshed with ANALYZE.
+app.config['CHARACTER_TTL'] = 7 * 24 * 3600
+app.config['REAPER_BATCH'] = 500
+app.config['REAPER_VACUUM_PAGES'] = 5000  # free pages returned per run
+app.config['REAPER_INTERVAL'] = int(os.environ.get("REAPER_INTERVAL", "0"))  # seconds; 0 disables the thread
+
+def free_pages(conn):
+    return conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+
+def enable_incremental_vacuum():
+    # auto_vacuum can only be switched on by a full VACUUM; done once.
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+
+def reap(ttl=None, batch_size=None, vacuum=True):
+    ttl = app.config['CHARACTER_TTL'] if ttl is None else ttl
+    batch_size = batch_size or app.config['REAPER_BATCH']
+    cutoff = time.time() - ttl
+    report = {"characters": 0, "battles": 0, "matches": 0, "pages_reclaimed": 0, "bytes_reclaimed": 0}
+    pooled = db.select(CharacterPool.character_id)
+    while True:
+        batch = (db.select(Character.id)
+                 .where(Character.last_seen < cutoff, Character.id.not_in(pooled))
+                 .limit(batch_size).scalar_subquery())
+        deleted = db.session.execute(
+            db.delete(Character).where(Character.id.in_(batch)).execution_options(synchronize_session=False)).rowcount
+        db.session.commit()  # one short write transaction per batch
+        report["characters"] += deleted
+        if deleted < batch_size:
+            break
+    report["battles"] = battle_store.prune(cutoff)
+    db.session.execute(db.delete(BattleRecord).where(
+        BattleRecord.finished_at < time.time() - app.config['BATTLE_RECORD_TTL']))
+    db.session.execute(db.delete(BattleEvent).where(
+        BattleEvent.created_at < time.time() - app.config['BATTLE_EVENT_TTL']))
+    db.session.execute(db.delete(Submission).where(
+        Submission.created_at < time.time() - app.config['SUBMISSION_TTL']))
+    # API tokens of the characters deleted above
+    db.session.execute(db.delete(ApiToken).where(ApiToken.character_id.not_in(db.select(Character.id))))
+    # Online PvP: queue rows nobody polls any more, and matches idle since the cutoff
+    db.session.execute(db.delete(PvpQueue).where(PvpQueue.queued_at < time.time() - app.config['PVP_QUEUE_TIMEOUT']))
+    report["matches"] = db.session.execute(db.delete(PvpMatch).where(PvpMatch.updated_at < cutoff)).rowcount
+    db.session.commit()
+
+    if vacuum and app.config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite"):
+        enable_incremental_vacuum()
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            # Counted in free pages handed back by the vacuum itself: the file
+            # size also moves with the one-off VACUUM above and with ANALYZE
+            before = free_pages(conn)
+            # executescript steps the pragma to completion (execute() frees one page per step)
+            conn.connection.driver_connection.executescript(
+                f"PRAGMA incremental_vacuum({app.config['REAPER_VACUUM_PAGES']})")
+            report["pages_reclaimed"] = max(0, before - free_pages(conn))
+            report["bytes_reclaimed"] = report["pages_reclaimed"] * conn.exec_driver_sql("PRAGMA page_size").scalar()
+            if report["characters"]:
+                conn.exec_driver_sql("ANALYZE")
+    return report
+
+def _reaper_loop(interval):
+    while True:
+        time.sleep(interval)
+        with app.app_context():
+            report = reap()
+        app.logger.info("Reaper: removed %(characters)s characters, %(battles)s battles, %(matches)s matches, "
+                        "reclaimed %(pages_reclaimed)s free pages (%(bytes_reclaimed)s bytes)", report)
+
+def start_reaper(interval=None):
+    interval = interval or app.config['REAPER_INTERVAL']
+    if interval:
+        threading.Thread(target=_reaper_loop, args=(interval,), name="reaper", daemon=True).start()
+
+@app.cli.command("reap")
+@click.option("--ttl", type=float, help="Idle hours before a character is deleted (default CHARACTER_TTL).")
+@click.option("--no-vacuum", is_flag=True, help="Skip the incremental VACUUM/ANALYZE step.")
+def reap_command(ttl, no_vacuum):
+    """Delete abandoned characters and battles, then compact the database."""
+    report = reap(ttl * 3600 if ttl is not None else None, vacuum=not no_vacuum)
+    click.echo(f"Removed {report['characters']} characters, {report['battles']} battles and {report['matches']} matches; "
+               f"reclaimed {report['pages_reclaimed']} free pages ({report['bytes_reclaimed']} bytes).")
+
+# -------------------------------
+# Character Cache (write-behind)
+# -------------------------------
+# Routes read characters through a per-process LRU of detached Character
+# objects, bounded by CHARACTER_CACHE_SIZE entries and CHARACTER_CACHE_TTL
+# seconds. A request gets its own copy of the cached character, and its
+# changes are applied to the cached one at the request's commit point (see
+# Concurrent Updates). Gold, level or potion changes, and battle ends
+# (write_through), are written in the request's own transaction. Everything
+# else (HP, mana, last_seen) stays dirty and is written in batches every
+# CHARACTER_CACHE_FLUSH_INTERVAL seconds by a background flusher, or when the
+# entry is evicted, expires or is invalidated. Only changed columns are written.
+# An entry written as it leaves the cache is written in the current
+# transaction; if that rolls back, the entry goes back into the cache as it
+# was, pending changes included, so they are written again later.
+#
+# Every write is a compare-and-swap on the version column. A batched write
+# that finds a row written by someone else since it was cached (another
+# worker, a bulk grant) drops its pending changes and the cached copy
+# instead of overwriting the newer row.
+#
+# With several workers (CHARACTER_CACHE_SHARED), every write is also logged in
+# character_invalidation. Each flusher polls the log and drops its copies of
+# characters written by another process, so a stale copy lives for at most
+# one flush interval (and never past the TTL).
+class CharacterInvalidation(db.Model):
+    __tablename__ = "character_invalidation"
+    character_id = db.Column(db.Integer, primary_key=True)  # 0 = every character
+    changed_at = db.Column(db.Float, index=True)
+    writer = db.Column(db.String(32))
+
+app.config['CHARACTER_CACHE'] = os.environ.get("CHARACTER_CACHE", "1") == "1"
+app.config['CHARACTER_CACHE_SIZE'] = 1000
+app.config['CHARACTER_CACHE_TTL'] = 30
+app.config['CHARACTER_CACHE_FLUSH_INTERVAL'] = 2
+app.config['CHARACTER_CACHE_SHARED'] = os.environ.get("CHARACTER_CACHE_SHARED", "1") == "1"
+app.config['CHARACTER_LOCK_TIMEOUT'] = 2  # seconds to wait for a character another request is committing
+CACHE_FORCED_COLUMNS = {"gold", "level", "potions"}
+
+# A character changed after this request read it; the request is retried
+class CharacterConflict(Exception):
+    pass
+
+class CachedCharacter:
+    __slots__ = ("character", "loaded_at", "saved", "revision", "lock")
+
+    def __init__(self, character, loaded_at, saved):
+        self.character = character
+        self.loaded_at = loaded_at
+        self.saved = saved  # column values as last written; {} = unknown, write everything
+        self.revision = 0  # bumped whenever a request's changes are applied
+        self.lock = threading.Lock()
+
+class CharacterCheckout:
+    # One request's copy of a cached character
+    __slots__ = ("entry", "copy", "revision", "start", "wrote")
+
+    def __init__(self, entry, copy, revision, start):
+        self.entry = entry
+        self.copy = copy
+        self.revision = revision  # the entry's revision when copied (or last committed)
+        self.start = start  # the copy's column values at that point
+        self.wrote = False  # written in the request's transaction
+
+def lock_entries(entries, timeout):
+    # Takes the locks in character ID order, so two requests can't deadlock;
+    # returns the entries locked, or raises CharacterConflict on a timeout
+    ordered = sorted(entries, key=lambda entry: (entry.character.id, id(entry)))
+    locked = []
+    for entry in ordered:
+        if not entry.lock.acquire(timeout=timeout):
+            for held in locked:
+                held.lock.release()
+            raise CharacterConflict(entry.character.id)
+        locked.append(entry)
+    return locked
+
+class CharacterCache:
+    def __init__(self, max_size=1000, ttl=30, flush_interval=2, shared=True, lock_timeout=2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.lock_timeout = lock_timeout
+        self.writer = uuid.uuid4().hex
+        self.columns = [column.key for column in Character.__table__.columns if column.key not in ("id", "version")]
+        self.entries = OrderedDict()
+        self.stats = dict.fromkeys(["hits", "misses", "expired", "evicted", "invalidated",
+                                    "forced_writes", "behind_writes", "conflicts"], 0)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._polled_at = self._pruned_at = time.time()
+
+    def values(self, character):
+        return {column: getattr(character, column) for column in self.columns}
+
+    def diff(self, entry):
+        missing = object()
+        return {column: value for column, value in self.values(entry.character).items()
+                if entry.saved.get(column, missing) != value}
+
+    def copy(self, character):
+        # A transient Character with the same values, for one request
+        copy = Character.__mapper__.class_manager.new_instance()
+        copy.id = character.id
+        copy.version = character.version
+        for column, value in self.values(character).items():
+            setattr(copy, column, value)
+        return copy
+
+    def peek(self, char_ids):
+        # {id: cached character} for those of char_ids in the cache, read-only
+        found = {}
+        with self._lock:
+            for char_id in char_ids:
+                entry = self.entries.get(char_id)
+                if entry is not None:
+                    found[char_id] = entry.character
+        return found
+
+    def get(self, char_id):
+        # Returns this request's copy of the character (None if it doesn't exist)
+        tracked = g.setdefault("cached_characters", {})
+        if char_id in tracked:
+            return tracked[char_id].copy
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(char_id)
+            fresh = entry is not None and now - entry.loaded_at <= self.ttl
+            if fresh:
+                self.entries.move_to_end(char_id)
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+                if entry is not None:
+                    self.stats["expired"] += 1
+                    del self.entries[char_id]
+        if fresh:
+            return self.checkout(entry)
+        if entry is not None:
+            self.write_dropped([entry])  # expired: persist what's pending, then reload
+        character = db.session.get(Character, char_id)
+        if character is None:
+            return None
+        db.session.expunge(character)
+        entry = CachedCharacter(character, now, self.values(character))
+        with self._lock:
+            self.entries[char_id] = entry
+            evicted = []
+            while len(self.entries) > self.max_size:
+                evicted.append(self.entries.popitem(last=False)[1])
+            self.stats["evicted"] += len(evicted)
+        self.write_dropped(evicted)
+        self.start()
+        return self.checkout(entry)
+
+    def checkout(self, entry):
+        with entry.lock:
+            copy = self.copy(entry.character)
+            checkout = CharacterCheckout(entry, copy, entry.revision, self.values(copy))
+        g.cached_characters[copy.id] = checkout
+        return copy
+
+    def pending(self, entries):
+        # (entry, version, changed columns) for each entry with unwritten changes;
+        # the caller holds the entries' locks
+        pending = []
+        for entry in entries:
+            changes = self.diff(entry)
+            if changes:
+                pending.append((entry, entry.character.version, changes))
+        return pending
+
+    def write(self, pending, counter="behind_writes", strict=False):
+        # Writes `pending` with the current session as compare-and-swap UPDATEs
+        # (one executemany per set of changed columns); the caller commits and
+        # then calls written(). A row someone else wrote since it was cached is
+        # skipped and its entry dropped, or with `strict` raises CharacterConflict.
+        if not pending:
+            return []
+        ids = [entry.character.id for entry, _, _ in pending]
+        current = dict(db.session.execute(db.select(Character.id, Character.version).where(Character.id.in_(ids))).all())
+        stale = [entry for entry, version, _ in pending if current.get(entry.character.id) != version]
+        if stale:
+            self.drop(stale)
+            with self._lock:
+                self.stats["conflicts"] += len(stale)
+            if strict:
+                raise CharacterConflict(stale[0].character.id)
+            pending = [item for item in pending if item[0] not in stale]
+        table = Character.__table__
+        groups = defaultdict(list)
+        for entry, version, changes in pending:
+            groups[tuple(sorted(changes))].append({"row_id": entry.character.id, "row_version": version, **changes})
+        updated = 0
+        for rows in groups.values():
+            stmt = (table.update()
+                    .where(table.c.id == db.bindparam("row_id"), table.c.version == db.bindparam("row_version"))
+                    .values(version=table.c.version + 1))
+            updated += db.session.execute(stmt, rows).rowcount
+        if updated != len(pending):
+            raise CharacterConflict(None)  # a row changed between the check and the write
+        if pending and self.shared:
+            self.log_writes([entry.character.id for entry, _, _ in pending])
+        with self._lock:
+            self.stats[counter] += len(pending)
+        return pending
+
+    def written(self, pending, locked=False):
+        # Records a committed write(): the entries now match their rows
+        for entry, version, changes in pending:
+            if not locked:
+                entry.lock.acquire()
+            try:
+                if entry.character.version == version:
+                    entry.character.version = version + 1
+                    entry.saved = {**entry.saved, **changes}
+            finally:
+                if not locked:
+                    entry.lock.release()
+
+    def write_dropped(self, entries):
+        # Writes entries that just left the cache; the caller commits. Each
+        # written entry is remembered (with its state before the write) until
+        # the transaction ends, for restore_dropped().
+        if not entries:
+            return
+        locked = lock_entries(entries, self.lock_timeout)
+        try:
+            pending = self.write(self.pending(locked))
+            db.session.info.setdefault("dropped_characters", []).extend(
+                (entry, self.values(entry.character), version, entry.saved) for entry, version, _ in pending)
+            self.written(pending, locked=True)
+        finally:
+            for entry in locked:
+                entry.lock.release()
+
+    def restore_dropped(self, dropped, held=()):
+        # The transaction that wrote these dropped entries rolled back: puts
+        # them back as they were before, replacing any copy loaded since (it
+        # may have read the rolled-back write). `held` are entries whose locks
+        # this thread already holds.
+        for entry, values, version, saved in reversed(dropped):
+            if entry not in held:
+                entry.lock.acquire()
+            try:
+                for column, value in values.items():
+                    setattr(entry.character, column, value)
+                entry.character.version = version
+                entry.saved = saved
+                entry.revision += 1  # copies taken since then are stale
+            finally:
+                if entry not in held:
+                    entry.lock.release()
+        with self._lock:
+            for entry, _, _, _ in dropped:
+                self.entries[entry.character.id] = entry
+
+    def drop(self, entries):
+        with self._lock:
+            for entry in entries:
+                if self.entries.get(entry.character.id) is entry:
+                    del self.entries[entry.character.id]
+
+    def log_writes(self, character_ids):
+        rows = [{"character_id": character_id, "changed_at": time.time(), "writer": self.writer}
+                for character_id in character_ids]
+        stmt = sqlite_insert(CharacterInvalidation).values(rows)
+        stmt = stmt.on_conflict_do_update(index_elements=["character_id"],
+                                          set_={"changed_at": stmt.excluded.changed_at, "writer": stmt.excluded.writer})
+        db.session.execute(stmt)
+
+    def commit(self, checkouts, write_through=()):
+        # A request's commit point: applies its changes to the cached
+        # characters, or raises CharacterConflict if one was changed by another
+        # request since it was copied. Gold/level/potion changes, battle ends and
+        # characters no longer cached are written now. The changed characters
+        # stay locked until release(), at the end of the request.
+        changed = []
+        for checkout in checkouts:
+            changes = {column: value for column, value in self.values(checkout.copy).items()
+                       if checkout.start[column] != value}
+            if changes:
+                changed.append((checkout, changes))
+        if not changed:
+            return []
+        held = g.setdefault("character_locks", [])
+        locked = lock_entries([checkout.entry for checkout, _ in changed if checkout.entry not in held],
+                              self.lock_timeout)
+        held.extend(locked)
+        for checkout, _ in changed:
+            if checkout.entry.revision != checkout.revision:
+                with self._lock:
+                    self.stats["conflicts"] += 1
+                raise CharacterConflict(checkout.copy.id)
+        forced = [checkout for checkout, changes in changed
+                  if checkout.copy.id in write_through or CACHE_FORCED_COLUMNS & changes.keys()
+                  or self.entries.get(checkout.copy.id) is not checkout.entry]
+        # Write first: the copies' values, over what is already pending in the entry
+        pending = [(checkout.entry, checkout.entry.character.version,
+                    {**self.diff(checkout.entry), **dict(changes)})
+                   for checkout, changes in changed if checkout in forced]
+        self.written(self.write(pending, counter="forced_writes", strict=True), locked=True)
+        for checkout, changes in changed:
+            entry = checkout.entry
+            for column, value in changes.items():
+                setattr(entry.character, column, value)
+            entry.revision += 1
+            checkout.revision = entry.revision
+            checkout.copy.version = entry.character.version
+            checkout.start = self.values(checkout.copy)
+            checkout.wrote = checkout.wrote or checkout in forced
+        return [checkout for checkout, _ in changed]
+
+    def release(self, checkouts, failed=False):
+        # End of the request. If it failed after writing, its transaction was
+        # rolled back, so those cached copies are ahead of their rows: drop them
+        # (unless restore_dropped() already put an entry back as it was).
+        if failed:
+            self.drop([checkout.entry for checkout in checkouts
+                       if checkout.wrote and checkout.entry.revision == checkout.revision])
+        for entry in g.pop("character_locks", []):
+            entry.lock.release()
+
+    def invalidate(self, character_ids=None, log=True):
+        # Writes pending changes of these characters (None = all) and drops
+        # them; logs the invalidation for other workers. The caller commits.
+        with self._lock:
+            if character_ids is None:
+                dropped = list(self.entries.values())
+                self.entries.clear()
+            else:
+                dropped = [self.entries.pop(char_id) for char_id in character_ids if char_id in self.entries]
+            self.stats["invalidated"] += len(dropped)
+        self.write_dropped(dropped)
+        if log and self.shared:
+            self.log_writes([0] if character_ids is None else character_ids)
+
+    def poll(self):
+        # Drops copies of characters another worker wrote since the last poll
+        # (one second of overlap covers writes that committed late).
+        since, self._polled_at = self._polled_at, time.time()
+        changed = db.session.scalars(db.select(CharacterInvalidation.character_id).where(
+            CharacterInvalidation.changed_at >= since - 1, CharacterInvalidation.writer != self.writer)).all()
+        if changed:
+            self.invalidate(None if 0 in changed else changed, log=False)
+        if self._polled_at - self._pruned_at > self.ttl:
+            # Older entries can't refer to anything still cached anywhere
+            self._pruned_at = self._polled_at
+            db.session.execute(db.delete(CharacterInvalidation).where(
+                CharacterInvalidation.changed_at < self._polled_at - 2 * self.ttl))
+
+    def flush(self):
+        # Polls first, so nothing waits for an entry's lock while this
+        # transaction holds the database's write lock. Entries a request is
+        # committing are skipped (their lock is held) until the next flush.
+        pending = []
+        try:
+            if self.shared:
+                self.poll()
+            with self._lock:
+                entries = list(self.entries.values())
+            for entry in entries:
+                if entry.lock.acquire(blocking=False):
+                    try:
+                        pending.extend(self.pending([entry]))
+                    finally:
+                        entry.lock.release()
+            pending = self.write(pending)
+            db.session.commit()
+        except CharacterConflict:
+            db.session.rollback()  # the rows are checked again next time
+            return 0
+        except Exception:
+            db.session.rollback()
+            raise
+        self.written(pending)
+        return len(pending)
+
+    def start(self):
+        if self._thread is None and self.flush_interval:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="character-cache", daemon=True)
+                    self._thread.start()
+                    atexit.register(self._flush_in_app_context)
+
+    def _flush_in_app_context(self):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Character cache flush failed")
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self._flush_in_app_context()
+
+character_cache = (CharacterCache(app.config['CHARACTER_CACHE_SIZE'], app.config['CHARACTER_CACHE_TTL'],
+                                  app.config['CHARACTER_CACHE_FLUSH_INTERVAL'], app.config['CHARACTER_CACHE_SHARED'],
+                                  app.config['CHARACTER_LOCK_TIMEOUT'])
+                   if app.config['CHARACTER_CACHE'] else None)
+
+# Dropped entries written in a transaction are settled when it ends: kept out
+# of the cache once it commits, put back if it rolls back (or is closed
+# without committing, as after an error response)
+if character_cache is not None:
+    @event.listens_for(db.session, "after_commit")
+    def forget_dropped_characters(session):
+        session.info.pop("dropped_characters", None)
+
+    @event.listens_for(db.session, "after_transaction_end")
+    def restore_dropped_characters(session, transaction):
+        dropped = session.info.pop("dropped_characters", None) if transaction.parent is None else None
+        if dropped:
+            character_cache.restore_dropped(dropped, g.get("character_locks", ()))
+
+# Persist these characters with the current request (e.g. at the end of a battle)
+def write_through(*characters):
+    if character_cache is not None:
+        g.setdefault("cache_write_through", set()).update(character.id for character in characters)
+
+if metrics is not None and character_cache is not None:
+    metrics.register(CallbackMetric(
+        "rpg_character_cache_events_total", "Character cache hits, misses, evictions, writes and conflicts.",
+        "counter", lambda: {(event,): count for event, count in character_cache.stats.items()}, ("event",)))
+    metrics.register(CallbackMetric(
+        "rpg_character_cache_entries", "Characters held in this process's cache.", "gauge",
+        lambda: {(): len(character_cache.entries)}))
+
+# -------------------------------
+# Concurrent Updates (optimistic locking)
+# -------------------------------
+# Two tabs or two workers can load the same character, change it and save.
+# Instead of a lock around the whole request, each one works on its own copy
+# and saves with a compare-and-swap at its commit point: on the version
+# column for the row (a stale UPDATE raises StaleDataError), and on the
+# cached entry's revision for changes still waiting in the write-behind
+# cache. The loser gets CharacterConflict, and routes marked with
+# @retry_on_conflict run again from scratch on fresh data, up to
+# CHARACTER_RETRIES times, before answering 409.
+#
+# Routes with side effects outside the database (the battle store) call
+# commit_characters() just before making them; the characters committed stay
+# locked until the request ends, so a retry never sees half of a turn. Other
+# routes reach the commit point when the view returns.
+#
+# A POST can carry a submission token (a "submission" form field, rendered
+# into the game's forms, or an Idempotency-Key header). The first request
+# with a token records it at its commit point, in the same transaction; a
+# repeat gets the first one's JSON answer again, or a redirect to the page
+# for a form post, without playing anything twice. Pages rendering a token
+# (battle, shop, PvP) differ on every load, so they skip the HTML ETag.
+class Submission(db.Model):
+    __tablename__ = "submission"
+    key = db.Column(db.String(100), primary_key=True)  # "<character id>:<token>"
+    created_at = db.Column(db.Float, nullable=False, index=True)
+    response = db.Column(db.JSON)  # status and JSON body for a repeat of a JSON request
+
+app.config['CHARACTER_RETRIES'] = 3
+app.config['SUBMISSION_TTL'] = 24 * 3600
+
+class DuplicateSubmission(Exception):
+    pass
+
+def submission_token():
+    g.skip_etag = True  # a page with a fresh token never repeats, so it is never a 304
+    return uuid.uuid4().hex
+
+app.jinja_env.globals["submission_token"] = submission_token
+
+def submission_key():
+    token = request.headers.get("Idempotency-Key") or request.form.get("submission")
+    if not token or len(token) > 64 or request.method != "POST":
+        return None
+    owner = g.api_character.id if g.get("api_character") is not None else session.get("char_id")
+    return f"{owner}:{token}"
+
+def claim_submission():
+    key = g.get("submission")
+    if key is None or g.get("submission_claimed"):
+        return
+    try:
+        db.session.execute(db.insert(Submission).values(key=key, created_at=time.time()))
+    except IntegrityError:
+        raise DuplicateSubmission(key)
+    g.submission_claimed = True
+
+def replay_submission(key):
+    submission = db.session.get(Submission, key)
+    if submission is None:
+        return None
+    if submission.response is not None:
+        return make_response(jsonify(submission.response["body"]), submission.response["status"])
+    return redirect(request.url, code=303)
+
+# The request's commit point for character changes (see above)
+def commit_characters():
+    claim_submission()
+    try:
+        db.session.flush()
+    except StaleDataError:
+        raise CharacterConflict(None)
+    tracked = g.get("cached_characters")
+    if tracked:
+        character_cache.commit(tracked.values(), g.pop("cache_write_through", ()))
+
+def reset_request():
+    # Forgets everything a conflicting attempt did, before a retry
+    db.session.rollback()
+    db.session.info.pop("writes", None)
+    tracked = g.pop("cached_characters", None)
+    if tracked:
+        character_cache.release(tracked.values(), failed=True)
+    for key in ("cache_write_through", "battle_events", "submission_claimed"):
+        g.pop(key, None)
+    if "api_notices" in g:
+        g.api_notices = []
+    if g.get("api_character") is not None:
+        g.api_character = get_character(g.api_character.id)
+
+def conflict_response():
+    message = "Someone else changed your character at the same time; try again."
+    if request.is_json or request.blueprint == "api":
+        return make_response(jsonify({"error": message}), 409)
+    flash(message, "warning")
+    return redirect(request.url, code=303)
+
+def retry_on_conflict(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.submission = submission_key()
+        if g.submission is not None:
+            replay = replay_submission(g.submission)
+            if replay is not None:
+                g.submission = None  # nothing of this request is recorded
+                return replay
+        flashes = list(session.get("_flashes", []))
+        for attempt in range(app.config['CHARACTER_RETRIES'] + 1):
+            try:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code < 400:  # errors commit nothing (see commit_unit_of_work)
+                    commit_characters()
+            except CharacterConflict:
+                reset_request()
+                session["_flashes"] = list(flashes)  # notices from the failed attempt
+                continue
+            except DuplicateSubmission:
+                reset_request()
+                return replay_submission(g.submission) or conflict_response()
+            if g.get("submission_claimed") and response.is_json:
+                db.session.execute(db.update(Submission).where(Submission.key == g.submission).values(
+                    response={"status": response.status_code, "body": response.get_json()}))
+            return response
+        return conflict_response()
+    return wrapper
+
+# Routes without @retry_on_conflict reach the commit point here, before
+# commit_unit_of_work (registered earlier, so it runs later)
+@app.after_request
+def commit_cached_characters(response):
+    if response.status_code >= 400:
+        g.request_failed = True  # nothing is committed
+    elif g.get("cached_characters"):
+        try:
+            commit_characters()
+        except (CharacterConflict, DuplicateSubmission):
+            reset_request()
+            return conflict_response()
+    return response
+
+@app.teardown_request
+def release_cached_characters(exc):
+    tracked = g.pop("cached_characters", None)
+    if tracked:
+        character_cache.release(tracked.values(), failed=exc is not None or g.get("request_failed", False))
+    else:
+        for entry in g.pop("character_locks", []):
+            entry.lock.release()
+
+# -------------------------------
+# Leaderboards
+# -------------------------------
+# Rankings read straight off descending composite indexes (SQLite keeps them
+# current on every write), overall and per race. Top-K is an index range
+# scan. For "my rank" each board keeps an ascending array of every ranked
+# score, rebuilt from the index at most once per LEADERBOARD_CACHE_TTL, so a
+# lookup is a bisect. Ties share a rank. Pooled (unclaimed) characters aren't
+# ranked.
+# EXP resets on level-up, so (level, exp) is also the total-EXP order.
+LEADERBOARDS = {
+    "level": (Character.level, Character.exp),
+    "gold": (Character.gold,),
+}
+db.Index("ix_character_level_rank", Character.level.desc(), Character.exp.desc(), Character.id)
+db.Index("ix_character_gold_rank", Character.gold.desc(), Character.id)
+db.Index("ix_character_race_level_rank", Character.race, Character.level.desc(), Character.exp.desc(), Character.id)
+db.Index("ix_character_race_gold_rank", Character.race, Character.gold.desc(), Character.id)
+
+app.config['LEADERBOARD_CACHE_TTL'] = 10
+app.config['LEADERBOARD_SIZE'] = 10
+app.config['LEADERBOARD_MAX_SIZE'] = 100
+_leaderboard_cache = {}
+_leaderboard_lock = threading.Lock()
+
+def leaderboard_score(board, values):
+    # One sortable integer per character: level and exp packed, or gold
+    if board == "level":
+        level, exp = values
+        return (level << 32) + exp
+    return values[0]
+
+def _ranked(query, race):
+    query = query.where(Character.id.not_in(db.select(CharacterPool.character_id)))
+    return query.where(Character.race == race) if race else query
+
+def _cached_leaderboard(key, compute):
+    now = time.time()
+    with _leaderboard_lock:
+        hit = _leaderboard_cache.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    value = compute()
+    with _leaderboard_lock:
+        _leaderboard_cache[key] = (now + app.config['LEADERBOARD_CACHE_TTL'], value)
+    return value
+
+def leaderboard_scores(board, race=None):
+    def compute():
+        columns = LEADERBOARDS[board]
+        rows = db.session.execute(_ranked(db.select(*columns), race).order_by(*columns))
+        return array("q", [leaderboard_score(board, row) for row in rows])
+    return _cached_leaderboard(("scores", board, race), compute)
+
+def leaderboard_rank(board, values, race=None):
+    scores = leaderboard_scores(board, race)
+    return len(scores) - bisect_right(scores, leaderboard_score(board, values)) + 1, len(scores)
+
+def leaderboard_top(board, race=None, size=10):
+    def compute():
+        columns = LEADERBOARDS[board]
+        query = _ranked(db.select(Character.id, Character.race, Character.level, Character.exp, Character.gold), race)
+        rows = db.session.execute(query.order_by(*[column.desc() for column in columns], Character.id).limit(size))
+        top = []
+        for row in rows:
+            entry = row._asdict()
+            entry["total_exp"] = level_exp_cost(1, row.level - 1) + row.exp
+            entry["rank"] = leaderboard_rank(board, [entry[column.key] for column in columns], race)[0]
+            top.append(entry)
+        return top
+    return _cached_leaderboard(("top", board, race, size), compute)
+
+def leaderboard(board, race=None, size=10, character=None):
+    result = {"board": board, "race": race, "top": leaderboard_top(board, race, size), "me": None}
+    if character is not None and (race is None or character.race == race):
+        rank, ranked = leaderboard_rank(board, [getattr(character, column.key) for column in LEADERBOARDS[board]], race)
+        result["me"] = {"id": character.id, "rank": rank, "of": ranked}
+    return result
 
 # -------------------------------
 # Database Table Creation
 # -------------------------------
+# create_all() only creates missing tables, so columns and indexes added to
+# existing models are applied here (SQLite ALTER TABLE ADD COLUMN).
+def upgrade_schema():
+    db.create_all()
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+        # Rows from before last_seen existed count as seen now
+        conn.execute(db.update(Character).where(Character.last_seen.is_(None)).values(last_seen=time.time()))
+        # Rows from before optimistic locking start at version 1
+        conn.execute(db.update(Character).where(Character.version.is_(None)).values(version=1))
+        # Rows from before seeds were stored get one for their evolution stream
+        unseeded = conn.scalars(db.select(Character.id).where(Character.seed.is_(None))).all()
+        if unseeded:
+            table = Character.__table__
+            conn.execute(table.update().where(table.c.id == db.bindparam("row_id")).values(seed=db.bindparam("row_seed")),
+                         [{"row_id": character_id, "row_seed": new_seed()} for character_id in unseeded])
+
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """Create missing tables, columns and indexes."""
+    upgrade_schema()
+    click.echo("Database schema is up to date.")
+
 # @app.before_first_request
 # def create_tables():
 #     db.create_all()
@@ -352,33 +1520,126 @@ class Character(db.Model):
 # -------------------------------
 # Enemy Generation (using defined races and applying level scaling)
 # -------------------------------
-def generate_enemy(player_level):
-    enemy_race = random.choice(list(RACE_STATS.keys()))
-    base_stats = RACE_STATS[enemy_race].copy()
-    if enemy_race == "Kaosborne":
-        base_health = calculate_kaosborne_stat()
-        speed = calculate_kaosborne_stat()
-    else:
-        base_health = base_stats["base_health"]
-        speed = base_stats["speed"]
-    enemy_level = random.randint(max(1, player_level - 1), player_level + 1)
-    enemy = {
-        "race": enemy_race,
-        "level": enemy_level,
-        "base_health": base_health + (enemy_level - 1) * 20,
-        "current_health": base_health + (enemy_level - 1) * 20,
+# An enemy is fully described by a compact reference
+#   [race_id, level, rolled base_health, rolled speed]
+# (the rolls only vary for Kaosborne); everything else comes from a cached
+# per-(race, level) template. Battle state stores the reference plus current HP.
+ENEMY_RACES = list(RACE_STATS.keys())
+
+@lru_cache(maxsize=None)
+def enemy_template(race, level):
+    base_stats = RACE_STATS[race]
+    strength = base_stats["strength"] + (level - 1) * 2
+    return {
+        "race": race,
+        "level": level,
         "mana": base_stats["mana"],
-        "strength": base_stats["strength"] + (enemy_level - 1) * 2,
-        "intelligence": base_stats["intelligence"] + (enemy_level - 1) * 2,
-        "wisdom": base_stats["wisdom"] + (enemy_level - 1) * 2,
-        "constitution": base_stats["constitution"] + (enemy_level - 1) * 2,
-        "speed": speed,
-        "ability": base_stats["ability"]
+        "strength": strength,
+        "intelligence": base_stats["intelligence"] + (level - 1) * 2,
+        "wisdom": base_stats["wisdom"] + (level - 1) * 2,
+        "constitution": base_stats["constitution"] + (level - 1) * 2,
+        "ability": base_stats["ability"],
+        "attack_min": strength,
+        "attack_max": strength + 10,
     }
-    enemy["attack_min"] = enemy["strength"]
-    enemy["attack_max"] = enemy["strength"] + 10
+
+def roll_enemy_ref(player_level, rng):
+    race_id = rng.randrange(len(ENEMY_RACES))
+    enemy_race = ENEMY_RACES[race_id]
+    if enemy_race == "Kaosborne":
+        base_health = calculate_kaosborne_stat(rng)
+        speed = calculate_kaosborne_stat(rng)
+    else:
+        base_health = RACE_STATS[enemy_race]["base_health"]
+        speed = RACE_STATS[enemy_race]["speed"]
+    enemy_level = rng.randint(max(1, player_level - 1), player_level + 1)
+    return [race_id, enemy_level, base_health, speed]
+
+def enemy_from_ref(ref, current_health=None):
+    race_id, level, base_health, speed = ref
+    enemy = dict(enemy_template(ENEMY_RACES[race_id], level))
+    enemy["ref"] = ref
+    enemy["base_health"] = base_health + (level - 1) * 20
+    enemy["current_health"] = enemy["base_health"] if current_health is None else current_health
+    enemy["speed"] = speed
     return enemy
 
+def pack_enemy(enemy):
+    return {"ref": enemy["ref"], "hp": enemy["current_health"]}
+
+def unpack_enemy(packed):
+    return enemy_from_ref(packed["ref"], packed["hp"])
+
+def generate_enemy(player_level, rng):
+    return enemy_from_ref(roll_enemy_ref(player_level, rng))
+
+# Pre-rolled enemy references per player level. take() pops one; when a
+# level's pool drops below `low_water` it is topped up with a batch of
+# `batch_size`, on a background thread when enabled so rolling stays off
+# the request path. A cold pool falls back to rolling one inline. The pool
+# rolls from its own stream; a fight records the reference it was given.
+class EnemyPool:
+    def __init__(self, batch_size=64, low_water=16, background=True):
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self.background = background
+        self.pools = defaultdict(deque)
+        self.rng = RngStream(new_seed())
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._roll_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def take(self, player_level):
+        pool = self.pools[player_level]
+        try:
+            ref = pool.popleft()
+        except IndexError:
+            with self._roll_lock:
+                ref = roll_enemy_ref(player_level, self.rng)
+        if len(pool) < self.low_water:
+            self.request_refill(player_level)
+        return ref
+
+    def refill(self, player_level):
+        pool = self.pools[player_level]
+        missing = self.batch_size - len(pool)
+        if missing > 0:
+            with self._roll_lock:
+                refs = [roll_enemy_ref(player_level, self.rng) for _ in range(missing)]
+            pool.extend(refs)
+
+    def warm(self, levels):
+        for level in levels:
+            self.refill(level)
+
+    def request_refill(self, player_level):
+        if not self.background:
+            self.refill(player_level)
+            return
+        with self._lock:
+            self._pending.add(player_level)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="enemy-pool", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            with self._lock:
+                self._wake.clear()
+                levels = list(self._pending)
+                self._pending.clear()
+            for level in levels:
+                self.refill(level)
+
+app.config['ENEMY_POOL_BATCH'] = 64
+app.config['ENEMY_POOL_BACKGROUND'] = os.environ.get("ENEMY_POOL_BACKGROUND", "1") == "1"
+enemy_pool = EnemyPool(batch_size=app.config['ENEMY_POOL_BATCH'], low_water=app.config['ENEMY_POOL_BATCH'] // 4,
+                       background=app.config['ENEMY_POOL_BACKGROUND'])
+
 # -------------------------------
 # Damage Calculation (includes reduction from constitution)
 # -------------------------------
@@ -390,80 +1651,1318 @@ def calculate_damage(damage, defense_constitution):
 # -------------------------------
 # Ability Effects (for PvE and PvP)
 # -------------------------------
-def use_ability(attacker, defender):
-    log = ""
-    damage = 0
-    # Effects vary based on the ability text (we check for key words)
-    ability_text = attacker.ability.split(" | ")[0]  # Use primary ability for effect
-    if ability_text in ["Inspiring Strike", "Heroic Rally", "Champion Human"]:
-        bonus = random.randint(10, 20)
-        damage = attacker.strength + bonus
-        heal = bonus // 2
-        attacker.current_health = min(attacker.base_health, attacker.current_health + heal)
-        log = f"{attacker.race} used {ability_text}, dealing {damage} damage and healing for {heal} HP!"
-    elif ability_text in ["Stout Resolve", "Dwarven Lord", "Stalwart Fortress"]:
-        heal = random.randint(5, 15)
+# Each ability resolves as:
+#   damage = (strength + roll(damage)) * scale      if "damage" is set
+#   heal   = roll(heal), or damage roll // heal_div if "heal_div" is set
+# "mana_cost" must be paid or the ability fizzles with "fail_log".
+# With "chance", only the damage half fires (probability = chance) and the
+# heal half otherwise, logged with "alt_log". Evolved abilities share the
+# effect of the base ability they are listed under.
+ABILITY_EFFECTS = {
+    "Basic Attack": {"damage": (1, 10),
+                     "log": "{race} performed a basic attack for {damage} damage."},
+    "Inspiring Strike": {"aliases": ["Heroic Rally"], "damage": (10, 20), "heal_div": 2,
+                         "log": "{race} used {ability}, dealing {damage} damage and healing for {heal} HP!"},
+    "Stout Resolve": {"aliases": ["Stalwart Fortress"], "heal": (5, 15),
+                      "log": "{race} used {ability} and fortified their defenses, healing for {heal} HP!"},
+    "Swift Arrow": {"aliases": ["Elven Grace"], "damage": (5, 15), "scale": 2,
+                    "log": "{race} unleashed {ability}, striking for {damage} damage!"},
+    "Infernal Rage": {"aliases": ["Hellfire Blast"], "damage": (30, 30), "mana_cost": 20,
+                      "log": "{race} invoked {ability}, dealing {damage} searing damage!",
+                      "fail_log": "{race} tried to use {ability} but lacked enough mana!"},
+    "Heavenly Grace": {"aliases": ["Divine Intervention"], "heal": (20, 30),
+                       "log": "{race} used {ability} to heal for {heal} HP!"},
+    "Divine Charge": {"aliases": ["Celestial Smite"], "damage": (15, 25),
+                      "log": "{race} used {ability}, charging for {damage} damage!"},
+    "Miraculous Touch": {"aliases": ["Miraculous Salvation"], "damage": (10, 10), "heal": (10, 20),
+                         "log": "{race} used {ability}, dealing {damage} damage and healing for {heal} HP!"},
+    "Searing Flames": {"aliases": ["Dragon's Fury"], "damage": (20, 30),
+                       "log": "{race} unleashed {ability} for {damage} damage!"},
+    "Savage Bite": {"aliases": ["Feral Roar"], "damage": (10, 20),
+                    "log": "{race} used {ability} and bit fiercely for {damage} damage!"},
+    "Wild Anarchy": {"aliases": ["Chaotic Surge"], "damage": (5, 15), "heal": (5, 15), "chance": 0.5,
+                     "log": "{race} channeled chaos via {ability}, dealing {damage} damage!",
+                     "alt_log": "{race} let loose {ability} and healed for {heal} HP!"},
+}
+
+AbilityEffect = namedtuple("AbilityEffect", "id damage scale heal heal_div mana_cost chance log alt_log fail_log")
+
+# Compiled once: ABILITY_TABLE is indexed by effect ID (0 = basic attack),
+# ABILITY_IDS maps every ability name to its effect ID.
+ABILITY_TABLE = []
+ABILITY_IDS = {}
+for _name, _spec in ABILITY_EFFECTS.items():
+    _effect = AbilityEffect(
+        id=len(ABILITY_TABLE),
+        damage=_spec.get("damage"),
+        scale=_spec.get("scale", 1),
+        heal=_spec.get("heal"),
+        heal_div=_spec.get("heal_div"),
+        mana_cost=_spec.get("mana_cost", 0),
+        chance=_spec.get("chance"),
+        log=_spec["log"],
+        alt_log=_spec.get("alt_log"),
+        fail_log=_spec.get("fail_log"),
+    )
+    ABILITY_TABLE.append(_effect)
+    for _alias in [_name] + _spec.get("aliases", []):
+        ABILITY_IDS[_alias] = _effect.id
+BASIC_ATTACK = ABILITY_TABLE[0]
+
+# A character's ability column holds "Primary" or "Primary | Secondary"; only
+# the primary fires. Lookups are memoized on the full column value.
+_PRIMARY_ABILITY = {}
+
+def primary_ability(ability):
+    entry = _PRIMARY_ABILITY.get(ability)
+    if entry is None:
+        name = ability.split(" | ")[0]
+        entry = _PRIMARY_ABILITY[ability] = (name, ABILITY_TABLE[ABILITY_IDS.get(name, BASIC_ATTACK.id)])
+    return entry
+
+for _stats in list(RACE_STATS.values()) + list(EVOLUTION_MAP.values()):
+    primary_ability(_stats["ability"])
+for _evolution in EVOLUTION_MAP.values():
+    primary_ability(f"{_evolution['ability']} | {_evolution['secondary_ability']}")
+
+def _roll(bounds, rng):
+    low, high = bounds
+    return low if low == high else rng.randint(low, high)
+
+def use_ability(attacker, defender, rng):
+    ability_text, effect = primary_ability(attacker.ability)
+    if attacker.mana < effect.mana_cost:
+        return effect.fail_log.format(race=attacker.race, ability=ability_text), 0
+    attacker.mana -= effect.mana_cost
+    damage = heal = 0
+    log = effect.log
+    strike = True
+    mend = True
+    if effect.chance is not None:
+        strike = rng.random() < effect.chance
+        mend = not strike
+        if mend:
+            log = effect.alt_log
+    if strike and effect.damage:
+        roll = _roll(effect.damage, rng)
+        damage = (attacker.strength + roll) * effect.scale
+        if effect.heal_div:
+            heal = roll // effect.heal_div
+    if mend and effect.heal:
+        heal = _roll(effect.heal, rng)
+    if heal:
         attacker.current_health = min(attacker.base_health, attacker.current_health + heal)
-        log = f"{attacker.race} used {ability_text} and fortified their defenses, healing for {heal} HP!"
-    elif ability_text in ["Swift Arrow", "High Elf", "Elven Grace"]:
-        damage = (attacker.strength + random.randint(5, 15)) * 2
-        log = f"{attacker.race} unleashed {ability_text}, striking for {damage} damage!"
-    elif ability_text in ["Infernal Rage", "Archdemon", "Hellfire Blast"]:
-        if attacker.mana >= 20:
-            attacker.mana -= 20
-            damage = attacker.strength + 30
-            log = f"{attacker.race} invoked {ability_text}, dealing {damage} searing damage!"
+    return log.format(race=attacker.race, ability=ability_text, damage=damage, heal=heal), damage
+
+# -------------------------------
+# PvE Turn Resolution (shared by the battle page and auto-battle)
+# -------------------------------
+# Returns the new log lines and "won", "lost" or None if the fight goes on.
+def play_turn(character, enemy, action, rng):
+    log = []
+    if action == "attack":
+        base_damage = character.strength + rng.randint(1, 10)
+        # Apply type advantage multiplier
+        mult = race_multiplier(character.race, enemy["race"])
+        damage = int(base_damage * mult)
+        enemy["current_health"] -= damage
+        log.append(f"You attacked the {enemy['race']} for {damage} damage!")
+        if enemy["current_health"] <= 0:
+            log.append(f"You defeated the {enemy['race']}!")
+            exp_gain = enemy["level"] * 50
+            gold_gain = enemy["level"] * 20
+            log.append(f"You gained {exp_gain} EXP and {gold_gain} gold!")
+            character.gain_exp(exp_gain)
+            character.gold += gold_gain
+            return log, "won"
+        enemy_damage = rng.randint(enemy["attack_min"], enemy["attack_max"])
+        effective_damage = calculate_damage(enemy_damage, character.constitution)
+        character.current_health -= effective_damage
+        log.append(f"The {enemy['race']} attacked you for {effective_damage} damage!")
+    elif action == "defend":
+        enemy_damage = rng.randint(enemy["attack_min"], enemy["attack_max"])
+        reduced_damage = max(1, enemy_damage - (character.constitution // 2) - 5)
+        character.current_health -= reduced_damage
+        log.append(f"You defended! The {enemy['race']} attacked for {reduced_damage} damage after reduction.")
+    elif action == "use_potion":
+        if character.potions > 0:
+            heal_amount = rng.randint(30, 50)
+            character.current_health = min(character.base_health, character.current_health + heal_amount)
+            character.potions -= 1
+            log.append(f"You used a potion and healed for {heal_amount} HP!")
+            enemy_damage = rng.randint(enemy["attack_min"], enemy["attack_max"])
+            effective_damage = calculate_damage(enemy_damage, character.constitution)
+            character.current_health -= effective_damage
+            log.append(f"While using a potion, the {enemy['race']} attacked you for {effective_damage} damage!")
         else:
-            log = f"{attacker.race} tried to use {ability_text} but lacked enough mana!"
-    elif ability_text in ["Heavenly Grace", "Archangel", "Divine Intervention"]:
-        heal = random.randint(20, 30)
-        attacker.current_health = min(attacker.base_health, attacker.current_health + heal)
-        damage = 0
-        log = f"{attacker.race} used {ability_text} to heal for {heal} HP!"
-    elif ability_text in ["Divine Charge", "Demigod", "Celestial Smite"]:
-        damage = attacker.strength + random.randint(15, 25)
-        log = f"{attacker.race} used {ability_text}, charging for {damage} damage!"
-    elif ability_text in ["Miraculous Touch", "Messiah", "Miraculous Salvation"]:
-        damage = attacker.strength + 10
-        heal = random.randint(10, 20)
-        attacker.current_health = min(attacker.base_health, attacker.current_health + heal)
-        log = f"{attacker.race} used {ability_text}, dealing {damage} damage and healing for {heal} HP!"
-    elif ability_text in ["Searing Flames", "Dragon", "Dragon's Fury"]:
-        damage = attacker.strength + random.randint(20, 30)
-        log = f"{attacker.race} unleashed {ability_text} for {damage} damage!"
-    elif ability_text in ["Savage Bite", "Beastman", "Feral Roar"]:
-        damage = attacker.strength + random.randint(10, 20)
-        log = f"{attacker.race} used {ability_text} and bit fiercely for {damage} damage!"
-    elif ability_text in ["Wild Anarchy", "Kaosborne", "Chaotic Surge"]:
-        if random.choice([True, False]):
-            damage = attacker.strength + random.randint(5, 15)
-            log = f"{attacker.race} channeled chaos via {ability_text}, dealing {damage} damage!"
+            log.append("You have no potions left!")
+    if character.current_health <= 0:
+        character.current_health = 0
+        log.append("You have been defeated!")
+        return log, "lost"
+    return log, None
+
+# -------------------------------
+# Auto-Battle (resolve a whole PvE fight in one request)
+# -------------------------------
+# "attack": always attack.
+# "potion": drink a potion when HP is below the threshold (if any are left).
+# "defend": defend when HP is below the threshold.
+AUTO_BATTLE_POLICIES = ["attack", "potion", "defend"]
+AUTO_BATTLE_MAX_TURNS = 200
+AUTO_BATTLE_LOG_TAIL = 6
+
+def choose_auto_action(character, policy, threshold):
+    low = character.current_health * 100 < character.base_health * threshold
+    if policy == "potion" and low and character.potions > 0:
+        return "use_potion"
+    if policy == "defend" and low:
+        return "defend"
+    return "attack"
+
+def auto_battle(character, enemy, rng, policy="attack", threshold=30):
+    # Plays turns until the fight ends or AUTO_BATTLE_MAX_TURNS is reached and
+    # returns a summary plus a condensed log (totals and the last few lines).
+    outcome = None
+    turns = 0
+    actions = {action: 0 for action in ["attack", "defend", "use_potion"]}
+    start_health = character.current_health
+    start_enemy_health = enemy["current_health"]
+    tail = []
+    if character.current_health <= 0:
+        outcome = "lost"
+    while outcome is None and turns < AUTO_BATTLE_MAX_TURNS:
+        action = choose_auto_action(character, policy, threshold)
+        lines, outcome = play_turn(character, enemy, action, rng)
+        actions[action] += 1
+        turns += 1
+        tail = (tail + lines)[-AUTO_BATTLE_LOG_TAIL:]
+    summary = (f"Auto-battle ({policy}) vs {enemy['race']}: {turns} turns, "
+               f"{actions['attack']} attacks, {actions['defend']} defends, {actions['use_potion']} potions. "
+               f"Dealt {start_enemy_health - max(enemy['current_health'], 0)} damage, "
+               f"lost {start_health - character.current_health} HP.")
+    return {"outcome": outcome or "unfinished", "turns": turns, "actions": actions, "log": [summary] + tail}
+
+# -------------------------------
+# Win Odds (exact outcome of an auto-battle)
+# -------------------------------
+# Instead of sampling fights, the odds follow the exact probability of every
+# state turn by turn, under the same rules as play_turn/auto_battle:
+#   - The enemy only loses HP to attacks, so the number of attacks it takes
+#     to kill it is independent of what the player does. Its distribution
+#     comes from convolving the enemy's HP with the attack-damage pmf
+#     (strength + randint(1, 10), times the type multiplier).
+#   - The player's side is a Markov chain over (potions left, HP, attacks
+#     landed), kept as a dense NumPy box trimmed to the states that still
+#     have probability. Each turn applies the policy's action, the enemy's
+#     randint(attack_min, attack_max) hit through calculate_damage (or the
+#     defend reduction), and the potion heal, capped at max HP.
+# An attack wins with the enemy's hazard at that attack count. Mass that is
+# still fighting after AUTO_BATTLE_MAX_TURNS counts as "unfinished". States
+# below WIN_ODDS_EPSILON are dropped, which keeps the box to the tens of
+# standard deviations that matter in long fights (the odds stay exact to
+# ~1e-9). Results are memoized per (fighter stats, policy) with LRU eviction.
+WIN_ODDS_CACHE_SIZE = 4096
+WIN_ODDS_EPSILON = 1e-13
+POTION_HEAL = (30, 50)
+DEFEND_REDUCTION = 5
+
+def _pmf(values):
+    # [(value, probability)] for equally likely values
+    counts = defaultdict(int)
+    for value in values:
+        counts[value] += 1
+    return [(value, count / len(values)) for value, count in sorted(counts.items())]
+
+def _kill_hazard(health, hits, max_attacks):
+    # hazard[k] = P(the k-th attack kills | the enemy survived k - 1 attacks)
+    low = hits[0][0]
+    weights = np.zeros(hits[-1][0] - low + 1)
+    for damage, p in hits:
+        weights[damage - low] = p
+    hazard = np.ones(max_attacks + 2)
+    dist, top = np.ones(1), health  # dist[i] = P(HP == top - i)
+    alive = 1.0
+    for k in range(1, max_attacks + 1):
+        dist = np.convolve(dist, weights)
+        top -= low
+        killed = dist[max(top, 0):].sum()
+        dist = dist[:max(top, 0)]
+        hazard[k] = killed / alive if alive > 0 else 1.0
+        alive -= killed
+        if not len(dist):
+            break
+    return hazard
+
+def _apply_hits(src, h0, dst, d0, hits, layer, column):
+    # Adds src (HP h0 upwards) into dst (HP d0 upwards, offset by layer and
+    # column) after each hit; returns the probability knocked to 0 HP.
+    lost = 0.0
+    layers, rows, columns = src.shape
+    for damage, p in hits:
+        cut = min(max(damage - h0 + 1, 0), rows)  # rows with HP <= damage
+        if cut:
+            lost += p * src[:, :cut].sum()
+        if cut < rows:
+            start = h0 + cut - damage - d0
+            dst[layer:layer + layers, start:start + rows - cut, column:column + columns] += p * src[:, cut:]
+    return lost
+
+def _apply_heals(src, h0, heals, cap):
+    # Heals src (HP h0 upwards) by each amount, capped at `cap`; returns the
+    # healed box and its lowest HP
+    layers, rows, columns = src.shape
+    r0 = min(h0 + heals[0][0], cap)
+    out = np.zeros((layers, min(h0 + rows - 1 + heals[-1][0], cap) - r0 + 1, columns))
+    for heal, p in heals:
+        keep = min(max(cap - heal - h0 + 1, 0), rows)  # rows that stay under the cap
+        if keep:
+            out[:, h0 + heal - r0:h0 + heal - r0 + keep] += p * src[:, :keep]
+        if keep < rows:
+            out[:, cap - r0] += p * src[:, keep:].sum(axis=1)
+    return out, r0
+
+def _trim(box, offsets):
+    # Shrinks the box to the states with probability left
+    spans = []
+    for axis in range(3):
+        live = np.flatnonzero(box.any(axis=tuple(a for a in range(3) if a != axis)))
+        if not len(live):
+            return None, offsets
+        spans.append((live[0], live[-1] + 1))
+    (l0, l1), (h0, h1), (k0, k1) = spans
+    return box[l0:l1, h0:h1, k0:k1], (offsets[0] + l0, offsets[1] + h0, offsets[2] + k0)
+
+@lru_cache(maxsize=WIN_ODDS_CACHE_SIZE)
+def _win_odds(policy, threshold, race, strength, constitution, health, base_health, potions,
+              enemy_race, attack_min, attack_max, enemy_health):
+    max_turns = AUTO_BATTLE_MAX_TURNS
+    if health <= 0:
+        return {"win": 0.0, "loss": 1.0, "unfinished": 0.0, "expected_turns": 0.0}
+    mult = race_multiplier(race, enemy_race)
+    hazard = _kill_hazard(max(enemy_health, 1), _pmf([int((strength + roll) * mult) for roll in range(1, 11)]),
+                          max_turns)
+    enemy_rolls = range(attack_min, attack_max + 1)
+    hits = _pmf([calculate_damage(damage, constitution) for damage in enemy_rolls])
+    defend_hits = _pmf([max(1, damage - constitution // 2 - DEFEND_REDUCTION) for damage in enemy_rolls])
+    heals = _pmf(range(POTION_HEAL[0], POTION_HEAL[1] + 1))
+    cap = max(base_health, health)
+    if policy != "potion":
+        potions = 0  # never drunk; one layer
+    box = np.ones((1, 1, 1))
+    offsets = (potions, min(health, cap), 0)  # (potions, HP, attacks landed) of box[0, 0, 0]
+    win = loss = expected = 0.0
+    for turn in range(1, max_turns + 1):
+        l0, h0, k0 = offsets
+        layers, rows, columns = box.shape
+        hp = h0 + np.arange(rows)
+        low = hp * 100 < base_health * threshold
+        potion = np.zeros((layers, rows), dtype=bool)
+        defend = np.zeros((layers, rows), dtype=bool)
+        if policy == "potion":
+            potion = low[None, :] & (l0 + np.arange(layers) > 0)[:, None]
+        elif policy == "defend":
+            defend = np.broadcast_to(low, (layers, rows))
+        attack = ~(potion | defend)
+
+        d_l0 = max(l0 - 1, 0)
+        d_h0 = max(1, h0 - hits[-1][0])
+        d_top = min(cap, h0 + rows - 1 + (heals[-1][0] if potion.any() else 0))
+        out = np.zeros((l0 + layers - d_l0, d_top - d_h0 + 1, columns + 1))
+        won = lost = 0.0
+        if attack.any():
+            striking = box * attack[:, :, None]
+            kills = hazard[k0 + 1:k0 + columns + 1]
+            won = (striking.sum(axis=(0, 1)) * kills).sum()
+            lost += _apply_hits(striking * (1 - kills), h0, out, d_h0, hits, l0 - d_l0, 1)
+        if defend.any():
+            lost += _apply_hits(box * defend[:, :, None], h0, out, d_h0, defend_hits, l0 - d_l0, 0)
+        if potion.any():
+            dry = 1 if l0 == 0 else 0  # the no-potions layer never drinks
+            healed, r0 = _apply_heals(box[dry:] * potion[dry:, :, None], h0, heals, cap)
+            lost += _apply_hits(healed, r0, out, d_h0, hits, l0 + dry - 1 - d_l0, 0)
+        win += won
+        loss += lost
+        expected += turn * (won + lost)
+        out[out < WIN_ODDS_EPSILON] = 0.0
+        box, offsets = _trim(out, (d_l0, d_h0, k0))
+        if box is None:
+            break
+    unfinished = box.sum() if box is not None else 0.0
+    return {"win": min(float(win), 1.0), "loss": min(float(loss), 1.0), "unfinished": float(unfinished),
+            "expected_turns": float(expected + unfinished * max_turns)}
+
+def win_odds(character, enemy, policy="attack", threshold=30):
+    # {"win", "loss", "unfinished", "expected_turns"} for auto_battle(policy, threshold) from here
+    return dict(_win_odds(policy, threshold, character.race, character.strength, character.constitution,
+                          character.current_health, character.base_health,
+                          character.potions if policy == "potion" else 0,
+                          enemy["race"], enemy["attack_min"], enemy["attack_max"], enemy["current_health"]))
+
+def battle_odds(character, enemy, threshold=30):
+    return {policy: win_odds(character, enemy, policy, threshold) for policy in AUTO_BATTLE_POLICIES}
+
+# -------------------------------
+# PvP Moves (shared by hotseat and online PvP)
+# -------------------------------
+# Applies one move to `defender` and returns the log line (None for an
+# unknown action). A defend only logs; callers track the defend flag.
+def pvp_action(attacker, defender, action, rng, defending=False):
+    if action == "attack":
+        base_damage = attacker.strength + rng.randint(1, 10)
+        # Apply type advantage multiplier
+        mult = type_multiplier(attacker, defender)
+        if defending:
+            base_damage //= 2
+        damage = int(base_damage * mult)
+        defender.current_health -= damage
+        return f"{attacker.race} attacked {defender.race} for {damage} damage!"
+    if action == "defend":
+        return f"{attacker.race} is defending this turn!"
+    if action == "ability":
+        log_text, ability_damage = use_ability(attacker, defender, rng)
+        defender.current_health -= ability_damage
+        return log_text
+    return None
+
+# -------------------------------
+# CPU Opponent (hotseat PvP against the computer)
+# -------------------------------
+# In a "vs CPU" hotseat match, player 2's moves come from an expectimax
+# search over the hotseat rules:
+#   - An attack deals int((strength + randint(1, 10)) * type multiplier), or
+#     half the base damage against a defending target.
+#   - An ability follows use_ability: its mana cost, damage and heal rolls,
+#     and its chance split. Ability damage ignores types and defends.
+#   - A defend sets the mover's flag, but play_hotseat_turn clears both flags
+#     when the turn passes, so in hotseat it never reaches an attack. The
+#     search still tries it; it simply never comes out ahead.
+# Each move's outcomes are tabulated once per matchup, then merged into at
+# most CPU_CHANCE_BRANCHES buckets of about equal probability, each standing
+# in at its mean damage and heal. Nodes past the search depth are scored by
+# who wins the race to zero HP at expected damage per turn, spending the
+# casts left of a mana-costed ability first.
+#
+# A position is just (side to move, both HPs, casts of a mana-costed ability
+# left), so the step is integer arithmetic on precomputed tables: no
+# Character, namespace or log line per node. Values go in a transposition
+# table keyed on the position packed into one int. Each matchup keeps its
+# table across moves and requests, LRU-evicted over CPU_SEARCH_CACHE_SIZE
+# matchups and cleared when it passes CPU_TABLE_SIZE positions.
+#
+# The difficulty sets the depth in plies. The search deepens one ply at a
+# time and plays the best move of the last depth that finished within
+# CPU_MOVE_BUDGET seconds. The 1-ply search at the start always finishes.
+# The search draws nothing from the fight's random stream, so replays of a
+# recorded match are unchanged.
+app.config['CPU_MOVE_BUDGET'] = 0.02
+app.config['CPU_CHANCE_BRANCHES'] = 4
+app.config['CPU_TABLE_SIZE'] = 200000
+CPU_SEARCH_CACHE_SIZE = 256
+CPU_DIFFICULTIES = {"easy": 1, "normal": 3, "hard": 7}  # plies
+CPU_ACTIONS = ("attack", "ability", "defend")
+CPU_DISCOUNT = 0.99  # a win now beats the same win later
+CPU_HEURISTIC_SCALE = 0.9  # keeps estimates below a certain win or loss
+
+class CpuOutOfTime(Exception):
+    pass
+
+def _outcome_buckets(outcomes, branches):
+    # {(damage, heal): probability} -> at most `branches` (probability,
+    # damage, heal) in order of damage plus heal, each an equal share of the
+    # probability mass (as near as the outcomes allow)
+    ordered = sorted(outcomes.items(), key=lambda item: item[0][0] + item[0][1])
+    buckets = []
+    seen = mass = damage = heal = 0.0
+    for i, ((d, h), p) in enumerate(ordered):
+        seen += p
+        mass += p
+        damage += d * p
+        heal += h * p
+        if seen >= (len(buckets) + 1) / branches - 1e-9 or i == len(ordered) - 1:
+            buckets.append((mass, round(damage / mass), round(heal / mass)))
+            mass = damage = heal = 0.0
+    return tuple(buckets)
+
+def _move_outcomes(attacker, defender, action, defending):
+    # {(damage to defender, heal to attacker): probability} for one move
+    if action == "attack":
+        mult = race_multiplier(attacker.race, defender.race)
+        outcomes = {}
+        for roll in range(1, 11):
+            base_damage = attacker.strength + roll
+            if defending:
+                base_damage //= 2
+            key = (int(base_damage * mult), 0)
+            outcomes[key] = outcomes.get(key, 0.0) + 0.1
+        return outcomes
+    if action == "defend":
+        return {(0, 0): 1.0}
+    effect = primary_ability(attacker.ability)[1]
+    strikes, mends = {(0, 0): 1.0}, {(0, 0): 1.0}
+    if effect.damage:
+        low, high = effect.damage
+        strikes = {}
+        for roll in range(low, high + 1):
+            key = ((attacker.strength + roll) * effect.scale, roll // effect.heal_div if effect.heal_div else 0)
+            strikes[key] = strikes.get(key, 0.0) + 1 / (high - low + 1)
+    if effect.heal:
+        low, high = effect.heal
+        mends = {(0, heal): 1 / (high - low + 1) for heal in range(low, high + 1)}
+    outcomes = {}
+    if effect.chance is not None:
+        for (damage, _), p in strikes.items():
+            outcomes[(damage, 0)] = outcomes.get((damage, 0), 0.0) + effect.chance * p
+        for (_, heal), p in mends.items():
+            outcomes[(0, heal)] = outcomes.get((0, heal), 0.0) + (1 - effect.chance) * p
+    else:
+        # The heal roll, when there is one, replaces the damage roll's heal
+        for (damage, strike_heal), p in strikes.items():
+            for (_, heal), q in mends.items():
+                key = (damage, heal if effect.heal else strike_heal)
+                outcomes[key] = outcomes.get(key, 0.0) + p * q
+    return outcomes
+
+class CpuRules:
+    # One matchup: per side, its base HP, ability mana cost, the bucketed
+    # outcomes of each action and the expected damage of an attack and of
+    # the ability for the heuristic
+    __slots__ = ("base_health", "mana_cost", "moves", "pace", "table")
+
+    def __init__(self, fighters, branches):
+        self.base_health = [fighter.base_health for fighter in fighters]
+        self.mana_cost = [primary_ability(fighter.ability)[1].mana_cost for fighter in fighters]
+        self.moves = [[], []]
+        self.pace = [{}, {}]
+        for side in (0, 1):
+            me, opponent = fighters[side], fighters[1 - side]
+            for action in CPU_ACTIONS:
+                outcomes = _move_outcomes(me, opponent, action, False)
+                self.moves[side].append((action, _outcome_buckets(outcomes, branches)))
+                self.pace[side][action] = sum(damage * p for (damage, _), p in outcomes.items())
+        self.table = {}
+
+    def casts(self, side, mana):
+        cost = self.mana_cost[side]
+        return mana // cost if cost else 0
+
+class CpuSearch:
+    # One move's search: shares the matchup's rules and table, keeps its own
+    # deadline and node count
+    __slots__ = ("rules", "deadline", "nodes", "limit")
+
+    def __init__(self, rules, deadline, limit):
+        self.rules = rules
+        self.deadline = deadline
+        self.nodes = 0
+        self.limit = limit
+
+    def turns_to_kill(self, side, health, casts):
+        attack, ability = self.rules.pace[side]["attack"], self.rules.pace[side]["ability"]
+        if ability > attack and self.rules.mana_cost[side]:
+            if casts * ability >= health:
+                return -(-health // ability)
+            casts_used, health = casts, health - casts * ability
         else:
-            heal = random.randint(5, 15)
-            attacker.current_health = min(attacker.base_health, attacker.current_health + heal)
-            log = f"{attacker.race} let loose {ability_text} and healed for {heal} HP!"
+            casts_used, attack = 0, max(attack, ability)
+        return casts_used + (-(-health // attack) if attack > 0 else 1 << 30)
+
+    def estimate(self, side, hp_me, hp_other, casts_me, casts_other):
+        # Who finishes the other first at expected damage; the side to move
+        # wins a tie
+        need = self.turns_to_kill(side, hp_other, casts_me)
+        their_need = self.turns_to_kill(1 - side, hp_me, casts_other)
+        return CPU_HEURISTIC_SCALE * (their_need - need + 0.5) / (their_need + need + 0.5)
+
+    def action_value(self, side, hp_me, hp_other, casts_me, casts_other, move, depth):
+        # Expected value of one move for the side making it; None if it can't be played
+        action, buckets = move
+        rules = self.rules
+        costed = rules.mana_cost[side]
+        if action == "ability" and costed and casts_me == 0:
+            return None  # it would fizzle: a defend, which is searched anyway
+        casts_after = casts_me - 1 if action == "ability" and costed else casts_me
+        cap = rules.base_health[side]
+        total = 0.0
+        for p, damage, heal in buckets:
+            left = hp_other - damage
+            if left <= 0:
+                total += p
+            else:
+                healed = hp_me + heal
+                total -= p * CPU_DISCOUNT * self.value(1 - side, left, healed if healed < cap else cap,
+                                                       casts_other, casts_after, depth - 1)
+        return total
+
+    def value(self, side, hp_me, hp_other, casts_me, casts_other, depth):
+        # Expectimax value for the side to move, in [-1, 1]
+        if depth == 0:
+            return self.estimate(side, hp_me, hp_other, casts_me, casts_other)
+        table = self.rules.table
+        key = (((((hp_me << 32 | hp_other) << 16 | casts_me) << 16 | casts_other) << 6 | depth) << 1) | side
+        known = table.get(key)
+        if known is not None:
+            return known
+        self.nodes += 1
+        if self.nodes & 63 == 0 and time.perf_counter() > self.deadline:
+            raise CpuOutOfTime()
+        best = -1.0
+        for move in self.rules.moves[side]:
+            value = self.action_value(side, hp_me, hp_other, casts_me, casts_other, move, depth)
+            if value is not None and value > best:
+                best = value
+        if len(table) >= self.limit:
+            table.clear()
+        table[key] = best
+        return best
+
+@lru_cache(maxsize=CPU_SEARCH_CACHE_SIZE)
+def cpu_rules(p1, p2, branches):
+    # p1/p2 are (race, ability, strength, base_health)
+    fighters = [SimpleNamespace(race=race, ability=ability, strength=strength, base_health=base_health)
+                for race, ability, strength, base_health in (p1, p2)]
+    return CpuRules(fighters, branches)
+
+cpu_stats = {"moves": 0, "timeouts": 0, "nodes": 0}
+_cpu_stats_lock = threading.Lock()
+
+def cpu_move(state, player1, player2, difficulty):
+    # The action for the player whose turn it is in a hotseat match
+    side = state["turn"] - 1
+    fighters = [player1, player2]
+    rules = cpu_rules(*[(f.race, f.ability, f.strength, f.base_health) for f in fighters],
+                      app.config['CPU_CHANCE_BRANCHES'])
+    me, other = fighters[side], fighters[1 - side]
+    position = (side, me.current_health, other.current_health,
+                rules.casts(side, me.mana), rules.casts(1 - side, other.mana))
+    search = CpuSearch(rules, time.perf_counter() + app.config['CPU_MOVE_BUDGET'], app.config['CPU_TABLE_SIZE'])
+    best, timed_out = "attack", False
+    for depth in range(1, CPU_DIFFICULTIES.get(difficulty, 1) + 1):
+        try:
+            values = [(search.action_value(*position, move, depth), move[0]) for move in rules.moves[side]]
+        except CpuOutOfTime:
+            timed_out = True
+            break
+        best_value = None
+        for value, action in values:  # ties keep the earlier action in CPU_ACTIONS
+            if value is not None and (best_value is None or value > best_value):
+                best_value, best = value, action
+        if best_value >= 1.0:
+            break  # a certain win this move
+    with _cpu_stats_lock:
+        cpu_stats["moves"] += 1
+        cpu_stats["timeouts"] += timed_out
+        cpu_stats["nodes"] += search.nodes
+    return best
+
+if metrics is not None:
+    metrics.register(CallbackMetric(
+        "rpg_cpu_search_events_total", "CPU opponent moves, searches cut short by the time budget and nodes "
+        "searched.", "counter", lambda: {(event,): count for event, count in cpu_stats.items()}, ("event",)))
+
+# -------------------------------
+# Online PvP (matchmaking across workers)
+# -------------------------------
+# The queue and the matches live in the shared database, so any worker can
+# serve either player. Joining probes the queue for the longest-waiting
+# opponent at the same level, then at +1, -1, +2 ... up to PVP_LEVEL_SPREAD.
+# Each probe is one DELETE ... RETURNING on the (level, queued_at) index, so
+# pairing costs the same however long the queue gets, and two workers can
+# never claim the same opponent. Players who find nobody are queued and
+# probe again on every poll.
+#
+# A match snapshots both fighters at full HP, so the duel never writes to
+# the players' characters. A turn is applied and answered straight away,
+# and pushed to the opponent over the match's event stream. A defend halves
+# the next attack against you. The version column turns a concurrent stale
+# write into a 409 instead of a lost update.
+class PvpQueue(db.Model):
+    __tablename__ = "pvp_queue"
+    character_id = db.Column(db.Integer, db.ForeignKey("character.id"), primary_key=True)
+    level = db.Column(db.Integer, nullable=False)
+    queued_at = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.Index("ix_pvp_queue_level_queued_at", "level", "queued_at"),)
+
+class PvpMatch(db.Model):
+    __tablename__ = "pvp_match"
+    id = db.Column(db.Integer, primary_key=True)
+    p1_id = db.Column(db.Integer, nullable=False, index=True)
+    p2_id = db.Column(db.Integer, nullable=False, index=True)
+    fighters = db.Column(db.JSON, nullable=False)  # [p1, p2] snapshots with HP, mana and defend flag
+    log = db.Column(db.JSON, nullable=False)
+    turn = db.Column(db.Integer, nullable=False, default=1)  # side to move: 1 or 2
+    turns = db.Column(db.Integer, nullable=False, default=0)
+    winner = db.Column(db.Integer)  # side that won, once finished
+    updated_at = db.Column(db.Float, nullable=False, index=True)
+    log_total = db.Column(db.Integer, nullable=False, default=0)  # lines ever logged; `log` keeps the tail
+    fight = db.Column(db.JSON)  # seed, stream position, starting fighters and moves (see Battle Records)
+    version = db.Column(db.Integer, nullable=False)
+    __mapper_args__ = {"version_id_col": version}
+
+app.config['PVP_LEVEL_SPREAD'] = 2
+app.config['PVP_QUEUE_TIMEOUT'] = 30  # seconds without a poll before a queued player is skipped
+app.config['PVP_TURN_TIMEOUT'] = 120  # seconds before an idle opponent forfeits
+app.config['PVP_ONLINE_LOG_LIMIT'] = 20
+app.config['PVP_POLL_MS'] = 1000  # how often the page polls the queue
+app.config['PVP_STREAM_CHECK'] = 0.5  # seconds between match checks on an event stream
+app.config['PVP_STREAM_KEEPALIVE'] = 15
+app.config['PVP_STREAM_MAX'] = 300  # seconds before a stream ends; the browser reconnects
+PVP_ACTIONS = ["attack", "defend", "ability", "forfeit"]
+FIGHTER_FIELDS = ["id", "race", "ability", "level", "strength", "intelligence", "wisdom",
+                  "constitution", "speed", "base_health", "mana"]
+
+def fighter_snapshot(character):
+    fighter = {field: getattr(character, field) for field in FIGHTER_FIELDS}
+    fighter.update(current_health=character.base_health, defending=False)
+    return fighter
+
+def find_pvp_match(character_id):
+    # The player's unfinished match, if any
+    return db.session.scalar(
+        db.select(PvpMatch)
+        .where(db.or_(PvpMatch.p1_id == character_id, PvpMatch.p2_id == character_id), PvpMatch.winner.is_(None))
+        .order_by(PvpMatch.id.desc()).limit(1))
+
+def _pvp_levels(level):
+    levels = [level]
+    for spread in range(1, app.config['PVP_LEVEL_SPREAD'] + 1):
+        levels += [level + spread, level - spread]
+    return levels
+
+def join_pvp_queue(character):
+    # Returns the player's match, pairing them now if an opponent is waiting;
+    # otherwise (re)queues them and returns None.
+    match = find_pvp_match(character.id)
+    if match is not None:
+        return match
+    now = time.time()
+    timeout = app.config['PVP_QUEUE_TIMEOUT']
+    levels = _pvp_levels(character.level)
+    # Polls with nobody to pair stay read-only (no write lock) while our
+    # queue row is fresh
+    queued_at = db.session.scalar(db.select(PvpQueue.queued_at).where(PvpQueue.character_id == character.id))
+    waiting = db.session.scalar(db.select(PvpQueue.character_id).where(
+        PvpQueue.level.in_(levels), PvpQueue.queued_at > now - timeout,
+        PvpQueue.character_id != character.id).limit(1))
+    if waiting is None and queued_at is not None and queued_at > now - timeout / 2:
+        return None
+    # Taking our own queue row first means a concurrent pairing has either
+    # committed its match (found below) or will no longer find us.
+    db.session.execute(db.delete(PvpQueue).where(PvpQueue.character_id == character.id))
+    match = find_pvp_match(character.id)
+    if match is not None:
+        return match
+    for level in levels:
+        oldest = (db.select(PvpQueue.character_id)
+                  .where(PvpQueue.level == level, PvpQueue.queued_at > now - timeout)
+                  .order_by(PvpQueue.queued_at).limit(1).scalar_subquery())
+        opponent_id = db.session.scalar(
+            db.delete(PvpQueue).where(PvpQueue.character_id == oldest).returning(PvpQueue.character_id))
+        opponent = db.session.get(Character, opponent_id) if opponent_id else None
+        if opponent is None:
+            continue
+        fighters = [fighter_snapshot(opponent), fighter_snapshot(character)]
+        match = PvpMatch(p1_id=opponent.id, p2_id=character.id, turn=1, turns=0, updated_at=now,
+                         fighters=fighters, fight=start_fight(fighters=fighters),
+                         log=[f"{opponent.race} (level {opponent.level}) vs {character.race} (level {character.level})!"],
+                         log_total=1)
+        db.session.add(match)
+        db.session.flush()  # assigns match.id
+        return match
+    db.session.add(PvpQueue(character_id=character.id, level=character.level, queued_at=now))
+    return None
+
+def leave_pvp_queue(character):
+    db.session.execute(db.delete(PvpQueue).where(PvpQueue.character_id == character.id))
+
+def _finish_pvp_match(match, fighters, lines, winner=None):
+    match.fighters = fighters
+    match.log_total = (match.log_total or len(match.log)) + len(lines)
+    match.log = (match.log + lines)[-app.config['PVP_ONLINE_LOG_LIMIT']:]
+    match.winner = winner
+    match.updated_at = time.time()
+
+def _record_pvp_move(match, side, action, lines, rng=None):
+    fight = dict(match.fight or start_fight(fighters=match.fighters))
+    fight["actions"] = fight["actions"] + [[side, action]]
+    fight["log"] = chain_log_digest(fight["log"], lines)
+    if rng is not None:
+        park_stream(fight, rng)
+    match.fight = fight
+
+def play_pvp_online_turn(match, side, action):
+    # Applies `side`'s move; returns an error message if it can't be played
+    if match.winner:
+        return "The match is over."
+    fighters = [dict(fighter) for fighter in match.fighters]
+    me, opponent = fighters[side - 1], fighters[2 - side]
+    if action == "forfeit":
+        lines = [f"{me['race']} forfeits! {opponent['race']} wins!"]
+        _record_pvp_move(match, side, action, lines)
+        _finish_pvp_match(match, fighters, lines, winner=3 - side)
+        return None
+    if match.turn != side:
+        return "It's not your turn."
+    me["defending"] = False  # a defend lasts until your own next move
+    attacker, defender = SimpleNamespace(**me), SimpleNamespace(**opponent)
+    rng = fight_stream(match.fight or start_fight(fighters=match.fighters))
+    lines = [pvp_action(attacker, defender, action, rng, opponent["defending"])]
+    me.update(vars(attacker))
+    opponent.update(vars(defender))
+    if action == "defend":
+        me["defending"] = True
+    match.turns += 1
+    if opponent["current_health"] <= 0:
+        lines.append(f"{opponent['race']} has been defeated! {me['race']} wins!")
+    _record_pvp_move(match, side, action, lines, rng)
+    if opponent["current_health"] <= 0:
+        _finish_pvp_match(match, fighters, lines, winner=side)
     else:
-        damage = attacker.strength + random.randint(1, 10)
-        log = f"{attacker.race} performed a basic attack for {damage} damage."
-    return log, damage
+        match.turn = 3 - side
+        _finish_pvp_match(match, fighters, lines)
+    return None
+
+def pvp_timeout_win(match, side):
+    opponent, me = match.fighters[2 - side], match.fighters[side - 1]
+    lines = [f"{opponent['race']} ran out of time! {me['race']} wins!"]
+    _record_pvp_move(match, side, "timeout", lines)
+    _finish_pvp_match(match, match.fighters, lines, winner=side)
+
+def claim_pvp_timeout(match, side):
+    # The waiting player wins once the opponent has let PVP_TURN_TIMEOUT pass;
+    # returns whether it did
+    if not match.winner and match.turn != side and time.time() - match.updated_at > app.config['PVP_TURN_TIMEOUT']:
+        pvp_timeout_win(match, side)
+        return True
+    return False
+
+def pvp_match_state(match, side):
+    return {
+        "match_id": match.id,
+        "side": side,
+        "turn": match.turn,
+        "your_turn": not match.winner and match.turn == side,
+        "turns": match.turns,
+        "result": None if not match.winner else ("won" if match.winner == side else "lost"),
+        "fighters": [{key: fighter[key] for key in ["race", "level", "current_health", "base_health", "mana", "defending"]}
+                     for fighter in match.fighters],
+        "log": match.log,
+        "log_total": match.log_total or len(match.log),
+    }
+
+# -------------------------------
+# Online PvP Event Stream (Server-Sent Events)
+# -------------------------------
+# Each player keeps one text/event-stream open per match instead of polling.
+# The stream re-reads the match row (a primary-key lookup on a short-lived
+# connection, so an idle stream holds no session or lock) every
+# PVP_STREAM_CHECK seconds, or at once when a move is committed in this
+# process, and sends an event only when the version has changed: the new HP,
+# turn and result, typed damage/heal/defeat events and just the new log lines.
+# The event id is the match version, so a reconnecting browser (Last-Event-ID)
+# is not sent a turn it has already seen.
+#
+# Under the WSGI server each open stream is a generator on a request thread
+# (pvp_match_stream). The ASGI front end drives the same PvpMatchStream from
+# its event loop instead, where a waiting viewer is only a coroutine: it
+# registers in pvp_watchers and is handed the id of every match that moves.
+pvp_changed = threading.Condition()
+pvp_watchers = []  # callables given the id of each match a request has moved
+
+@app.teardown_request
+def wake_pvp_streams(exc):
+    match_id = g.pop("pvp_moved", None)
+    if match_id is not None and exc is None:
+        with pvp_changed:
+            pvp_changed.notify_all()
+        for watcher in pvp_watchers:
+            watcher(match_id)
+
+def pvp_stream_event(row, side, previous, sent_total):
+    state = pvp_match_state(row, side)
+    log, total = state.pop("log"), state["log_total"]
+    state["lines"] = log if sent_total is None else log[len(log) - min(len(log), total - sent_total):]
+    state["events"] = [] if previous is None else hp_events(
+        ["p1", "p2"], [f["current_health"] for f in previous], [f["current_health"] for f in row.fighters])
+    return f"id: {row.version}\nevent: turn\ndata: {json.dumps(state, separators=(',', ':'))}\n\n"
+
+class PvpMatchStream:
+    # What one viewer of a match has been sent so far
+    def __init__(self, engine, match_id, side, last_version, settings):
+        self.engine, self.match_id, self.side = engine, match_id, side
+        self.check, self.keepalive, self.lifetime = settings
+        self.sent_version, self.sent_total, self.previous = last_version, None, None
+        self.started = self.last_sent = time.monotonic()
+        self.done = False
+
+    def opening(self):
+        return f"retry: {int(self.check * 2000)}\n\n"
+
+    def live(self):
+        return not self.done and time.monotonic() - self.started < self.lifetime
+
+    def read(self):
+        # Blocking; the ASGI front end calls it on a pool thread
+        table = PvpMatch.__table__
+        with self.engine.connect() as conn:
+            return conn.execute(db.select(table).where(table.c.id == self.match_id)).first()
+
+    def update(self, row):
+        # The next chunk to send for a freshly read row, if any
+        if row is None:
+            self.done = True
+            return None
+        self.done = bool(row.winner)
+        if row.version != self.sent_version:
+            chunk = pvp_stream_event(row, self.side, self.previous, self.sent_total)
+            self.sent_version, self.sent_total, self.previous = row.version, row.log_total or len(row.log), row.fighters
+        elif time.monotonic() - self.last_sent >= self.keepalive:
+            chunk = ": keep-alive\n\n"
+        else:
+            return None
+        self.last_sent = time.monotonic()
+        return chunk
+
+def pvp_match_stream(watch):
+    yield watch.opening()
+    while watch.live():
+        chunk = watch.update(watch.read())
+        if chunk:
+            yield chunk
+        if watch.done:
+            return
+        with pvp_changed:
+            pvp_changed.wait(watch.check)
+
+# -------------------------------
+# Battle Records (seeded fights and replay)
+# -------------------------------
+# Every fight draws from its own RNG stream (rng.py) with a fresh seed: one
+# per PvE enemy, one per hotseat or online PvP match. The fight keeps its
+# seed and stream position, the fighters as they were when it started, the
+# actions played and a running digest of its log. PvE also notes changes
+# made to the character between turns (shopping mid-fight). A fight that
+# ends is written to battle_record along with its final state, and
+# `flask replay-battle ID` re-runs it from the seed and checks that it ends
+# the same, bit for bit.
+class BattleRecord(db.Model):
+    __tablename__ = "battle_record"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)  # "pve", "hotseat" or "pvp"
+    character_id = db.Column(db.Integer, index=True)  # the PvE player, or PvP player 1
+    seed = db.Column(db.Integer, nullable=False)
+    start = db.Column(db.JSON, nullable=False)
+    actions = db.Column(db.JSON, nullable=False)
+    result = db.Column(db.JSON, nullable=False)  # final fighters, log digest and values drawn
+    finished_at = db.Column(db.Float, nullable=False, index=True)
+
+app.config['BATTLE_RECORD_TTL'] = 7 * 24 * 3600  # reaped after a week
+battle_streams = StreamCache()
+SNAPSHOT_COLUMNS = [column.key for column in Character.__table__.columns
+                    if column.key not in ("id", "last_seen", "version")]
+
+def character_snapshot(character):
+    return {column: getattr(character, column) for column in SNAPSHOT_COLUMNS}
+
+def character_from_snapshot(snapshot):
+    # Transient (never added to the session)
+    character = Character(seed=snapshot["seed"])
+    for column, value in snapshot.items():
+        setattr(character, column, value)
+    return character
+
+def start_fight(**start):
+    return {"seed": new_seed(), "drawn": 0, "start": start, "actions": [], "log": ""}
+
+def fight_stream(fight):
+    return battle_streams.resume([fight["seed"], 0, fight["drawn"]])
+
+def park_stream(fight, rng):
+    fight["drawn"] = rng.drawn
+    battle_streams.park(rng)
+
+def chain_log_digest(digest, lines):
+    return hashlib.sha256("\n".join([digest] + lines).encode()).hexdigest()
+
+def note_character_changes(fight, character):
+    # Records columns changed outside the fight since its last action
+    expected = fight.get("last") or fight["start"]["character"]
+    changes = {column: value for column, value in character_snapshot(character).items()
+               if expected.get(column) != value}
+    if changes:
+        fight["actions"].append({"set": changes})
+
+def record_fight(kind, character_id, fight, result):
+    result = dict(result, log=fight["log"], drawn=fight["drawn"])
+    db.session.add(BattleRecord(kind=kind, character_id=character_id, seed=fight["seed"], start=fight["start"],
+                                actions=fight["actions"], result=result, finished_at=time.time()))
+
+def replay_fight(record):
+    # Re-runs a recorded fight from its seed; returns (log lines, result)
+    log = []
+    if record.kind == "pvp":
+        # Online moves resume the match's stream from its fight, as they do live
+        match = SimpleNamespace(fighters=record.start["fighters"], log=[], log_total=0, turn=1, turns=0,
+                                winner=None, updated_at=0)
+        match.fight = {"seed": record.seed, "drawn": 0, "start": record.start, "actions": [], "log": ""}
+        for side, action in record.actions:
+            before = match.log_total
+            if action == "timeout":
+                pvp_timeout_win(match, side)
+            else:
+                play_pvp_online_turn(match, side, action)
+            log += match.log[len(match.log) - (match.log_total - before):]
+        result = {"winner": match.winner, "fighters": match.fighters}
+        return log, dict(result, log=match.fight["log"], drawn=match.fight["drawn"])
+    rng = RngStream(record.seed)
+    digest = ""
+    if record.kind == "pve":
+        character = character_from_snapshot(record.start["character"])
+        enemy = unpack_enemy(record.start["enemy"])
+        outcome = None
+        for params in record.actions:
+            if "set" in params:
+                for column, value in params["set"].items():
+                    setattr(character, column, value)
+                continue
+            turn = resolve_battle_action(character, enemy, params, rng)
+            lines, outcome = turn["log"], turn["outcome"]
+            log += lines
+            digest = chain_log_digest(digest, lines)
+        result = {"outcome": outcome, "character": character_snapshot(character),
+                  "enemy_hp": enemy["current_health"]}
+    else:
+        player1 = character_from_snapshot(record.start["p1"])
+        player2 = character_from_snapshot(record.start["p2"])
+        state = {"turn": 1, "p1_defend": False, "p2_defend": False}
+        for action in record.actions:
+            lines, _ = play_hotseat_turn(state, player1, player2, action, rng)
+            log += lines
+            digest = chain_log_digest(digest, lines)
+        result = {"p1": character_snapshot(player1), "p2": character_snapshot(player2)}
+    return log, dict(result, log=digest, drawn=rng.drawn)
+
+@app.cli.command("replay-battle")
+@click.argument("record_id", type=int)
+@click.option("--log/--no-log", "show_log", default=True, help="Print the replayed battle log.")
+def replay_battle_command(record_id, show_log):
+    """Re-run a recorded battle from its seed and compare the outcome."""
+    record = db.session.get(BattleRecord, record_id)
+    if record is None:
+        raise click.ClickException(f"No battle record {record_id}.")
+    log, result = replay_fight(record)
+    if show_log:
+        for line in log:
+            click.echo(line)
+    mismatched = sorted(key for key in record.result if result.get(key) != record.result[key])
+    if mismatched:
+        raise click.ClickException(f"Replay of {record.kind} battle {record_id} differs in: {', '.join(mismatched)}.")
+    click.echo(f"Replay of {record.kind} battle {record_id} matches: {len(record.actions)} actions, "
+               f"{result['drawn']} random values drawn (seed {record.seed}).")
+
+# -------------------------------
+# Battle Events (append-only history)
+# -------------------------------
+# Every PvE action and PvP move appends rows to battle_event, which is never
+# updated: a "turn" row per action (damage dealt, HP lost - negative when a
+# heal outweighs the hit - and the ability used), plus "reward", "level_up",
+# "evolve", "death", "win" and "loss" rows when a fight ends. Rows carry the
+# fight's seed, so they line up with its battle_record.
+#
+# Requests only collect their rows in `g`. A request that succeeds hands them
+# to an in-process buffer, and a background thread writes the buffer with
+# one executemany INSERT per BATTLE_EVENT_BATCH rows every
+# BATTLE_EVENT_FLUSH_INTERVAL seconds (sooner once a batch is full), on its
+# own short transaction. At most one flush interval of events is lost if
+# the process dies; past BATTLE_EVENT_MAX_PENDING unwritten rows the oldest
+# are dropped (counted in the metrics) rather than holding requests up.
+class BattleEvent(db.Model):
+    __tablename__ = "battle_event"
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.Float, nullable=False, index=True)
+    character_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(16), nullable=False)  # "pve", "hotseat" or "pvp"
+    seed = db.Column(db.Integer, index=True)  # the fight's seed
+    turn = db.Column(db.Integer, nullable=False)  # actions played in the fight so far
+    type = db.Column(db.String(16), nullable=False)
+    action = db.Column(db.String(16))
+    damage = db.Column(db.Integer, nullable=False, default=0)
+    taken = db.Column(db.Integer, nullable=False, default=0)
+    detail = db.Column(db.JSON)
+    __table_args__ = (db.Index("ix_battle_event_character_time", "character_id", "created_at"),)
+
+app.config['BATTLE_EVENTS'] = os.environ.get("BATTLE_EVENTS", "1") == "1"
+app.config['BATTLE_EVENT_BATCH'] = 500
+app.config['BATTLE_EVENT_FLUSH_INTERVAL'] = 1
+app.config['BATTLE_EVENT_MAX_PENDING'] = 100000
+app.config['BATTLE_EVENT_TTL'] = 90 * 24 * 3600  # reaped after 90 days
+
+class BattleEventLog:
+    def __init__(self, batch_size=500, flush_interval=1, max_pending=100000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = deque(maxlen=max_pending)
+        self.stats = dict.fromkeys(["appended", "written", "batches", "dropped"], 0)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, rows):
+        with self._lock:
+            overflow = len(self.pending) + len(rows) - self.pending.maxlen
+            if overflow > 0:
+                self.stats["dropped"] += overflow
+            self.pending.extend(rows)
+            self.stats["appended"] += len(rows)
+            full = len(self.pending) >= self.batch_size
+        if self._thread is None and self.flush_interval:
+            self.start()
+        if not self.flush_interval:
+            self.flush()  # no flusher thread: write with the request
+        elif full:
+            self._wake.set()
+
+    def flush(self):
+        # Writes everything pending; returns the number of rows written
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+                if not batch:
+                    return written
+                try:
+                    with db.engine.begin() as conn:
+                        conn.execute(BattleEvent.__table__.insert(), batch)
+                except Exception:
+                    with self._lock:
+                        self.pending.extendleft(reversed(batch))  # retried on the next flush
+                    raise
+                written += len(batch)
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+
+    def start(self):
+        if self._thread is None and self.flush_interval:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="battle-events", daemon=True)
+                    self._thread.start()
+                    atexit.register(self._flush_in_app_context)
+
+    def _flush_in_app_context(self):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Battle event flush failed")
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._flush_in_app_context()
+
+battle_events = (BattleEventLog(app.config['BATTLE_EVENT_BATCH'], app.config['BATTLE_EVENT_FLUSH_INTERVAL'],
+                                app.config['BATTLE_EVENT_MAX_PENDING'])
+                 if app.config['BATTLE_EVENTS'] else None)
+
+def battle_event(character_id, kind, fight, type, action=None, damage=0, taken=0, **detail):
+    # Queues one row with the current request (dropped if the request fails)
+    if battle_events is None or not has_request_context():
+        return
+    g.setdefault("battle_events", []).append({
+        "created_at": time.time(), "character_id": character_id, "kind": kind,
+        "seed": fight.get("seed") if fight else None, "turn": len(fight["actions"]) if fight else 0,
+        "type": type, "action": action, "damage": damage, "taken": taken,
+        "detail": {key: value for key, value in detail.items() if value is not None} or None,
+    })
+
+def fight_end_events(kind, fight, winner_id, loser_id, loser_health, reason=None):
+    battle_event(winner_id, kind, fight, "win", opponent=loser_id, reason=reason)
+    battle_event(loser_id, kind, fight, "death" if loser_health <= 0 else "loss", opponent=winner_id, reason=reason)
+
+@app.after_request
+def keep_battle_events(response):
+    # Runs before commit_unit_of_work; rows of failed requests are discarded
+    if response.status_code >= 400:
+        g.pop("battle_events", None)
+    return response
+
+@app.teardown_request
+def queue_battle_events(exc):
+    rows = g.pop("battle_events", None)
+    if rows and exc is None:
+        battle_events.add(rows)
+
+@app.cli.command("battle-events")
+@click.option("--character", "character_id", type=int, help="Only this character's events.")
+@click.option("--seed", type=int, help="Only the events of the fight with this seed.")
+@click.option("--hours", type=float, default=24, show_default=True, help="How far back to look.")
+@click.option("--limit", type=int, default=100, show_default=True)
+def battle_events_command(character_id, seed, hours, limit):
+    """Print recent battle events, oldest first."""
+    if battle_events is not None:
+        battle_events.flush()
+    query = db.select(BattleEvent).where(BattleEvent.created_at >= time.time() - hours * 3600)
+    if character_id is not None:
+        query = query.where(BattleEvent.character_id == character_id)
+    if seed is not None:
+        query = query.where(BattleEvent.seed == seed)
+    rows = db.session.scalars(query.order_by(BattleEvent.created_at.desc(), BattleEvent.id.desc()).limit(limit)).all()
+    for row in reversed(rows):
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row.created_at))
+        click.echo(f"{when} {row.kind} seed={row.seed} turn={row.turn} character={row.character_id} {row.type}"
+                   f"{' ' + row.action if row.action else ''} damage={row.damage} taken={row.taken}"
+                   f"{' ' + json.dumps(row.detail) if row.detail else ''}")
+
+if metrics is not None and battle_events is not None:
+    metrics.register(CallbackMetric(
+        "rpg_battle_events_total", "Battle events appended, written, batched and dropped.", "counter",
+        lambda: {(event,): count for event, count in battle_events.stats.items()}, ("event",)))
+    metrics.register(CallbackMetric(
+        "rpg_battle_events_pending", "Battle events waiting for the next batch insert.", "gauge",
+        lambda: {(): len(battle_events.pending)}))
+
+# -------------------------------
+# Tournaments (results written by tournament.py)
+# -------------------------------
+# `python tournament.py` plays round-robin or Swiss brackets between stored
+# characters under the online PvP rules, spread over worker processes, and
+# stores each run in one transaction: a tournament row, the final standings
+# and every match. A match is played from the tournament's seed on its own
+# stream (its number), so re-running with the same seed and roster gives
+# the same results however the matches were split between workers.
+class Tournament(db.Model):
+    __tablename__ = "tournament"
+    id = db.Column(db.Integer, primary_key=True)
+    format = db.Column(db.String(16), nullable=False)  # "round-robin" or "swiss"
+    seed = db.Column(db.Integer, nullable=False)
+    settings = db.Column(db.JSON, nullable=False)
+    participants = db.Column(db.Integer, nullable=False)
+    matches = db.Column(db.Integer, nullable=False)
+    started_at = db.Column(db.Float, nullable=False)
+    finished_at = db.Column(db.Float, nullable=False, index=True)
+
+class TournamentEntry(db.Model):
+    __tablename__ = "tournament_entry"
+    tournament_id = db.Column(db.Integer, db.ForeignKey("tournament.id"), primary_key=True)
+    character_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, nullable=False)
+    points = db.Column(db.Float, nullable=False)  # 1 per win or bye, 1/2 per draw
+    wins = db.Column(db.Integer, nullable=False)
+    losses = db.Column(db.Integer, nullable=False)
+    draws = db.Column(db.Integer, nullable=False)
+    tiebreak = db.Column(db.Float, nullable=False)  # opponents' points (Buchholz)
+    __table_args__ = (db.Index("ix_tournament_entry_character", "character_id"),)
+
+class TournamentMatch(db.Model):
+    __tablename__ = "tournament_match"
+    tournament_id = db.Column(db.Integer, db.ForeignKey("tournament.id"), primary_key=True)
+    number = db.Column(db.Integer, primary_key=True)  # also the match's RNG stream
+    round = db.Column(db.Integer, nullable=False)
+    p1_id = db.Column(db.Integer, nullable=False)
+    p2_id = db.Column(db.Integer, nullable=False)
+    winner = db.Column(db.Integer, nullable=False)  # 1 or 2, 0 for a draw
+    turns = db.Column(db.Integer, nullable=False)
+
+# -------------------------------
+# Template Fragments (cached HTML)
+# -------------------------------
+# The character sheet is rendered from the macros in _fragments.html and the
+# HTML is kept: a race panel per race, an ability card per ability column,
+# and whole sheets per sheet version - the tuple of every value the sheet
+# shows. Any change to a displayed column (written to the database or still
+# pending in the write-behind cache) is a new version, so an unchanged
+# character's sheet is one dictionary hit. Entries are LRU-evicted past
+# FRAGMENT_CACHE_SIZE.
+app.config['FRAGMENT_CACHE_SIZE'] = 2048
+app.config['TEMPLATE_WARMUP'] = os.environ.get("TEMPLATE_WARMUP", "1") == "1"
+SHEET_COLUMNS = ("race", "level", "exp", "strength", "intelligence", "wisdom", "constitution", "speed",
+                 "mana", "potions", "gold", "ability")
+
+class FragmentCache:
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.stats = dict.fromkeys(["hits", "misses"], 0)
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        with self._lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return html
+            self.stats["misses"] += 1
+        html = Markup(render())
+        with self._lock:
+            self.entries[key] = html
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return html
+
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+def _fragments():
+    return app.jinja_env.get_template("_fragments.html").module
+
+def race_panel(race):
+    return fragment_cache.get(("race", race), lambda: _fragments().race_panel(race))
+
+def ability_panel(ability):
+    return fragment_cache.get(("ability", ability),
+                              lambda: _fragments().ability_panel(ability, ABILITY_DESCRIPTIONS))
+
+def sheet_version(character):
+    return tuple(getattr(character, column) for column in SHEET_COLUMNS)
+
+def character_sheet(character):
+    return fragment_cache.get(("sheet",) + sheet_version(character), lambda: _fragments().character_sheet(
+        character, race_panel(character.race), ability_panel(character.ability)))
+
+app.jinja_env.globals["character_sheet"] = character_sheet
+
+# Compiles every template up front, so no request pays for parsing one
+def warm_templates():
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    _fragments()  # builds the macro module
+    return names
+
+if metrics is not None:
+    metrics.register(CallbackMetric(
+        "rpg_fragment_cache_events_total", "Template fragment cache hits and misses.", "counter",
+        lambda: {(event,): count for event, count in fragment_cache.stats.items()}, ("event",)))
 
 # -------------------------------
 # Routes
 # -------------------------------
 
+# Loads the session's character and records that it is still in use
+def get_character(char_id):
+    if not char_id:
+        return None
+    if character_cache is not None:
+        character = character_cache.get(char_id)
+    else:
+        character = db.session.get(Character, char_id)
+    if character is not None:
+        character.touch()
+    return character
+
 # Dice Roll Route (animation before character creation)
 @app.route("/roll")
 def roll_dice():
     # Create a new character if not already in session or if the stored character cannot be found.
     char_id = session.get("char_id")
-    character = None
-    if char_id:
-        character = Character.query.get(char_id)
+    character = get_character(char_id)
     if character is None:
-        # Create a new character and store its ID in the session.
-        character = Character()
-        db.session.add(character)
-        db.session.commit()
+        # Claim a pre-rolled character and store its ID in the session.
+        character = claim_character()
         session["char_id"] = character.id
     return render_template("dice.html")
 
@@ -471,206 +2970,673 @@ def roll_dice():
 @app.route("/")
 def index():
     char_id = session.get("char_id")
-    character = None
-    if char_id:
-        character = Character.query.get(char_id)
+    character = get_character(char_id)
     if character is None:
         # If no valid character exists, redirect to the dice roll so one is created.
         return redirect(url_for("roll_dice"))
-    return render_template("index.html", character=character, ability_descriptions=ABILITY_DESCRIPTIONS)
+    return render_template("index.html", character=character)
+
+
+
+
+# Battle log page for the current request (?page=1 is the most recent lines)
+def load_log_page(battle_id):
+    page = request.args.get("page", 1, type=int)
+    return battle_store.log_page(battle_id, page, app.config['BATTLE_LOG_PAGE_SIZE'])
+
+# Server-side PvE state for the session (or the given battle ID), with an
+# enemy ready to fight. state["enemy"] holds the packed enemy (reference +
+# current HP).
+def load_battle_state(character, battle_id=None):
+    if battle_id is None:
+        battle_id = session.get("battle_id")
+        state = battle_store.get(battle_id) if battle_id else None
+        if state is None:
+            state = {"enemy": None}
+            battle_id = battle_store.create(state)
+            session["battle_id"] = battle_id
+    else:
+        state = battle_store.get(battle_id) or {"enemy": None}
+    if state["enemy"] is None:
+        state["enemy"] = pack_enemy(enemy_from_ref(enemy_pool.take(character.level)))
+        state["fight"] = start_fight(character=character_snapshot(character), enemy=state["enemy"])
+        battle_store.save(battle_id, state)
+    return battle_id, state, unpack_enemy(state["enemy"])
+
+# -------------------------------
+# Turn Events (JSON updates for the battle pages)
+# -------------------------------
+# A turn is sent back as a few hundred bytes: typed events, the new log
+# lines and the numbers the page shows, instead of a re-rendered page.
+def hp_events(targets, before, after):
+    events = []
+    for target, old, new in zip(targets, before, after):
+        if new < old:
+            events.append({"type": "damage", "target": target, "amount": old - new})
+        elif new > old:
+            events.append({"type": "heal", "target": target, "amount": new - old})
+        if new <= 0 < old:
+            events.append({"type": "defeat", "target": target})
+    return events
+
+def fighter_view(fighter, keys=("race", "level", "current_health", "base_health")):
+    get = fighter.get if isinstance(fighter, dict) else lambda key: getattr(fighter, key)
+    return {key: get(key) for key in keys}
+
+def battle_update(character, battle_id, enemy, before, lines, outcome):
+    old_health, old_enemy_health, old_level, old_race = before
+    events = hp_events(["you", "enemy"], [old_health, old_enemy_health],
+                       [character.current_health, enemy["current_health"]])
+    if character.level > old_level:
+        # Level-ups heal fully; report the level-up rather than a heal
+        events = [e for e in events if not (e["type"] == "heal" and e["target"] == "you")]
+        events.append({"type": "level_up", "level": character.level})
+    if character.race != old_race:
+        events.append({"type": "evolve", "race": character.race})
+    update = {
+        "outcome": outcome, "events": events, "lines": lines,
+        "you": fighter_view(character, ("race", "level", "exp", "current_health", "base_health", "potions", "gold")),
+        "enemy": fighter_view(enemy),
+        "messages": take_notices(),
+    }
+    if outcome == "won":
+        update["next_enemy"] = fighter_view(load_battle_state(character, battle_id)[2])
+    return update
 
+# A posted action ("attack", "defend", "use_potion" or "auto" with
+# "policy"/"threshold") as it is recorded for replay
+def battle_action_params(params):
+    action = params.get("action")
+    if action != "auto":
+        return {"action": action}
+    policy = params.get("policy", "attack")
+    try:
+        threshold = int(params.get("threshold", 30))
+    except (TypeError, ValueError):
+        threshold = 30
+    return {"action": "auto", "policy": policy if policy in AUTO_BATTLE_POLICIES else "attack",
+            "threshold": threshold}
 
+# Returns a result dict with "log" and "outcome" (auto-battles add their summary)
+def resolve_battle_action(character, enemy, params, rng):
+    if params["action"] == "auto":
+        return auto_battle(character, enemy, rng, params["policy"], params["threshold"])
+    lines, outcome = play_turn(character, enemy, params["action"], rng)
+    return {"log": lines, "outcome": outcome}
 
+# Plays one posted action on the fight's stream and saves the battle; a fight
+# that ends is recorded. Returns the result of resolve_battle_action.
+def play_battle_action(character, battle_id, state, enemy, params):
+    params = battle_action_params(params)
+    fight = state.get("fight")
+    if fight is None:  # battle from before fights were recorded
+        fight = state["fight"] = start_fight(character=character_snapshot(character), enemy=pack_enemy(enemy))
+    note_character_changes(fight, character)
+    before = (character.current_health, enemy["current_health"], character.potions,
+              character.level, character.race, character.exp, character.gold)
+    rng = fight_stream(fight)
+    result = resolve_battle_action(character, enemy, params, rng)
+    battle_log, outcome = result["log"], result["outcome"]
+    fight["actions"].append(params)
+    fight["log"] = chain_log_digest(fight["log"], battle_log)
+    fight["last"] = character_snapshot(character)
+    park_stream(fight, rng)
+    pve_events(character, enemy, fight, params, result, before)
+    if outcome in ("won", "lost"):
+        record_fight("pve", character.id, fight, {"outcome": outcome, "character": fight["last"],
+                                                  "enemy_hp": enemy["current_health"]})
+        write_through(character)
+    state["enemy"] = None if outcome == "won" else pack_enemy(enemy)
+    commit_characters()
+    battle_store.update(battle_id, state, battle_log)
+    return result
+
+# Battle events for one PvE action (see battle_event)
+def pve_events(character, enemy, fight, params, result, before):
+    health, enemy_health, potions, level, race, exp, gold = before
+    detail = {"enemy": enemy["race"], "enemy_level": enemy["level"]}
+    if potions != character.potions:
+        detail["potions"] = potions - character.potions
+    if params["action"] == "auto":
+        detail.update(policy=params["policy"], turns=result["turns"])
+    battle_event(character.id, "pve", fight, "turn", params["action"], enemy_health - enemy["current_health"],
+                 health - character.current_health, **detail)
+    if result["outcome"] == "won":
+        battle_event(character.id, "pve", fight, "reward", enemy=enemy["race"], gold=character.gold - gold,
+                     exp=enemy["level"] * 50)
+        if character.level != level:
+            battle_event(character.id, "pve", fight, "level_up", level=character.level, exp=character.exp)
+        if character.race != race:
+            battle_event(character.id, "pve", fight, "evolve", race=character.race)
+    elif result["outcome"] == "lost":
+        battle_event(character.id, "pve", fight, "death", enemy=enemy["race"], enemy_level=enemy["level"])
+
+# Battle events for one PvP move by `side`; fighters are (id, HP before, HP
+# after, race, ability) for player 1 and 2
+def pvp_move_events(kind, fight, fighters, side, action, winner=None, reason=None):
+    me, opponent = fighters[side - 1], fighters[2 - side]
+    detail = {"ability": primary_ability(me[4])[0]} if action == "ability" else {}
+    battle_event(me[0], kind, fight, "turn", action, opponent[1] - opponent[2], me[1] - me[2], **detail)
+    if winner:
+        won, lost = fighters[winner - 1], fighters[2 - winner]
+        fight_end_events(kind, fight, won[0], lost[0], lost[2], reason)
 
 # PvE Battle Route
 @app.route("/battle", methods=["GET", "POST"])
+@retry_on_conflict
 def battle():
-    char_id = session.get("char_id", None)
-    if not char_id:
+    character = get_character(session.get("char_id", None))
+    if character is None:
         return redirect(url_for("index"))
-    character = Character.query.get(char_id)
-    if "enemy" not in session:
-        enemy = generate_enemy(character.level)
-        session["enemy"] = enemy
-    else:
-        enemy = session["enemy"]
-
-    battle_log = session.get("battle_log", [])
+    battle_id, state, enemy = load_battle_state(character)
 
+    game_over = False
     if request.method == "POST":
-        action = request.form.get("action")
-        if action == "attack":
-            base_damage = character.strength + random.randint(1, 10)
-            # Apply type advantage multiplier
-            mult = type_multiplier(character, type("dummy", (), {"race": enemy["race"]}))
-            damage = int(base_damage * mult)
-            enemy["current_health"] -= damage
-            battle_log.append(f"You attacked the {enemy['race']} for {damage} damage!")
-            if enemy["current_health"] <= 0:
-                battle_log.append(f"You defeated the {enemy['race']}!")
-                exp_gain = enemy["level"] * 50
-                gold_gain = enemy["level"] * 20
-                battle_log.append(f"You gained {exp_gain} EXP and {gold_gain} gold!")
-                character.gain_exp(exp_gain)
-                character.gold += gold_gain
-                db.session.commit()
-                session.pop("enemy", None)
-                session["battle_log"] = battle_log
-                return redirect(url_for("battle"))
-            else:
-                enemy_damage = random.randint(enemy["attack_min"], enemy["attack_max"])
-                effective_damage = calculate_damage(enemy_damage, character.constitution)
-                character.current_health -= effective_damage
-                battle_log.append(f"The {enemy['race']} attacked you for {effective_damage} damage!")
-                if character.current_health <= 0:
-                    character.current_health = 0
-                    battle_log.append("You have been defeated!")
-                    db.session.commit()
-                    session["battle_log"] = battle_log
-                    return render_template("battle.html", character=character, enemy=enemy,
-                                           battle_log=battle_log, game_over=True)
-        elif action == "defend":
-            enemy_damage = random.randint(enemy["attack_min"], enemy["attack_max"])
-            reduced_damage = max(1, enemy_damage - (character.constitution // 2) - 5)
-            character.current_health -= reduced_damage
-            battle_log.append(f"You defended! The {enemy['race']} attacked for {reduced_damage} damage after reduction.")
-            if character.current_health <= 0:
-                character.current_health = 0
-                battle_log.append("You have been defeated!")
-                db.session.commit()
-                session["battle_log"] = battle_log
-                return render_template("battle.html", character=character, enemy=enemy,
-                                           battle_log=battle_log, game_over=True)
-        elif action == "use_potion":
-            if character.potions > 0:
-                heal_amount = random.randint(30, 50)
-                character.current_health = min(character.base_health, character.current_health + heal_amount)
-                character.potions -= 1
-                battle_log.append(f"You used a potion and healed for {heal_amount} HP!")
-                enemy_damage = random.randint(enemy["attack_min"], enemy["attack_max"])
-                effective_damage = calculate_damage(enemy_damage, character.constitution)
-                character.current_health -= effective_damage
-                battle_log.append(f"While using a potion, the {enemy['race']} attacked you for {effective_damage} damage!")
-                if character.current_health <= 0:
-                    character.current_health = 0
-                    battle_log.append("You have been defeated!")
-                    db.session.commit()
-                    session["battle_log"] = battle_log
-                    return render_template("battle.html", character=character, enemy=enemy,
-                                           battle_log=battle_log, game_over=True)
-            else:
-                battle_log.append("You have no potions left!")
-        db.session.commit()
-        session["enemy"] = enemy
-        session["battle_log"] = battle_log
+        # Form posts re-render the page; JSON posts get just the turn's events
+        params = request.get_json(silent=True) or request.form
+        before = (character.current_health, enemy["current_health"], character.level, character.race)
+        result = play_battle_action(character, battle_id, state, enemy, params)
+        battle_log, outcome = result["log"], result["outcome"]
+        if request.is_json:
+            return jsonify(battle_update(character, battle_id, enemy, before, battle_log, outcome))
+        if outcome == "won":
+            return redirect(url_for("battle"))
+        game_over = outcome == "lost"
 
+    log_lines, log_page, log_pages = load_log_page(battle_id)
     return render_template("battle.html", character=character, enemy=enemy,
-                           battle_log=battle_log, game_over=False)
+                           battle_log=log_lines, log_page=log_page, log_pages=log_pages,
+                           game_over=game_over, auto_policies=AUTO_BATTLE_POLICIES,
+                           enemy_images={race: assets.url(f"images/{race.lower()}.png") for race in ENEMY_RACES})
+
+# Exact auto-battle odds against the current enemy for every policy, at the
+# given "threshold" (percent of max HP). Solving them takes milliseconds per
+# policy and the answer changes every turn, so the battle page asks for them
+# only when the player does, never on a render or a turn.
+@app.route("/battle/odds")
+def battle_odds_view():
+    character = get_character(session.get("char_id", None))
+    if character is None:
+        return jsonify({"error": "No character in session."}), 400
+    threshold = request.args.get("threshold", 30, type=int)
+    if not 0 <= threshold <= 100:
+        return jsonify({"error": "threshold must be a percentage."}), 400
+    _, _, enemy = load_battle_state(character)
+    return jsonify(battle_odds(character, enemy, threshold))
+
+# Auto-Battle JSON endpoint: resolves the current fight in one request.
+# Accepts "policy" and "threshold" (percent of max HP) as JSON or form fields.
+@app.route("/battle/auto", methods=["POST"])
+@retry_on_conflict
+def battle_auto():
+    char_id = session.get("char_id", None)
+    character = get_character(char_id)
+    if character is None:
+        return jsonify({"error": "No character in session."}), 400
+    params = request.get_json(silent=True) or request.form
+    policy = params.get("policy", "attack")
+    if policy not in AUTO_BATTLE_POLICIES:
+        return jsonify({"error": f"Unknown policy. Choose one of: {', '.join(AUTO_BATTLE_POLICIES)}."}), 400
+    try:
+        threshold = int(params.get("threshold", 30))
+    except (TypeError, ValueError):
+        return jsonify({"error": "threshold must be an integer percentage."}), 400
+
+    battle_id, state, enemy = load_battle_state(character)
+    result = play_battle_action(character, battle_id, state, enemy,
+                                {"action": "auto", "policy": policy, "threshold": threshold})
+    result["character"] = {
+        "race": character.race, "level": character.level, "exp": character.exp,
+        "current_health": character.current_health, "base_health": character.base_health,
+        "potions": character.potions, "gold": character.gold,
+    }
+    result["enemy"] = {key: enemy[key] for key in ["race", "level", "current_health", "base_health"]}
+    return jsonify(result)
+
+POTION_COST = 20
+
+# Returns (bought, message)
+def buy_potions(character, quantity):
+    try:
+        quantity = int(quantity)
+    except (TypeError, ValueError):
+        quantity = 0
+    total_cost = POTION_COST * quantity
+    if quantity > 0 and character.gold >= total_cost:
+        character.gold -= total_cost
+        character.potions += quantity
+        return True, f"You purchased {quantity} potion(s) for {total_cost} gold."
+    return False, "Not enough gold or invalid quantity."
 
 # Shop Route
 @app.route("/shop", methods=["GET", "POST"])
+@retry_on_conflict
 def shop():
-    char_id = session.get("char_id", None)
-    if not char_id:
+    character = get_character(session.get("char_id", None))
+    if character is None:
         return redirect(url_for("index"))
-    character = Character.query.get(char_id)
     message = ""
     if request.method == "POST":
-        cost_per_potion = 20
-        try:
-            quantity = int(request.form.get("quantity", 0))
-        except ValueError:
-            quantity = 0
-        total_cost = cost_per_potion * quantity
-        if quantity > 0 and character.gold >= total_cost:
-            character.gold -= total_cost
-            character.potions += quantity
-            message = f"You purchased {quantity} potion(s) for {total_cost} gold."
-            db.session.commit()
-        else:
-            message = "Not enough gold or invalid quantity."
+        _, message = buy_potions(character, request.form.get("quantity", 0))
     return render_template("shop.html", character=character, message=message)
 
+# One hotseat move by the player whose turn it is; returns (log lines, game over)
+def play_hotseat_turn(state, player1, player2, action, rng):
+    pvp_turn = state["turn"]
+    if pvp_turn == 1:
+        attacker, defender, defending_flag = player1, player2, state["p2_defend"]
+    else:
+        attacker, defender, defending_flag = player2, player1, state["p1_defend"]
+    if action == "defend":
+        state[f"p{pvp_turn}_defend"] = True
+    lines = []
+    line = pvp_action(attacker, defender, action, rng, defending_flag)
+    if line:
+        lines.append(line)
+    if defender.current_health <= 0:
+        lines.append(f"{defender.race} has been defeated! {attacker.race} wins!")
+        return lines, True
+    state["turn"] = 2 if pvp_turn == 1 else 1
+    state["p1_defend"] = False
+    state["p2_defend"] = False
+    return lines, False
+
+# Plays one hotseat move and records it on the fight; returns (log lines, game over)
+def play_hotseat_move(state, fight, player1, player2, action, rng):
+    pvp_turn = state["turn"]
+    before = [player1.current_health, player2.current_health]
+    lines, game_over = play_hotseat_turn(state, player1, player2, action, rng)
+    fight["actions"].append(action)
+    fight["log"] = chain_log_digest(fight["log"], lines)
+    if not fight.get("recorded"):
+        fighters = [(player.id, health, player.current_health, player.race, player.ability)
+                    for player, health in zip([player1, player2], before)]
+        pvp_move_events("hotseat", fight, fighters, pvp_turn, action, pvp_turn if game_over else None)
+    return lines, game_over
+
 # Local PvP Route
 @app.route("/pvp", methods=["GET", "POST"])
+@retry_on_conflict
 def pvp():
-    p1_id = session.get("pvp_p1_id", None)
-    p2_id = session.get("pvp_p2_id", None)
-    if not p1_id or not p2_id:
-        player1 = Character()
-        player2 = Character()
-        db.session.add(player1)
-        db.session.add(player2)
-        db.session.commit()
-        session["pvp_p1_id"] = player1.id
-        session["pvp_p2_id"] = player2.id
+    pvp_id = session.get("pvp_id")
+    state = battle_store.get(pvp_id) if pvp_id else None
+    # ?cpu=<difficulty> starts a match against the CPU, ?cpu= one for two players
+    opponent = request.args.get("cpu") if request.method == "GET" else None
+    if opponent in CPU_DIFFICULTIES or opponent == "":
+        state = None
     else:
-        player1 = Character.query.get(p1_id)
-        player2 = Character.query.get(p2_id)
-    pvp_turn = session.get("pvp_turn", 1)
-    pvp_log = session.get("pvp_log", [])
-    p1_defend = session.get("p1_defend", False)
-    p2_defend = session.get("p2_defend", False)
+        opponent = None
+    if state is not None:
+        player1 = get_character(state["p1_id"])
+        player2 = get_character(state["p2_id"])
+        if player1 is None or player2 is None:
+            # The pair was reaped; start a fresh match
+            battle_store.delete(pvp_id)
+            state = None
+    if state is None:
+        player1 = claim_character()
+        player2 = claim_character()
+        state = {"p1_id": player1.id, "p2_id": player2.id, "turn": 1, "p1_defend": False, "p2_defend": False,
+                 "fight": start_fight(p1=character_snapshot(player1), p2=character_snapshot(player2))}
+        if opponent:
+            state["cpu"] = opponent  # plays player 2
+        pvp_id = battle_store.create(state)
+        session["pvp_id"] = pvp_id
+        if opponent is not None:
+            return redirect(url_for("pvp"))  # so a reload doesn't start another match
+    pvp_turn = state["turn"]
+    pvp_log = []
 
     if request.method == "POST":
-        action = request.form.get("action")
-        if pvp_turn == 1:
-            attacker = player1
-            defender = player2
-            defending_flag = p2_defend
-        else:
-            attacker = player2
-            defender = player1
-            defending_flag = p1_defend
-
-        if action == "attack":
-            base_damage = attacker.strength + random.randint(1, 10)
-            # Apply type advantage multiplier
-            mult = type_multiplier(attacker, defender)
-            if defending_flag:
-                base_damage //= 2
-            damage = int(base_damage * mult)
-            defender.current_health -= damage
-            pvp_log.append(f"{attacker.race} attacked {defender.race} for {damage} damage!")
-        elif action == "defend":
-            if pvp_turn == 1:
-                session["p1_defend"] = True
-            else:
-                session["p2_defend"] = True
-            pvp_log.append(f"{attacker.race} is defending this turn!")
-        elif action == "ability":
-            log_text, ability_damage = use_ability(attacker, defender)
-            defender.current_health -= ability_damage
-            pvp_log.append(log_text)
-        if defender.current_health <= 0:
-            pvp_log.append(f"{defender.race} has been defeated! {attacker.race} wins!")
-            db.session.commit()
-            session["pvp_log"] = pvp_log
-            return render_template("pvp.html", player1=player1, player2=player2, pvp_log=pvp_log, game_over=True, turn=pvp_turn)
-        pvp_turn = 2 if pvp_turn == 1 else 1
-        session["pvp_turn"] = pvp_turn
-        session["p1_defend"] = False
-        session["p2_defend"] = False
-        db.session.commit()
-        session["pvp_log"] = pvp_log
+        # Form posts re-render the page; JSON posts get just the turn's events
+        params = request.get_json(silent=True) or request.form
+        action = params.get("action")
+        before = [player1.current_health, player2.current_health]
+        fight = state.get("fight")
+        if fight is None:  # match from before fights were recorded
+            fight = state["fight"] = start_fight(p1=character_snapshot(player1), p2=character_snapshot(player2))
+        rng = fight_stream(fight)
+        game_over = False
+        if not (state.get("cpu") and pvp_turn == 2):
+            pvp_log, game_over = play_hotseat_move(state, fight, player1, player2, action, rng)
+        # The CPU answers straight away, in the same request
+        if state.get("cpu") and state["turn"] == 2 and not game_over:
+            lines, game_over = play_hotseat_move(state, fight, player1, player2,
+                                                 cpu_move(state, player1, player2, state["cpu"]), rng)
+            pvp_log += lines
+        park_stream(fight, rng)
+        pvp_turn = state["turn"]
+        if game_over and not fight.get("recorded"):
+            fight["recorded"] = True
+            record_fight("hotseat", player1.id, fight, {"p1": character_snapshot(player1),
+                                                        "p2": character_snapshot(player2)})
+            write_through(player1, player2)
+        commit_characters()
+        battle_store.update(pvp_id, state, pvp_log)
+        if request.is_json:
+            return jsonify({
+                "events": hp_events(["p1", "p2"], before, [player1.current_health, player2.current_health]),
+                "lines": pvp_log, "turn": pvp_turn, "game_over": game_over,
+                "players": [fighter_view(player1), fighter_view(player2)],
+            })
+        if game_over:
+            log_lines, log_page, log_pages = load_log_page(pvp_id)
+            return render_template("pvp.html", player1=player1, player2=player2, pvp_log=log_lines,
+                                   log_page=log_page, log_pages=log_pages, game_over=True, turn=pvp_turn,
+                                   cpu=state.get("cpu"), cpu_difficulties=CPU_DIFFICULTIES)
+
+    log_lines, log_page, log_pages = load_log_page(pvp_id)
+    return render_template("pvp.html", player1=player1, player2=player2, pvp_log=log_lines,
+                           log_page=log_page, log_pages=log_pages, game_over=False, turn=state["turn"],
+                           cpu=state.get("cpu"), cpu_difficulties=CPU_DIFFICULTIES)
+
+# Leaderboard: ?board=level|gold, optional ?race= and ?size=
+def leaderboard_args():
+    board = request.args.get("board", "level")
+    race = request.args.get("race") or None
+    size = request.args.get("size", app.config['LEADERBOARD_SIZE'], type=int)
+    if board not in LEADERBOARDS:
+        return None, f"Unknown board. Choose one of: {', '.join(LEADERBOARDS)}."
+    if race is not None and race not in RACE_IDS:
+        return None, "Unknown race."
+    return (board, race, min(max(1, size), app.config['LEADERBOARD_MAX_SIZE'])), None
+
+@app.route("/leaderboard")
+def leaderboard_page():
+    args, error = leaderboard_args()
+    if error:
+        flash(error, "warning")
+        return redirect(url_for("leaderboard_page"))
+    board, race, size = args
+    result = leaderboard(board, race, size, get_character(session.get("char_id")))
+    return render_template("leaderboard.html", result=result, boards=list(LEADERBOARDS), races=RACE_NAMES)
+
+@app.route("/leaderboard.json")
+def leaderboard_json():
+    args, error = leaderboard_args()
+    if error:
+        return jsonify({"error": error}), 400
+    response = jsonify(leaderboard(*args, character=get_character(session.get("char_id"))))
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config['LEADERBOARD_CACHE_TTL']
+    return response
 
-    return render_template("pvp.html", player1=player1, player2=player2, pvp_log=pvp_log, game_over=False, turn=session.get("pvp_turn", 1))
+# Online PvP page; the queue is polled, the match is pushed over /events
+@app.route("/pvp/online")
+def pvp_online():
+    character = get_character(session.get("char_id", None))
+    if character is None:
+        return redirect(url_for("index"))
+    return render_template("pvp_online.html", character=character, poll_ms=app.config['PVP_POLL_MS'],
+                           turn_timeout=app.config['PVP_TURN_TIMEOUT'])
+
+# Join the queue, or poll it while waiting: returns the match once paired
+@app.route("/pvp/online/queue", methods=["POST"])
+def pvp_online_queue():
+    character = get_character(session.get("char_id", None))
+    if character is None:
+        return jsonify({"error": "No character in session."}), 400
+    match = join_pvp_queue(character)
+    if match is None:
+        return jsonify({"status": "queued"})
+    return jsonify({"status": "matched", "match": pvp_match_state(match, 1 if match.p1_id == character.id else 2)})
+
+@app.route("/pvp/online/leave", methods=["POST"])
+def pvp_online_leave():
+    character = get_character(session.get("char_id", None))
+    if character is None:
+        return jsonify({"error": "No character in session."}), 400
+    leave_pvp_queue(character)
+    return jsonify({"status": "idle"})
+
+# Match state for one of its players: POST plays a move ("action" as JSON or
+# form field), GET polls (and claims a timeout win)
+def pvp_match_response(character, match_id):
+    match = db.session.get(PvpMatch, match_id)
+    side = None if match is None else {match.p1_id: 1, match.p2_id: 2}.get(character.id)
+    if side is None:
+        return jsonify({"error": "No such match."}), 404
+    if request.method == "POST":
+        params = request.get_json(silent=True) or request.form
+        action = params.get("action")
+        if action not in PVP_ACTIONS:
+            return jsonify({"error": f"Unknown action. Choose one of: {', '.join(PVP_ACTIONS)}."}), 400
+        before = match.fighters
+        error = play_pvp_online_turn(match, side, action)
+        if error:
+            return jsonify({"error": error, "match": pvp_match_state(match, side)}), 409
+        fighters = [(player_id, old["current_health"], new["current_health"], new["race"], new["ability"])
+                    for player_id, old, new in zip([match.p1_id, match.p2_id], before, match.fighters)]
+        pvp_move_events("pvp", match.fight, fighters, side, action, match.winner,
+                        "forfeit" if action == "forfeit" else None)
+    elif claim_pvp_timeout(match, side):
+        opponent_id = match.p2_id if side == 1 else match.p1_id
+        fight_end_events("pvp", match.fight, character.id, opponent_id, match.fighters[2 - side]["current_health"],
+                         "timeout")
+    if match.winner and db.inspect(match).attrs.winner.history.has_changes():
+        record_fight("pvp", match.p1_id, match.fight, {"winner": match.winner, "fighters": match.fighters})
+    try:
+        db.session.flush()
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify({"error": "The match changed meanwhile; fetch it again."}), 409
+    g.pvp_moved = match.id
+    return jsonify(pvp_match_state(match, side))
+
+@app.route("/pvp/online/match/<int:match_id>", methods=["GET", "POST"])
+def pvp_online_match(match_id):
+    character = get_character(session.get("char_id", None))
+    if character is None:
+        return jsonify({"error": "No character in session."}), 400
+    return pvp_match_response(character, match_id)
+
+# Pushes the match to the player as it changes (see pvp_match_stream)
+@app.route("/pvp/online/match/<int:match_id>/events")
+def pvp_online_events(match_id):
+    character = get_character(session.get("char_id", None))
+    if character is None:
+        return jsonify({"error": "No character in session."}), 400
+    match = db.session.get(PvpMatch, match_id)
+    side = None if match is None else {match.p1_id: 1, match.p2_id: 2}.get(character.id)
+    if side is None:
+        return jsonify({"error": "No such match."}), 404
+    settings = (app.config['PVP_STREAM_CHECK'], app.config['PVP_STREAM_KEEPALIVE'], app.config['PVP_STREAM_MAX'])
+    watch = PvpMatchStream(db.engine, match_id, side, request.headers.get("Last-Event-ID", type=int), settings)
+    if "rpg.pvp_stream" in request.environ:
+        # The ASGI front end streams it from its event loop (asgi.py)
+        request.environ["rpg.pvp_stream"] = watch
+        response = Response(mimetype="text/event-stream")
+    else:
+        response = Response(pvp_match_stream(watch), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # let nginx pass events straight through
+    return response
 
-# Restart Route (clears sessions)
+# Restart Route (clears sessions and the server-side battle state)
 @app.route("/restart")
 def restart():
     session.pop("char_id", None)
-    session.pop("enemy", None)
-    session.pop("battle_log", None)
-    session.pop("pvp_p1_id", None)
-    session.pop("pvp_p2_id", None)
-    session.pop("pvp_turn", None)
-    session.pop("pvp_log", None)
-    session.pop("p1_defend", None)
-    session.pop("p2_defend", None)
+    for key in ("battle_id", "pvp_id"):
+        state_id = session.pop(key, None)
+        if state_id:
+            battle_store.delete(state_id)
     return redirect(url_for("index"))
 
+# -------------------------------
+# JSON API (v1) for headless clients and bots
+# -------------------------------
+# The same game rules as the pages, without cookies or templates. A client
+# creates characters with POST /api/v1/characters and gets one bearer token
+# per character; every other call sends "Authorization: Bearer <token>".
+# Only a SHA-256 of each token is stored. The batched calls take several
+# characters (create, fetch) or several battle actions per request, up to
+# API_BATCH_LIMIT. Each token's character has its own server-side battle.
+# Serve it from asgi.py to keep thousands of connections on one event loop.
+class ApiToken(db.Model):
+    __tablename__ = "api_token"
+    token_hash = db.Column(db.String(64), primary_key=True)
+    character_id = db.Column(db.Integer, db.ForeignKey("character.id"), nullable=False, index=True)
+    created_at = db.Column(db.Float, nullable=False)
+
+app.config['API_BATCH_LIMIT'] = 20
+# asgi.py: threads that run requests (all game and database work), requests
+# allowed to wait for one before new ones get a 503, and the largest body read
+app.config['API_THREADS'] = int(os.environ.get("API_THREADS", "8"))
+app.config['API_MAX_PENDING'] = int(os.environ.get("API_MAX_PENDING", "10000"))
+app.config['API_MAX_BODY'] = 64 * 1024
+API_CHARACTER_FIELDS = ["id", "race", "level", "exp", "base_health", "current_health", "mana", "strength",
+                        "intelligence", "wisdom", "constitution", "speed", "potions", "gold", "evolved", "ability"]
+API_PUBLIC_CHARACTER_FIELDS = ["id", "race", "level", "exp", "gold"]  # what the leaderboards show of anyone
+API_BATTLE_ACTIONS = ["attack", "defend", "use_potion", "auto"]
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+def hash_api_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def issue_api_token(character):
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(token_hash=hash_api_token(token), character_id=character.id, created_at=time.time()))
+    return token
+
+# Tokens never change owner, so owners found are memoized per process (LRU).
+# Unknown tokens are not: one may be issued on another worker a moment later.
+API_TOKEN_CACHE_SIZE = 4096
+_api_token_owners = OrderedDict()
+_api_token_owners_lock = threading.Lock()
+
+def api_token_owner(token_hash):
+    with _api_token_owners_lock:
+        owner = _api_token_owners.get(token_hash)
+        if owner is not None:
+            _api_token_owners.move_to_end(token_hash)
+            return owner
+    owner = db.session.scalar(db.select(ApiToken.character_id).where(ApiToken.token_hash == token_hash))
+    if owner is not None:
+        with _api_token_owners_lock:
+            _api_token_owners[token_hash] = owner
+            while len(_api_token_owners) > API_TOKEN_CACHE_SIZE:
+                _api_token_owners.popitem(last=False)
+    return owner
+
+def api_battle_id(character):
+    return f"api-{character.id}"
+
+def api_error(message, status=400):
+    return jsonify({"error": message}), status
+
+def api_character_view(character, fields=API_CHARACTER_FIELDS):
+    return {field: getattr(character, field) for field in fields}
+
+@api.before_request
+def authenticate_api_client():
+    g.api_notices = []
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    owner = api_token_owner(hash_api_token(token)) if scheme.lower() == "bearer" and token else None
+    g.api_character = get_character(owner)
+    if g.api_character is None and request.endpoint != "api.create_characters":
+        return api_error("Missing or unknown bearer token.", 401)
+
+# {"count": n} -> n new characters, each with its token
+@api.route("/characters", methods=["POST"])
+def create_characters():
+    params = request.get_json(silent=True) or {}
+    count = params.get("count", 1)
+    if not isinstance(count, int) or not 1 <= count <= app.config['API_BATCH_LIMIT']:
+        return api_error(f"count must be between 1 and {app.config['API_BATCH_LIMIT']}.")
+    created = []
+    for _ in range(count):
+        character = claim_character()
+        created.append({"token": issue_api_token(character), "character": api_character_view(character)})
+    return jsonify({"characters": created}), 201
+
+# ?ids=1,2,3 -> those characters (cached copies win over possibly stale rows):
+# the token's own in full, anyone else's only as the leaderboards show it.
+# Pooled characters belong to nobody yet and are left out like unknown ids.
+@api.route("/characters")
+def fetch_characters():
+    try:
+        ids = [int(value) for value in request.args.get("ids", "").split(",") if value]
+    except ValueError:
+        return api_error("ids must be a comma-separated list of integers.")
+    if not 1 <= len(ids) <= app.config['API_BATCH_LIMIT']:
+        return api_error(f"Pass between 1 and {app.config['API_BATCH_LIMIT']} ids.")
+    pooled = set(db.session.scalars(db.select(CharacterPool.character_id).where(CharacterPool.character_id.in_(ids))))
+    ids = [char_id for char_id in ids if char_id not in pooled]
+    found = character_cache.peek(ids) if character_cache is not None else {}
+    missing = [char_id for char_id in ids if char_id not in found]
+    if missing:
+        found.update((character.id, character) for character in
+                     db.session.scalars(db.select(Character).where(Character.id.in_(missing))))
+    own = g.api_character.id
+    return jsonify({"characters": [
+        api_character_view(found[char_id], API_CHARACTER_FIELDS if char_id == own else API_PUBLIC_CHARACTER_FIELDS)
+        for char_id in ids if char_id in found]})
+
+@api.route("/character")
+def fetch_own_character():
+    return jsonify({"character": api_character_view(g.api_character)})
+
+# {"actions": ["attack", {"action": "auto", "policy": "potion"}, ...]} plays
+# them in order and stops early if the character is defeated
+@api.route("/battle", methods=["POST"])
+@retry_on_conflict
+def battle_actions():
+    params = request.get_json(silent=True) or {}
+    actions = params.get("actions", [params.get("action")])
+    if not isinstance(actions, list) or not 1 <= len(actions) <= app.config['API_BATCH_LIMIT']:
+        return api_error(f"actions must be a list of 1 to {app.config['API_BATCH_LIMIT']} actions.")
+    actions = [action if isinstance(action, dict) else {"action": action} for action in actions]
+    if any(action.get("action") not in API_BATTLE_ACTIONS for action in actions):
+        return api_error(f"Unknown action. Choose from: {', '.join(API_BATTLE_ACTIONS)}.")
+    character = g.api_character
+    battle_id = api_battle_id(character)
+    results = []
+    for action in actions:
+        _, state, enemy = load_battle_state(character, battle_id)
+        before = (character.current_health, enemy["current_health"], character.level, character.race)
+        result = play_battle_action(character, battle_id, state, enemy, action)
+        results.append(battle_update(character, battle_id, enemy, before, result["log"], result["outcome"]))
+        if result["outcome"] == "lost":
+            break
+    return jsonify({"results": results, "character": api_character_view(character)})
+
+@api.route("/shop", methods=["POST"])
+@retry_on_conflict
+def shop_purchase():
+    params = request.get_json(silent=True) or {}
+    bought, message = buy_potions(g.api_character, params.get("quantity", 0))
+    if not bought:
+        return api_error(message, 409)
+    return jsonify({"message": message, "character": api_character_view(g.api_character)})
+
+@api.route("/pvp/queue", methods=["POST"])
+def pvp_queue():
+    character = g.api_character
+    match = join_pvp_queue(character)
+    if match is None:
+        return jsonify({"status": "queued"})
+    return jsonify({"status": "matched", "match": pvp_match_state(match, 1 if match.p1_id == character.id else 2)})
+
+@api.route("/pvp/leave", methods=["POST"])
+def pvp_leave():
+    leave_pvp_queue(g.api_character)
+    return jsonify({"status": "idle"})
+
+@api.route("/pvp/matches/<int:match_id>", methods=["GET", "POST"])
+def pvp_match(match_id):
+    return pvp_match_response(g.api_character, match_id)
+
+app.register_blueprint(api)
+
+if app.config['TEMPLATE_WARMUP']:
+    warm_templates()
+
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
+        upgrade_schema()
+        refill_character_pool()
+        db.session.commit()
+    enemy_pool.warm(range(1, 11))
+    start_reaper()
     app.run(debug=True)
@@ -0,0 +1,240 @@
+import asyncio, sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from app import app, pvp_watchers
+
+# -------------------------------
+# Async front end (ASGI)
+# -------------------------------
+# Serves the whole Flask app, /api/v1 included, from an asyncio server:
+#
+#     uvicorn asgi:application --host 0.0.0.0 --port 8000
+#
+# Connections, request bodies and responses are handled on the event loop,
+# so idle and slow clients cost a coroutine rather than a thread. The view
+# itself (game rules, database and cache work) runs on a pool of API_THREADS
+# threads and never on the loop. Once API_MAX_PENDING requests are waiting
+# for a thread, new ones get a 503 straight away instead of queueing
+# without bound.
+#
+# The PvP event stream (pvp_online_events) runs on the loop itself: the view
+# only checks the player and hands back its PvpMatchStream, and the stream
+# then waits on an asyncio.Event per match, set when a request in this
+# process moves that match (or after PVP_STREAM_CHECK seconds, for moves made
+# by other workers). Only its match reads, one short primary-key lookup each,
+# go to the pool, so an open stream never holds a thread while it waits.
+# Other streamed responses are still pulled chunk by chunk on a separate
+# pool so they can't starve ordinary requests.
+
+
+def _latin1(value):
+    # WSGI carries paths and headers as latin-1 "bytes in a str"
+    return value.decode("latin-1") if isinstance(value, bytes) else value.encode("utf-8").decode("latin-1")
+
+
+class AsgiApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi_app = flask_app.wsgi_app
+        self.max_pending = flask_app.config['API_MAX_PENDING']
+        self.max_body = flask_app.config['API_MAX_BODY']
+        self.executor = ThreadPoolExecutor(flask_app.config['API_THREADS'], thread_name_prefix="asgi")
+        self.stream_executor = ThreadPoolExecutor(64, thread_name_prefix="asgi-stream")
+        self.pending = 0  # only touched on the event loop
+        self.loop = None
+        self.pvp_moved = {}  # match id: asyncio.Event set on its next move
+        self.pvp_viewers = Counter()  # match id: open streams
+        pvp_watchers.append(self.match_moved)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                self.stream_executor.shutdown(wait=False, cancel_futures=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        self.loop = asyncio.get_running_loop()
+        body = await self.read_body(receive)
+        if body is None:
+            await self.plain(send, 413, b"Request body too large.")
+            return
+        if self.pending >= self.max_pending:
+            await self.plain(send, 503, b"Server busy, try again shortly.")
+            return
+        loop = self.loop
+        self.pending += 1
+        try:
+            status, headers, chunks, stream = await loop.run_in_executor(
+                self.executor, self.run, self.environ(scope, body))
+        finally:
+            self.pending -= 1
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if stream is None:
+            await send({"type": "http.response.body", "body": b"".join(chunks)})
+            return
+        disconnected = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        try:
+            if isinstance(stream, tuple):
+                await self.stream_wsgi(send, chunks, *stream, disconnected)
+            else:
+                await self.stream_pvp(send, stream, disconnected)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+
+    async def stream_wsgi(self, send, chunks, iterator, iterable, disconnected):
+        # Pulls one chunk at a time off the loop until it ends or the client
+        # goes away
+        loop = self.loop
+        try:
+            for chunk in chunks:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            while not disconnected.done():
+                chunk = await loop.run_in_executor(self.stream_executor, next, iterator, None)
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if hasattr(iterable, "close"):
+                await loop.run_in_executor(self.stream_executor, iterable.close)
+
+    async def stream_pvp(self, send, watch, disconnected):
+        match_id = watch.match_id
+        self.pvp_viewers[match_id] += 1
+        try:
+            await send({"type": "http.response.body", "body": watch.opening().encode(), "more_body": True})
+            while watch.live() and not disconnected.done():
+                # Registered before the read, so a move committed meanwhile
+                # still wakes this stream
+                moved = self.pvp_moved.setdefault(match_id, asyncio.Event())
+                row = await self.loop.run_in_executor(self.executor, watch.read)
+                chunk = watch.update(row)
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+                if watch.done:
+                    break
+                waiting = asyncio.ensure_future(moved.wait())
+                await asyncio.wait([waiting, disconnected], timeout=watch.check, return_when=asyncio.FIRST_COMPLETED)
+                waiting.cancel()
+        finally:
+            self.pvp_viewers[match_id] -= 1
+            if not self.pvp_viewers[match_id]:
+                del self.pvp_viewers[match_id]
+                self.pvp_moved.pop(match_id, None)
+
+    def match_moved(self, match_id):
+        # On the request's pool thread, after its commit
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.wake_pvp_viewers, match_id)
+
+    def wake_pvp_viewers(self, match_id):
+        moved = self.pvp_moved.pop(match_id, None)
+        if moved is not None:
+            moved.set()
+
+    async def wait_for_disconnect(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    async def read_body(self, receive):
+        parts, size = [], 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body:
+                return None
+            parts.append(chunk)
+            if not message.get("more_body", False):
+                break
+        return b"".join(parts)
+
+    async def plain(self, send, status, text):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"retry-after", b"1")]})
+        await send({"type": "http.response.body", "body": text})
+
+    def environ(self, scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": _latin1(scope.get("root_path", "")),
+            "PATH_INFO": _latin1(scope["path"]),
+            "QUERY_STRING": _latin1(scope.get("query_string", b"")),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "CONTENT_LENGTH": str(len(body)),
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+                continue
+            if name == "CONTENT_LENGTH":
+                continue
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def run(self, environ):
+        # On a pool thread: runs the WSGI app and collects the response, or
+        # the first chunk of it if it has no Content-Length (a stream)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started["status"], started["headers"] = status, headers
+
+        environ["rpg.pvp_stream"] = None  # tells the view this server streams PvP events itself
+        iterable = self.wsgi_app(environ, start_response)
+        watch = environ["rpg.pvp_stream"]
+        headers = started["headers"]
+        if watch is not None:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            headers = [(name, value) for name, value in headers if name.lower() != "content-length"]
+        streamed = not any(name.lower() == "content-length" for name, _ in headers)
+        asgi_headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        status = int(started["status"].split(" ", 1)[0])
+        if watch is not None:
+            return status, asgi_headers, [], watch
+        if streamed:
+            iterator = iter(iterable)
+            first = next(iterator, None)
+            return status, asgi_headers, [first] if first else [], (iterator, iterable)
+        try:
+            return status, asgi_headers, list(iterable), None
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+
+application = AsgiApp(app)
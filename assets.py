@@ -0,0 +1,237 @@
+import gzip, hashlib, logging, mimetypes, os, posixpath, re, threading, urllib.request
+
+import click
+from flask import abort, g, has_request_context, request, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# -------------------------------
+# Static assets (fingerprinted, compressed, cached)
+# -------------------------------
+# Templates link assets through asset_url("css/app.css"), which returns
+#   /assets/css/app.<first 12 hex of the content's SHA-256>.css
+# Those URLs never change meaning, so they are served with a one-year
+# immutable Cache-Control and browsers don't re-request them until a deploy
+# changes the content (and so the URL). url(...) references inside CSS are
+# rewritten to fingerprinted URLs before hashing, so a new background image
+# also changes the stylesheet's URL. Text assets are compressed once per
+# process (brotli when installed and accepted, else gzip) and kept in memory.
+#
+# Third-party CSS/JS is vendored under static/vendor/ and committed, so pages
+# never fetch anything from a CDN. `flask vendor-assets` downloads whatever
+# is missing (run it wherever there is network, then commit the files) and
+# `flask vendor-assets --check` fails while anything is. A file that isn't
+# vendored is linked at its local path and 404s, and startup logs an error
+# naming it. ASSETS_CDN_FALLBACK=1 links its CDN URL instead (development
+# only).
+#
+# HTML and JSON responses get the same compression; HTML GETs also get an
+# ETag, "Cache-Control: no-cache" and a 304 when the page didn't change,
+# except pages that set g.skip_etag because they differ on every render
+# (forms with one-time submission tokens).
+
+VENDOR_ASSETS = {
+    "vendor/bootstrap.min.css": "https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css",
+    "vendor/animate.min.css": "https://cdnjs.cloudflare.com/ajax/libs/animate.css/4.1.1/animate.min.css",
+    "vendor/jquery.min.js": "https://code.jquery.com/jquery-3.6.1.min.js",
+    "vendor/bootstrap.min.js": "https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/js/bootstrap.min.js",
+}
+COMPRESSIBLE = {"text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+                "application/json", "image/svg+xml"}
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+HASHED_NAME = re.compile(r"^(.+)\.([0-9a-f]{12})(\.[^./]+)$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+logger = logging.getLogger(__name__)
+
+
+class Asset:
+    __slots__ = ("body", "digest", "mimetype", "mtime", "encoded")
+
+    def __init__(self, body, digest, mimetype, mtime):
+        self.body = body
+        self.digest = digest
+        self.mimetype = mimetype
+        self.mtime = mtime
+        self.encoded = {}  # Content-Encoding -> compressed body
+
+
+def compress(body, encoding, level=6):
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, compresslevel=min(level, 9), mtime=0)
+
+
+def negotiate_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+class AssetPipeline:
+    def __init__(self, app):
+        self.app = app
+        self.root = app.static_folder
+        self.watch = app.config['ASSETS_WATCH']
+        self.cdn_fallback = app.config['ASSETS_CDN_FALLBACK']
+        self._assets = {}  # filename -> Asset, or None when the file doesn't exist
+        self._urls = {}  # (filename, script root) -> URL
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        if filename in self._assets and not self.watch:
+            return self._assets[filename]
+        path = safe_join(self.root, filename)
+        try:
+            mtime = os.stat(path).st_mtime_ns if path else None
+        except OSError:
+            mtime = None
+        asset = self._assets.get(filename)
+        if mtime is None:
+            asset = None
+        elif asset is None or asset.mtime != mtime:
+            with open(path, "rb") as f:
+                body = f.read()
+            if filename.endswith(".css"):
+                body = self.rewrite_css(filename, body)
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            asset = Asset(body, hashlib.sha256(body).hexdigest()[:12], mimetype, mtime)
+        with self._lock:
+            self._assets[filename] = asset
+        return asset
+
+    def rewrite_css(self, filename, body):
+        base = posixpath.dirname(filename)
+
+        def fingerprint(match):
+            ref = match.group(2).strip()
+            if ref.startswith(("data:", "http:", "https:", "//", "/", "#")):
+                return match.group(0)
+            return f'url("{self.url(posixpath.normpath(posixpath.join(base, ref)))}")'
+
+        return CSS_URL.sub(fingerprint, body.decode("utf-8")).encode("utf-8")
+
+    def url(self, filename):
+        key = (filename, request.script_root if has_request_context() else "")
+        url = self._urls.get(key)
+        if url is not None and not self.watch:
+            return url
+        asset = self.get(filename)
+        if asset is None:
+            # Not vendored yet (or not shipped): the CDN if allowed, else the plain static URL
+            url = ((VENDOR_ASSETS.get(filename) if self.cdn_fallback else None)
+                   or url_for("static", filename=filename))
+        else:
+            stem, ext = posixpath.splitext(filename)
+            url = url_for("hashed_asset", filename=f"{stem}.{asset.digest}{ext}")
+        self._urls[key] = url
+        return url
+
+    def encoded(self, asset, encoding):
+        body = asset.encoded.get(encoding)
+        if body is None:
+            body = asset.encoded[encoding] = compress(asset.body, encoding, 11 if encoding == "br" else 9)
+        return body
+
+    def response(self, hashed_name):
+        match = HASHED_NAME.match(hashed_name)
+        if match is None:
+            abort(404)
+        stem, digest, ext = match.groups()
+        asset = self.get(stem + ext)
+        if asset is None:
+            abort(404)
+        encoding = negotiate_encoding() if asset.mimetype in COMPRESSIBLE else None
+        body = self.encoded(asset, encoding) if encoding else asset.body
+        response = self.app.response_class(body, mimetype=asset.mimetype)
+        response.headers["Vary"] = "Accept-Encoding"
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.set_etag(f"{asset.digest}-{encoding or 'identity'}")
+        # A stale fingerprint (page rendered before a deploy) gets today's file, uncached
+        response.headers["Cache-Control"] = IMMUTABLE if digest == asset.digest else "no-cache"
+        return response.make_conditional(request)
+
+
+def vendor_assets(static_folder, force=False):
+    # Downloads the third-party files in VENDOR_ASSETS; returns the paths written
+    written = []
+    for filename, url in VENDOR_ASSETS.items():
+        path = os.path.join(static_folder, *filename.split("/"))
+        if os.path.exists(path) and not force:
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as remote:
+            body = remote.read()
+        with open(path, "wb") as f:
+            f.write(body)
+        written.append(path)
+    return written
+
+
+def missing_vendor_assets(static_folder):
+    return [filename for filename in VENDOR_ASSETS
+            if not os.path.exists(os.path.join(static_folder, *filename.split("/")))]
+
+
+def init_assets(app):
+    pipeline = AssetPipeline(app)
+    missing = missing_vendor_assets(app.static_folder)
+    if missing:
+        logger.log(logging.WARNING if pipeline.cdn_fallback else logging.ERROR,
+                   "%d third-party assets are not vendored (%s); %s. Run `flask vendor-assets` to fetch them.",
+                   len(missing), ", ".join(missing),
+                   "pages load them from their CDNs" if pipeline.cdn_fallback else "they will 404")
+    app.jinja_env.globals["asset_url"] = pipeline.url
+
+    @app.route("/assets/<path:filename>")
+    def hashed_asset(filename):
+        return pipeline.response(filename)
+
+    # Registered before the app's other hooks, so it sees their final response
+    @app.after_request
+    def compress_response(response):
+        if (not app.config['ASSETS_COMPRESS'] or response.direct_passthrough or response.is_streamed
+                or response.mimetype not in COMPRESSIBLE or "Content-Encoding" in response.headers
+                or request.endpoint == "hashed_asset"):
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.mimetype == "text/html" and request.method in ("GET", "HEAD") and response.status_code == 200:
+            # Pages differ per player, so they are revalidated every time
+            response.headers["Cache-Control"] = "private, no-cache"
+            if not g.get("skip_etag"):
+                response.add_etag(weak=True)
+                response = response.make_conditional(request)
+                if response.status_code == 304:
+                    return response
+        body = response.get_data()
+        encoding = negotiate_encoding() if len(body) >= app.config['ASSETS_COMPRESS_MIN_SIZE'] else None
+        if encoding:
+            response.set_data(compress(body, encoding, app.config['ASSETS_COMPRESS_LEVEL']))
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+    @app.cli.command("vendor-assets")
+    @click.option("--force", is_flag=True, help="Download again even if the file is already vendored.")
+    @click.option("--check", is_flag=True, help="Download nothing; fail if any file is not vendored.")
+    def vendor_assets_command(force, check):
+        """Download the third-party CSS/JS into static/vendor/."""
+        if check:
+            missing = missing_vendor_assets(app.static_folder)
+            if missing:
+                raise click.ClickException(f"Not vendored: {', '.join(missing)}")
+            click.echo(f"All {len(VENDOR_ASSETS)} third-party assets are vendored.")
+            return
+        written = vendor_assets(app.static_folder, force)
+        for path in written:
+            click.echo(f"Wrote {path}")
+        click.echo(f"{len(written)} files downloaded; {len(VENDOR_ASSETS) - len(written)} already vendored.")
+
+    return pipeline
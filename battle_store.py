@@ -0,0 +1,215 @@
+import copy, json, sqlite3, threading, time, uuid
+from collections import deque
+
+# -------------------------------
+# Server-side battle state
+# -------------------------------
+# The session cookie only carries a battle ID. The enemy/turn state and the
+# battle log live here, and the log is a ring buffer capped at `log_limit`
+# lines so a long fight costs the same per request as a short one.
+
+
+class BattleStore:
+    def __init__(self, log_limit=100):
+        self.log_limit = log_limit
+
+    def new_id(self):
+        return uuid.uuid4().hex
+
+    def create(self, state):
+        battle_id = self.new_id()
+        self.save(battle_id, state)
+        return battle_id
+
+    def update(self, battle_id, state, lines):
+        # End-of-turn write: new state plus the turn's log lines
+        self.save(battle_id, state)
+        self.append_log(battle_id, lines)
+
+    def prune(self, older_than):
+        # Drops battles not written since `older_than` (Unix time); returns how many
+        stale = self.stale_ids(older_than)
+        for battle_id in stale:
+            self.delete(battle_id)
+        return len(stale)
+
+    def log_page(self, battle_id, page=1, per_page=20):
+        # Page 1 is the most recent `per_page` lines; lines within a page are
+        # returned oldest first so templates can render them top to bottom.
+        total = self.log_size(battle_id)
+        pages = max(1, -(-total // per_page))
+        page = min(max(1, page), pages)
+        end = total - (page - 1) * per_page
+        start = max(0, end - per_page)
+        return self.log_slice(battle_id, start, end), page, pages
+
+    # Backends implement these
+    def get(self, battle_id):
+        raise NotImplementedError
+
+    def save(self, battle_id, state):
+        raise NotImplementedError
+
+    def delete(self, battle_id):
+        raise NotImplementedError
+
+    def append_log(self, battle_id, lines):
+        raise NotImplementedError
+
+    def stale_ids(self, older_than):
+        raise NotImplementedError
+
+    def log_size(self, battle_id):
+        raise NotImplementedError
+
+    def log_slice(self, battle_id, start, end):
+        raise NotImplementedError
+
+
+class MemoryBattleStore(BattleStore):
+    # Per-process; use the SQLite backend when running several workers.
+    def __init__(self, log_limit=100):
+        super().__init__(log_limit)
+        self._states = {}
+        self._updated = {}
+        self._logs = {}
+        self._lock = threading.Lock()
+
+    def get(self, battle_id):
+        with self._lock:
+            state = self._states.get(battle_id)
+            return copy.deepcopy(state) if state is not None else None
+
+    def save(self, battle_id, state):
+        with self._lock:
+            self._states[battle_id] = copy.deepcopy(state)
+            self._updated[battle_id] = time.time()
+
+    def delete(self, battle_id):
+        with self._lock:
+            self._states.pop(battle_id, None)
+            self._updated.pop(battle_id, None)
+            self._logs.pop(battle_id, None)
+
+    def stale_ids(self, older_than):
+        with self._lock:
+            return [battle_id for battle_id, updated in self._updated.items() if updated < older_than]
+
+    def append_log(self, battle_id, lines):
+        with self._lock:
+            log = self._logs.get(battle_id)
+            if log is None:
+                log = self._logs[battle_id] = deque(maxlen=self.log_limit)
+            log.extend(lines)
+
+    def log_size(self, battle_id):
+        with self._lock:
+            return len(self._logs.get(battle_id, ()))
+
+    def log_slice(self, battle_id, start, end):
+        with self._lock:
+            log = self._logs.get(battle_id, ())
+            return [log[i] for i in range(start, min(end, len(log)))]
+
+
+class SqliteBattleStore(BattleStore):
+    # Shared across worker processes through one SQLite file. Log lines carry
+    # an increasing sequence number; appends drop everything older than the
+    # newest `log_limit` lines.
+    def __init__(self, path, log_limit=100, wal=False):
+        super().__init__(log_limit)
+        self.path = path
+        self.wal = wal
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS battle_state (
+                    id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_battle_state_updated_at ON battle_state (updated_at);
+                CREATE TABLE IF NOT EXISTS battle_log (
+                    battle_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    line TEXT NOT NULL,
+                    PRIMARY KEY (battle_id, seq)
+                ) WITHOUT ROWID;
+            """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            if self.wal:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, battle_id):
+        row = self._conn().execute("SELECT state FROM battle_state WHERE id = ?", (battle_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, battle_id, state):
+        with self._conn() as conn:
+            self._save(conn, battle_id, state)
+
+    def update(self, battle_id, state, lines):
+        # One transaction for both writes
+        with self._conn() as conn:
+            self._save(conn, battle_id, state)
+            self._append(conn, battle_id, lines)
+
+    def _save(self, conn, battle_id, state):
+        conn.execute(
+            "INSERT OR REPLACE INTO battle_state (id, state, updated_at) VALUES (?, ?, ?)",
+            (battle_id, json.dumps(state), time.time()),
+        )
+
+    def delete(self, battle_id):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM battle_state WHERE id = ?", (battle_id,))
+            conn.execute("DELETE FROM battle_log WHERE battle_id = ?", (battle_id,))
+
+    def append_log(self, battle_id, lines):
+        with self._conn() as conn:
+            self._append(conn, battle_id, lines)
+
+    def prune(self, older_than):
+        with self._conn() as conn:
+            stale = "SELECT id FROM battle_state WHERE updated_at < ?"
+            conn.execute(f"DELETE FROM battle_log WHERE battle_id IN ({stale})", (older_than,))
+            return conn.execute("DELETE FROM battle_state WHERE updated_at < ?", (older_than,)).rowcount
+
+    def _append(self, conn, battle_id, lines):
+        if not lines:
+            return
+        last = conn.execute("SELECT MAX(seq) FROM battle_log WHERE battle_id = ?", (battle_id,)).fetchone()[0]
+        first = (last or 0) + 1
+        conn.executemany(
+            "INSERT INTO battle_log (battle_id, seq, line) VALUES (?, ?, ?)",
+            [(battle_id, first + i, line) for i, line in enumerate(lines)],
+        )
+        conn.execute(
+            "DELETE FROM battle_log WHERE battle_id = ? AND seq <= ?",
+            (battle_id, first + len(lines) - 1 - self.log_limit),
+        )
+
+    def log_size(self, battle_id):
+        return self._conn().execute("SELECT COUNT(*) FROM battle_log WHERE battle_id = ?", (battle_id,)).fetchone()[0]
+
+    def log_slice(self, battle_id, start, end):
+        rows = self._conn().execute(
+            "SELECT line FROM battle_log WHERE battle_id = ? ORDER BY seq LIMIT ? OFFSET ?",
+            (battle_id, max(0, end - start), start),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+
+def create_battle_store(kind, path=None, log_limit=100, wal=False):
+    if kind == "memory":
+        return MemoryBattleStore(log_limit)
+    if kind == "sqlite":
+        return SqliteBattleStore(path, log_limit, wal)
+    raise ValueError(f"Unknown battle store backend: {kind}")
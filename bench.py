@@ -0,0 +1,813 @@
+import argparse, asyncio, json, logging, os, platform, random, statistics, sys, tempfile, threading, time
+import multiprocessing
+import urllib.error, urllib.parse, urllib.request
+from http.cookiejar import CookieJar
+
+# -------------------------------
+# Benchmarks and load harness
+# -------------------------------
+#   python bench.py micro                          combat math micro-benchmarks
+#   python bench.py load --users 8                 routes through Flask's test client
+#   python bench.py load --server --workers 4      routes over HTTP against local workers
+#   python bench.py pvp --matches 200              online PvP: matchmaking + turns, test client
+#   python bench.py pvp --matches 200 --server     ... over HTTP, players hop between workers
+#   python bench.py api --clients 2000             JSON API through the ASGI front end, in process
+#   python bench.py tournament --players 200 --workers 4   round robin on 1 process, then on --workers
+#   python bench.py conflicts --users 16 [--server]   concurrent purchases for one character
+#   python bench.py all --save results.json --baseline baseline.json
+#
+# Every run uses a throwaway SQLite database (and SQLite battle store) in a
+# temp directory, never game.db. --save writes the results as JSON and
+# --baseline compares against an earlier --save, flagging anything slower
+# than --tolerance.
+
+BENCH_SECRET = "bench-secret"
+
+
+def _prepare_environment(tmpdir, tuned=False):
+    # Must run before app is imported: the database location is read at import.
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tmpdir, "bench.db")
+    os.environ["BATTLE_STORE"] = "sqlite"
+    os.environ["BATTLE_STORE_PATH"] = os.path.join(tmpdir, "battle_state.db")
+    os.environ["CHARACTER_POOL_BACKGROUND"] = "0"
+    if tuned:
+        os.environ["SQLITE_TUNED"] = "1"
+
+
+def _load_app():
+    import app as game
+    game.app.secret_key = BENCH_SECRET
+    return game
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+# -------------------------------
+# Micro-benchmarks
+# -------------------------------
+class _Fighter:
+    def __init__(self, race, ability, strength=20):
+        self.race = race
+        self.ability = ability
+        self.strength = strength
+        self.mana = 10 ** 9
+        self.base_health = 10 ** 9
+        self.current_health = 10 ** 6
+
+
+def _time_op(fn, number, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - started)
+    return best / number * 1e9
+
+
+def run_micro(number=20000, repeat=5):
+    game = _load_app()
+    rng = random.Random(1)
+    races = list(game.RACE_STATS)
+    attacker = _Fighter("Demon", "Infernal Rage")
+    defender = _Fighter("Angel", "Heavenly Grace")
+    evolved = _Fighter("Champion Human", "Heroic Rally | Guardian's Shield")
+    from rng import RngStream
+    stream = RngStream(1)
+
+    def gain_exp():
+        character = game.Character()
+        character.gain_exp(rng.randint(0, 5000))
+
+    # A potion-policy fight of ~15 turns against a level-2 Beastman
+    hero = game.Character(seed=1)
+    hero.race, hero.strength, hero.constitution, hero.potions = "Human", 15, 12, 3
+    hero.current_health = hero.base_health = 150
+    foe = game.enemy_from_ref([game.ENEMY_RACES.index("Beastman"), 2, 200, 14])
+
+    # The CPU's reply to the hero in a hotseat match, from a fresh matchup
+    # (new transposition table) or one searched before
+    rival = game.Character(seed=2)
+    rival.race, rival.ability, rival.strength, rival.mana = "Demon", "Infernal Rage", 16, 60
+    rival.current_health = rival.base_health = 140
+    cpu_state = {"turn": 2}
+
+    def cpu_move(difficulty, cold=False):
+        if cold:
+            game.cpu_rules.cache_clear()
+        game.cpu_move(cpu_state, hero, rival, difficulty)
+
+    # The character sheet, served from the fragment cache or rendered afresh
+    def render_index(cold=False):
+        if cold:
+            game.fragment_cache.entries.clear()
+        game.render_template("index.html", character=hero)
+
+    cases = {
+        "calculate_damage": lambda: game.calculate_damage(rng.randint(1, 60), 14),
+        "type_multiplier": lambda: game.type_multiplier(attacker, defender),
+        "type_multiplier_evolved": lambda: game.type_multiplier(evolved, defender),
+        "use_ability": lambda: game.use_ability(_Fighter(rng.choice(races), game.RACE_STATS[rng.choice(races)]["ability"]), defender, stream),
+        "use_ability_evolved": lambda: game.use_ability(evolved, defender, stream),
+        "generate_enemy": lambda: game.generate_enemy(rng.randint(1, 20), stream),
+        "random.randint": lambda: rng.randint(1, 10),
+        "RngStream.randint": lambda: stream.randint(1, 10),
+        "RngStream resume": lambda: RngStream(1, 0, 37),
+        "Character.__init__": lambda: game.Character(),
+        "Character.__init__+gain_exp": gain_exp,
+        "win_odds": lambda: game._win_odds.__wrapped__("potion", 30, hero.race, hero.strength, hero.constitution,
+                                                        hero.current_health, hero.base_health, hero.potions,
+                                                        foe["race"], foe["attack_min"], foe["attack_max"],
+                                                        foe["current_health"]),
+        "win_odds (memoized)": lambda: game.win_odds(hero, foe, "potion"),
+        "cpu_move normal (cold)": lambda: cpu_move("normal", cold=True),
+        "cpu_move normal": lambda: cpu_move("normal"),
+        "cpu_move hard (cold)": lambda: cpu_move("hard", cold=True),
+        "render index.html": render_index,
+        "render index.html (cold)": lambda: render_index(cold=True),
+    }
+    with game.app.test_request_context():
+        results = {}
+        for name, fn in cases.items():
+            n = number if "Character" not in name and "render" not in name else max(1, number // 10)
+            if name == "win_odds" or name.startswith("cpu_move"):
+                n = max(1, number // 1000)
+            results[name] = {"ns_per_op": _time_op(fn, n, repeat), "ops": n}
+    return results
+
+
+# -------------------------------
+# Load scenario (shared by the test-client and HTTP modes)
+# -------------------------------
+# One virtual user: roll a character, look at it, fight, shop, play PvP and
+# occasionally restart. Route keys include the POSTed action so attack,
+# defend and use_potion are timed separately.
+def _scenario(client, rng, iterations, record):
+    def timed(key, method, path, data=None):
+        started = time.perf_counter()
+        status = client.request(method, path, data)
+        record(key, time.perf_counter() - started, status)
+
+    for i in range(iterations):
+        timed("GET /roll", "GET", "/roll")
+        timed("GET /", "GET", "/")
+        timed("GET /battle", "GET", "/battle")
+        for _ in range(5):
+            action = rng.choice(["attack", "attack", "defend", "use_potion"])
+            timed(f"POST /battle[{action}]", "POST", "/battle", {"action": action})
+        timed("GET /shop", "GET", "/shop")
+        timed("POST /shop", "POST", "/shop", {"quantity": str(rng.randint(1, 3))})
+        timed("GET /pvp", "GET", "/pvp")
+        for _ in range(4):
+            action = rng.choice(["attack", "defend", "ability"])
+            timed(f"POST /pvp[{action}]", "POST", "/pvp", {"action": action})
+        if i % 5 == 4:
+            timed("GET /restart", "GET", "/restart")
+
+
+class _TestClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        return self.client.open(path, method=method, data=data).status_code
+
+    def request_json(self, method, path, data=None, headers=None):
+        response = self.client.open(path, method=method, json=data, headers=headers)
+        return response.status_code, response.get_json()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class _HttpClient:
+    def __init__(self, base_urls, rng):
+        # Each request goes to a random worker, like a balancer without sticky
+        # sessions; the signed cookie and SQLite battle store work on any worker.
+        self.base_urls = base_urls
+        self.rng = rng
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        url = self.rng.choice(self.base_urls) + path
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(url, data=body, method=method), timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code
+
+    def request_json(self, method, path, data=None, headers=None):
+        url = self.rng.choice(self.base_urls) + path
+        body = json.dumps(data).encode() if data is not None else None
+        request = urllib.request.Request(url, data=body, method=method,
+                                         headers={"Content-Type": "application/json", **(headers or {})})
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                return response.status, self._json(response)
+        except urllib.error.HTTPError as error:
+            return error.code, self._json(error)
+        except OSError:
+            return 599, None  # connection refused/reset or timed out
+
+    def _json(self, response):
+        body = response.read()
+        return json.loads(body) if response.headers.get_content_type() == "application/json" else None
+
+
+def _run_users(make_client, users, iterations, seed):
+    samples = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def record(key, elapsed, status):
+        with lock:
+            samples.setdefault(key, []).append(elapsed)
+            if status >= 500:
+                errors[key] = errors.get(key, 0) + 1
+
+    def user(n):
+        rng = random.Random(seed + n)
+        _scenario(make_client(rng), rng, iterations, record)
+
+    threads = [threading.Thread(target=user, args=(n,)) for n in range(users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    return _summarize_routes(samples, errors, wall)
+
+
+def _summarize_routes(samples, errors, wall):
+    routes = {}
+    total = 0
+    for key, values in sorted(samples.items()):
+        values.sort()
+        total += len(values)
+        routes[key] = {
+            "count": len(values),
+            "errors": errors.get(key, 0),
+            "rps": len(values) / wall,
+            "mean_ms": statistics.fmean(values) * 1000,
+            "p50_ms": _percentile(values, 50) * 1000,
+            "p95_ms": _percentile(values, 95) * 1000,
+            "p99_ms": _percentile(values, 99) * 1000,
+        }
+    return {"wall_s": wall, "requests": total, "rps": total / wall, "routes": routes}
+
+
+def run_load_client(users=4, iterations=20, seed=1):
+    game = _load_app()
+    with game.app.app_context():
+        game.upgrade_schema()
+        game.refill_character_pool()
+        game.db.session.commit()
+    return _run_users(lambda rng: _TestClient(game.app), users, iterations, seed)
+
+
+def _serve(port):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # no per-request access log
+    game = _load_app()
+    game.app.run(host="127.0.0.1", port=port, threaded=True, use_reloader=False)
+
+
+def _wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except urllib.error.HTTPError:
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Worker at {url} did not start")
+
+
+def run_load_server(workers=2, users=8, iterations=20, seed=1, base_port=5800):
+    game = _load_app()
+    with game.app.app_context():
+        game.upgrade_schema()
+        game.refill_character_pool(users * iterations * 3)
+        game.db.session.commit()
+    base_urls, processes = _start_workers(workers, base_port)
+    try:
+        result = _run_users(lambda rng: _HttpClient(base_urls, rng), users, iterations, seed)
+    finally:
+        _stop_workers(processes)
+    result["workers"] = workers
+    return result
+
+
+def _start_workers(workers, base_port):
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_serve, args=(base_port + i,), daemon=True) for i in range(workers)]
+    for process in processes:
+        process.start()
+    base_urls = [f"http://127.0.0.1:{base_port + i}" for i in range(workers)]
+    try:
+        for url in base_urls:
+            _wait_for(url + "/restart")
+    except RuntimeError:
+        _stop_workers(processes)
+        raise
+    return base_urls, processes
+
+
+def _stop_workers(processes):
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+# -------------------------------
+# Online PvP load test
+# -------------------------------
+# 2 x `matches` players arrive spread over `ramp_s` seconds: roll a
+# character, queue, poll every `poll_s` until paired, then play until
+# someone wins (or forfeit after `max_turns` of their own moves). Checks that every player ends up in exactly one match
+# and that both players of a match agree on its result.
+def _pvp_player(client, rng, max_turns, poll_s, record, results, queue_timeout=60):
+    def timed(key, method, path, data=None):
+        started = time.perf_counter()
+        status, body = client.request_json(method, path, data)
+        record(key, time.perf_counter() - started, status)
+        return status, body
+
+    started = time.perf_counter()
+    timed("GET /roll", "GET", "/roll")
+    while True:
+        status, body = timed("POST /pvp/online/queue", "POST", "/pvp/online/queue")
+        if status == 200 and body["status"] == "matched":
+            match = body["match"]
+            break
+        if time.perf_counter() - started > queue_timeout:
+            timed("POST /pvp/online/leave", "POST", "/pvp/online/leave")
+            results.append({"match_id": None, "side": None, "result": "unmatched",
+                            "wait_s": queue_timeout, "conflicts": 0})
+            return
+        time.sleep(poll_s)
+    waited = time.perf_counter() - started
+    path = f"/pvp/online/match/{match['match_id']}"
+    moves = 0
+    conflicts = 0
+    while match["result"] is None:
+        if not match["your_turn"]:
+            time.sleep(poll_s)
+            status, body = timed("GET /pvp/online/match", "GET", path)
+            match = body if status == 200 else match
+            continue
+        moves += 1
+        action = "forfeit" if moves > max_turns else rng.choice(["attack", "attack", "defend", "ability"])
+        status, body = timed(f"POST /pvp/online/match[{action}]", "POST", path, {"action": action})
+        if status == 409:
+            conflicts += 1
+            match = body.get("match", match)
+        elif status == 200:
+            match = body
+    results.append({"match_id": match["match_id"], "side": match["side"], "result": match["result"],
+                    "wait_s": waited, "conflicts": conflicts})
+
+
+def _run_pvp(make_client, matches, max_turns, poll_s, ramp_s, seed):
+    samples = {}
+    errors = {}
+    results = []
+    lock = threading.Lock()
+
+    def record(key, elapsed, status):
+        with lock:
+            samples.setdefault(key, []).append(elapsed)
+            if status >= 500:
+                errors[key] = errors.get(key, 0) + 1
+
+    def player(n):
+        rng = random.Random(seed + n)
+        time.sleep(rng.uniform(0, ramp_s))
+        _pvp_player(make_client(rng), rng, max_turns, poll_s, record, results)
+
+    threads = [threading.Thread(target=player, args=(n,)) for n in range(2 * matches)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = _summarize_routes(samples, errors, time.perf_counter() - started)
+
+    by_match = {}
+    for r in results:
+        if r["match_id"] is not None:
+            by_match.setdefault(r["match_id"], []).append(r)
+    consistent = sum(1 for players in by_match.values()
+                     if len(players) == 2 and {p["side"] for p in players} == {1, 2}
+                     and {p["result"] for p in players} == {"won", "lost"})
+    waits = sorted(r["wait_s"] for r in results)
+    result["pvp"] = {
+        "players": len(results), "matches": len(by_match), "consistent_matches": consistent,
+        "unmatched": sum(1 for r in results if r["match_id"] is None),
+        "conflicts": sum(r["conflicts"] for r in results),
+        "wait_p50_s": _percentile(waits, 50), "wait_p95_s": _percentile(waits, 95),
+    }
+    return result
+
+
+def run_pvp_client(matches=100, max_turns=15, poll_s=1.0, ramp_s=10.0, seed=1):
+    game = _load_app()
+    with game.app.app_context():
+        game.upgrade_schema()
+        game.refill_character_pool(2 * matches + 10)
+        game.db.session.commit()
+    return _run_pvp(lambda rng: _TestClient(game.app), matches, max_turns, poll_s, ramp_s, seed)
+
+
+def run_pvp_server(workers=2, matches=100, max_turns=15, poll_s=1.0, ramp_s=10.0, seed=1, base_port=5800):
+    game = _load_app()
+    with game.app.app_context():
+        game.upgrade_schema()
+        game.refill_character_pool(2 * matches + 10)
+        game.db.session.commit()
+    base_urls, processes = _start_workers(workers, base_port)
+    try:
+        result = _run_pvp(lambda rng: _HttpClient(base_urls, rng), matches, max_turns, poll_s, ramp_s, seed)
+    finally:
+        _stop_workers(processes)
+    result["workers"] = workers
+    return result
+
+
+# -------------------------------
+# JSON API through the ASGI front end
+# -------------------------------
+# Every client is a coroutine on one event loop calling asgi.application
+# directly (no sockets), so --clients requests are in flight at once while
+# the app's API_THREADS threads do the work. Each client creates a character,
+# then fetches it, plays a batch of battle actions and shops per iteration.
+async def _asgi_request(application, method, path, body=None, token=None):
+    payload = json.dumps(body).encode() if body is not None else b""
+    path, _, query = path.partition("?")
+    headers = [(b"content-type", b"application/json")]
+    if token:
+        headers.append((b"authorization", f"Bearer {token}".encode()))
+    scope = {"type": "http", "http_version": "1.1", "method": method, "scheme": "http", "path": path,
+             "query_string": query.encode(), "root_path": "", "headers": headers,
+             "server": ("bench", 80), "client": ("127.0.0.1", 0)}
+    sent = [{"type": "http.request", "body": payload, "more_body": False}]
+    response = {"body": b""}
+
+    async def receive():
+        if sent:
+            return sent.pop()
+        await asyncio.sleep(3600)  # nothing more to send; the stream is cancelled before this ends
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        else:
+            response["body"] += message.get("body", b"")
+
+    await application(scope, receive, send)
+    return response["status"], response["body"]
+
+
+async def _api_client(application, rng, iterations, record):
+    async def timed(key, method, path, body=None, token=None):
+        started = time.perf_counter()
+        status, data = await _asgi_request(application, method, path, body, token)
+        record(key, time.perf_counter() - started, status)
+        return json.loads(data) if status < 500 else None
+
+    created = await timed("POST /api/v1/characters", "POST", "/api/v1/characters", {"count": 1})
+    if not created:
+        return
+    token = created["characters"][0]["token"]
+    for _ in range(iterations):
+        await timed("GET /api/v1/character", "GET", "/api/v1/character", token=token)
+        actions = [rng.choice(["attack", "attack", "defend", "use_potion"]) for _ in range(5)]
+        await timed("POST /api/v1/battle[5]", "POST", "/api/v1/battle", {"actions": actions}, token)
+        await timed("POST /api/v1/shop", "POST", "/api/v1/shop", {"quantity": rng.randint(1, 3)}, token)
+
+
+def run_api(clients=1000, iterations=3, seed=1):
+    game = _load_app()
+    with game.app.app_context():
+        game.upgrade_schema()
+        game.refill_character_pool()
+        game.db.session.commit()
+    import asgi
+    samples, errors = {}, {}
+
+    def record(key, elapsed, status):
+        samples.setdefault(key, []).append(elapsed)
+        if status >= 500:
+            errors[key] = errors.get(key, 0) + 1
+
+    async def main():
+        await asyncio.gather(*(_api_client(asgi.application, random.Random(seed + n), iterations, record)
+                               for n in range(clients)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    return _summarize_routes(samples, errors, time.perf_counter() - started)
+
+
+# -------------------------------
+# Tournament runner scaling
+# -------------------------------
+def run_tournament(players=200, workers=4, seed=1):
+    # The same round robin on one process and on `workers`; nothing is saved
+    game = _load_app()
+    import tournament
+    rows = game.roll_character_rows(players)
+    roster = tournament.Roster((n, r["race"], r["ability"], r["level"], r["strength"], r["base_health"], r["mana"])
+                               for n, r in enumerate(rows, 1))
+    result = {"players": players, "runs": {}}
+    for count in sorted({1, workers}):
+        started = time.perf_counter()
+        _, _, matches = tournament.run_tournament(roster, seed=seed, workers=count)
+        elapsed = time.perf_counter() - started
+        result["runs"][count] = {"matches": len(matches["number"]), "wall_s": elapsed,
+                                 "matches_per_s": len(matches["number"]) / elapsed}
+    result["speedup"] = result["runs"][workers]["matches_per_s"] / result["runs"][1]["matches_per_s"]
+    return result
+
+
+# -------------------------------
+# Concurrent updates to one character
+# -------------------------------
+# `users` threads buy one potion at a time for the same character, each
+# purchase with its own Idempotency-Key; `repeat` of them are sent a second
+# time (by another thread, so often while the first is still running). The
+# character starts with gold for half of the purchases. Afterwards its
+# potions must have gone up by exactly the number of keys that got a 200,
+# and its gold down by that many potions' worth: no lost update, no purchase
+# applied twice, no gold spent that wasn't there.
+def _conflict_user(client, rng, token, iterations, repeat, shared, record, outcomes):
+    def buy(key, label):
+        started = time.perf_counter()
+        status, body = client.request_json("POST", "/api/v1/shop", {"quantity": 1},
+                                           {"Authorization": f"Bearer {token}", "Idempotency-Key": key})
+        record(label, time.perf_counter() - started, status)
+        with shared["lock"]:
+            outcomes.setdefault(key, []).append((status, body))
+
+    for _ in range(iterations):
+        key = f"{rng.getrandbits(64):016x}"
+        with shared["lock"]:
+            shared["keys"].append(key)
+            again = rng.choice(shared["keys"]) if rng.random() < repeat else None
+        buy(key, "POST /api/v1/shop")
+        if again is not None:
+            buy(again, "POST /api/v1/shop (repeat)")
+
+
+def _run_conflicts(make_client, game, character, users, iterations, repeat, seed, flush):
+    samples, errors = {}, {}
+    shared = {"lock": threading.Lock(), "keys": []}
+    outcomes = {}
+
+    def record(key, elapsed, status):
+        with shared["lock"]:
+            samples.setdefault(key, []).append(elapsed)
+            if status >= 500:
+                errors[key] = errors.get(key, 0) + 1
+
+    def user(n):
+        rng = random.Random(seed + n)
+        _conflict_user(make_client(rng), rng, character["token"], iterations, repeat, shared, record, outcomes)
+
+    threads = [threading.Thread(target=user, args=(n,)) for n in range(users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = _summarize_routes(samples, errors, time.perf_counter() - started)
+
+    with game.app.app_context():
+        if flush:
+            game.character_cache.flush()
+        row = game.db.session.execute(game.db.select(game.Character.gold, game.Character.potions).where(
+            game.Character.id == character["id"])).one()
+    counts = {"bought": 0, "refused": 0, "conflicts": 0, "failed": 0}
+    for attempts in outcomes.values():
+        # A key's purchase happened if any of its requests got a 200
+        if any(status == 200 for status, _ in attempts):
+            counts["bought"] += 1
+        elif any(status == 409 and body and body["error"].startswith("Someone else") for status, body in attempts):
+            counts["conflicts"] += 1
+        elif any(status == 409 for status, _ in attempts):
+            counts["refused"] += 1
+        else:
+            counts["failed"] += 1
+    bought = counts["bought"]
+    result["conflicts"] = {
+        "purchases": len(outcomes),
+        **counts,
+        "potions_added": row.potions - character["potions"],
+        "gold_spent": character["gold"] - row.gold,
+        "consistent": (row.potions - character["potions"] == bought and row.gold >= 0
+                       and character["gold"] - row.gold == bought * game.POTION_COST),
+    }
+    return result
+
+
+def _conflict_character(game, purchases):
+    with game.app.app_context():
+        game.upgrade_schema()
+        game.refill_character_pool()
+        game.db.session.commit()
+    status, body = _TestClient(game.app).request_json("POST", "/api/v1/characters", {"count": 1})
+    created = body["characters"][0]
+    char_id = created["character"]["id"]
+    gold = game.POTION_COST * (purchases // 2)
+    with game.app.app_context():
+        if game.character_cache is not None:
+            game.character_cache.invalidate([char_id])
+        game.db.session.execute(game.db.update(game.Character).where(game.Character.id == char_id).values(
+            gold=gold, version=game.Character.version + 1))
+        game.db.session.commit()
+    return {"id": char_id, "token": created["token"], "gold": gold, "potions": created["character"]["potions"]}
+
+
+def run_conflicts_client(users=16, iterations=20, repeat=0.25, seed=1):
+    game = _load_app()
+    character = _conflict_character(game, users * iterations)
+    return _run_conflicts(lambda rng: _TestClient(game.app), game, character, users, iterations, repeat, seed,
+                          flush=game.character_cache is not None)
+
+
+def run_conflicts_server(workers=2, users=16, iterations=20, repeat=0.25, seed=1, base_port=5800):
+    # Purchases write gold and potions through (CACHE_FORCED_COLUMNS), so the
+    # database is current when the workers stop
+    game = _load_app()
+    character = _conflict_character(game, users * iterations)
+    base_urls, processes = _start_workers(workers, base_port)
+    try:
+        result = _run_conflicts(lambda rng: _HttpClient(base_urls, rng), game, character, users, iterations,
+                                repeat, seed, flush=False)
+    finally:
+        _stop_workers(processes)
+    result["workers"] = workers
+    return result
+
+
+# -------------------------------
+# Reporting and baseline comparison
+# -------------------------------
+def _print_micro(results):
+    print("\nMicro-benchmarks (best of repeats)")
+    for name, r in results.items():
+        print(f"  {name:32s} {r['ns_per_op']:12,.0f} ns/op")
+
+
+def _print_load(title, result):
+    print(f"\n{title}: {result['requests']} requests in {result['wall_s']:.2f}s ({result['rps']:,.0f} req/s)")
+    print(f"  {'route':34s} {'count':>6s} {'err':>4s} {'req/s':>8s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s}")
+    for key, r in result["routes"].items():
+        print(f"  {key:34s} {r['count']:6d} {r['errors']:4d} {r['rps']:8.1f} "
+              f"{r['p50_ms']:8.2f} {r['p95_ms']:8.2f} {r['p99_ms']:8.2f}")
+
+
+def _print_pvp(result):
+    pvp = result["pvp"]
+    print(f"  {pvp['players']} players in {pvp['matches']} matches, {pvp['consistent_matches']} consistent, "
+          f"{pvp['unmatched']} never paired; "
+          f"{pvp['conflicts']} turn conflicts; queue wait p50 {pvp['wait_p50_s'] * 1000:.0f} ms, "
+          f"p95 {pvp['wait_p95_s'] * 1000:.0f} ms")
+
+
+def _print_tournament(result):
+    print(f"\nRound robin, {result['players']} players")
+    for count, run in result["runs"].items():
+        print(f"  {count:3d} workers: {run['matches']} matches in {run['wall_s']:.2f}s "
+              f"({run['matches_per_s']:,.0f} matches/s)")
+    print(f"  speedup {result['speedup']:.2f}x on {os.cpu_count()} CPUs")
+
+
+def _print_conflicts(result):
+    c = result["conflicts"]
+    print(f"  {c['purchases']} purchases: {c['bought']} bought, {c['refused']} refused (no gold), "
+          f"{c['conflicts']} gave up after retries, {c['failed']} failed")
+    print(f"  potions +{c['potions_added']}, gold -{c['gold_spent']}: "
+          f"{'consistent' if c['consistent'] else 'INCONSISTENT'}")
+
+
+def compare(results, baseline, tolerance=0.10):
+    # Lower is better for latencies/ns, higher for throughput. Returns the
+    # list of regressions as (metric, baseline, current, change).
+    regressions = []
+    rows = []
+    for name, r in results.get("micro", {}).items():
+        old = baseline.get("micro", {}).get(name)
+        if old:
+            rows.append((f"micro {name} ns/op", old["ns_per_op"], r["ns_per_op"], False))
+    for mode, result in results.get("load", {}).items():
+        old_mode = baseline.get("load", {}).get(mode, {})
+        if old_mode:
+            rows.append((f"{mode} total req/s", old_mode["rps"], result["rps"], True))
+        for key, r in result["routes"].items():
+            old = old_mode.get("routes", {}).get(key)
+            if old:
+                rows.append((f"{mode} {key} p95 ms", old["p95_ms"], r["p95_ms"], False))
+    print(f"\nCompared with baseline (tolerance {tolerance:.0%})")
+    for metric, old, new, higher_is_better in rows:
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = "REGRESSION" if worse > tolerance else ("improved" if worse < -tolerance else "")
+        print(f"  {metric:48s} {old:12.2f} -> {new:12.2f} {change:+8.1%} {flag}")
+        if flag == "REGRESSION":
+            regressions.append((metric, old, new, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks and load tests for the game")
+    parser.add_argument("suite", choices=["micro", "load", "pvp", "api", "tournament", "conflicts", "all"])
+    parser.add_argument("--server", action="store_true", help="load: drive local HTTP workers instead of the test client")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--users", type=int, default=4, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=20, help="scenario loops per user")
+    parser.add_argument("--matches", type=int, default=100, help="pvp: simultaneous matches")
+    parser.add_argument("--max-turns", type=int, default=15, help="pvp: own moves before forfeiting")
+    parser.add_argument("--poll", type=float, default=1.0, help="pvp: seconds between polls")
+    parser.add_argument("--ramp", type=float, default=10.0, help="pvp: seconds over which players arrive")
+    parser.add_argument("--clients", type=int, default=1000, help="api: concurrent clients")
+    parser.add_argument("--players", type=int, default=200, help="tournament: round-robin field size")
+    parser.add_argument("--repeat", type=float, default=0.25, help="conflicts: share of purchases sent twice")
+    parser.add_argument("--number", type=int, default=20000, help="micro: calls per repeat")
+    parser.add_argument("--tuned", action="store_true", help="enable the SQLITE_TUNED profile")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write results JSON here")
+    parser.add_argument("--baseline", help="compare against this results JSON")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix="rpg-bench-")
+    _prepare_environment(tmpdir, args.tuned)
+    results = {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                        "time": time.time(), "args": vars(args)}}
+    if args.suite in ("micro", "all"):
+        results["micro"] = run_micro(args.number)
+        _print_micro(results["micro"])
+    if args.suite in ("load", "all"):
+        results["load"] = {}
+        if args.server or args.suite == "all":
+            result = run_load_server(args.workers, args.users, args.iterations, args.seed)
+            results["load"]["server"] = result
+            _print_load(f"HTTP, {args.workers} workers, {args.users} users", result)
+        if not args.server or args.suite == "all":
+            result = run_load_client(args.users, args.iterations, args.seed)
+            results["load"]["test_client"] = result
+            _print_load(f"Test client, {args.users} users", result)
+    if args.suite == "pvp":
+        if args.server:
+            result = run_pvp_server(args.workers, args.matches, args.max_turns, args.poll, args.ramp, args.seed)
+            title = f"Online PvP over HTTP, {args.workers} workers, {args.matches} matches"
+        else:
+            result = run_pvp_client(args.matches, args.max_turns, args.poll, args.ramp, args.seed)
+            title = f"Online PvP, test client, {args.matches} matches"
+        results["load"] = {"pvp_server" if args.server else "pvp_client": result}
+        _print_load(title, result)
+        _print_pvp(result)
+    if args.suite == "api":
+        result = run_api(args.clients, args.iterations, args.seed)
+        results["load"] = {"api": result}
+        _print_load(f"JSON API via ASGI, {args.clients} concurrent clients", result)
+    if args.suite == "tournament":
+        results["tournament"] = run_tournament(args.players, args.workers, args.seed)
+        _print_tournament(results["tournament"])
+    if args.suite == "conflicts":
+        if args.server:
+            result = run_conflicts_server(args.workers, args.users, args.iterations, args.repeat, args.seed)
+            title = f"Concurrent purchases over HTTP, {args.workers} workers, {args.users} users"
+        else:
+            result = run_conflicts_client(args.users, args.iterations, args.repeat, args.seed)
+            title = f"Concurrent purchases, test client, {args.users} users"
+        results["load"] = {"conflicts_server" if args.server else "conflicts_client": result}
+        _print_load(title, result)
+        _print_conflicts(result)
+        if not result["conflicts"]["consistent"]:
+            sys.exit(1)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
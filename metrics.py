@@ -0,0 +1,213 @@
+import threading, time
+from bisect import bisect_left
+
+from flask import g, request, Response
+from jinja2 import Template
+from sqlalchemy import event
+
+# -------------------------------
+# Request / SQL / template instrumentation
+# -------------------------------
+# Histograms and counters are kept per process and exposed in the Prometheus
+# text format on /metrics. Recording one sample is a bisect and two additions
+# under a lock, so it can stay on under load; set METRICS_ENABLED=0 to skip
+# installing any of the hooks (and the endpoint).
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 2048, 3072, 4096)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label_names = label_names
+        self._series = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for label_values, series in items:
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_label_text(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_label_text(labels + [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_label_text(labels)} {_format(series[-2])}")
+            lines.append(f"{self.name}_count{_label_text(labels)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_label_text(list(zip(self.label_names, label_values)))} {_format(value)}")
+        return lines
+
+
+class CallbackMetric:
+    # Read at scrape time: `collect()` returns {label values: value}
+    def __init__(self, name, help_text, kind, collect, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.collect = collect
+        self.label_names = label_names
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_label_text(list(zip(self.label_names, label_values)))} {_format(value)}")
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        self.request_seconds = Histogram(
+            "rpg_request_duration_seconds", "Time spent handling a request, by route.",
+            LATENCY_BUCKETS, ("endpoint", "method", "status"))
+        self.sql_statements = Counter(
+            "rpg_sql_statements_total", "SQL statements executed, by route and verb.", ("endpoint", "verb"))
+        self.sql_seconds = Histogram(
+            "rpg_sql_duration_seconds", "Time spent in individual SQL statements.", LATENCY_BUCKETS, ("verb",))
+        self.sql_per_request = Histogram(
+            "rpg_sql_statements_per_request", "SQL statements issued by one request.",
+            (0, 1, 2, 3, 5, 8, 13, 21), ("endpoint",))
+        self.template_seconds = Histogram(
+            "rpg_template_render_seconds", "Jinja render time, by template.", LATENCY_BUCKETS, ("template",))
+        self.session_save_seconds = Histogram(
+            "rpg_session_save_seconds", "Time spent serializing and signing the session cookie.", LATENCY_BUCKETS)
+        self.session_bytes = Histogram(
+            "rpg_session_cookie_bytes", "Size of the session cookie sent to the browser.", SIZE_BUCKETS, ("endpoint",))
+        self.all = [self.request_seconds, self.sql_statements, self.sql_seconds, self.sql_per_request,
+                    self.template_seconds, self.session_save_seconds, self.session_bytes]
+
+    def register(self, metric):
+        self.all.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self.all:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _endpoint():
+    try:
+        return request.endpoint or "unmatched"
+    except RuntimeError:  # outside a request (CLI, background threads)
+        return None
+
+
+def init_metrics(app, db):
+    metrics = Metrics()
+    local = threading.local()
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql = 0
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            endpoint = request.endpoint or "unmatched"
+            metrics.request_seconds.observe(time.perf_counter() - started, endpoint, request.method, response.status_code)
+            metrics.sql_per_request.observe(g.pop("metrics_sql", 0), endpoint)
+        return response
+
+    # SQL: count and time every statement on the app's engine
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_sql_timer(conn, cursor, statement, parameters, context, executemany):
+        local.sql_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def record_sql(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - getattr(local, "sql_started", time.perf_counter())
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+        metrics.sql_seconds.observe(elapsed, verb)
+        endpoint = _endpoint()
+        if endpoint is not None:
+            metrics.sql_statements.inc(1, endpoint, verb)
+            if "metrics_sql" in g:
+                g.metrics_sql += 1
+
+    # Templates: time the top-level render (includes extended base templates)
+    class TimedTemplate(Template):
+        def render(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return super().render(*args, **kwargs)
+            finally:
+                metrics.template_seconds.observe(time.perf_counter() - started, self.name or "<string>")
+
+    app.jinja_env.template_class = TimedTemplate
+
+    # Session: time the serialize+sign step and measure the resulting cookie
+    session_interface = app.session_interface
+    save_session = session_interface.save_session
+
+    def timed_save_session(app_, session_, response):
+        started = time.perf_counter()
+        save_session(app_, session_, response)
+        metrics.session_save_seconds.observe(time.perf_counter() - started)
+        cookie_name = app_.config["SESSION_COOKIE_NAME"]
+        for header in response.headers.getlist("Set-Cookie"):
+            if header.startswith(cookie_name + "="):
+                metrics.session_bytes.observe(len(header.split(";", 1)[0]) - len(cookie_name) - 1, _endpoint() or "none")
+
+    session_interface.save_session = timed_save_session
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    app.extensions["rpg_metrics"] = metrics
+    return metrics
@@ -0,0 +1,148 @@
+import cProfile, hmac, os, pstats, re, threading, time, tracemalloc
+from collections import defaultdict
+
+import click
+from werkzeug.exceptions import HTTPException
+
+# -------------------------------
+# On-demand request profiling
+# -------------------------------
+# Wraps the WSGI app so a sampled request is profiled end to end (routing,
+# view, template, commit, session cookie). One in PROFILE_SAMPLE_RATE
+# requests per endpoint is profiled when PROFILE_ENABLED is set; a request
+# carrying the PROFILE_HEADER_TOKEN in X-Profile-Token is always profiled.
+# Each profile is written as a pstats file (plus a tracemalloc snapshot when
+# PROFILE_TRACEMALLOC is set) and only the newest PROFILE_KEEP files are kept.
+# Endpoints in PROFILE_EXCLUDE (long-lived streams) are never profiled, since
+# profiling collects the whole response before sending it.
+
+PROFILE_HEADER = "HTTP_X_PROFILE_TOKEN"
+
+
+class RequestProfiler:
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.directory = app.config['PROFILE_DIR']
+        self._seen = defaultdict(int)
+        self._lock = threading.Lock()
+        self._tracemalloc_lock = threading.Lock()   # tracemalloc is process-wide
+        os.makedirs(self.directory, exist_ok=True)
+
+    def endpoint(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return "unmatched"
+        return endpoint
+
+    def should_profile(self, environ, endpoint):
+        if endpoint in self.app.config.get('PROFILE_EXCLUDE', ()):
+            return False
+        token = self.app.config['PROFILE_HEADER_TOKEN']
+        if token and hmac.compare_digest(environ.get(PROFILE_HEADER, ""), token):
+            return True
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if not self.app.config['PROFILE_ENABLED'] or rate <= 0:
+            return False
+        with self._lock:
+            self._seen[endpoint] += 1
+            return self._seen[endpoint] % rate == 0
+
+    def __call__(self, environ, start_response):
+        endpoint = self.endpoint(environ)
+        if not self.should_profile(environ, endpoint):
+            return self.wsgi_app(environ, start_response)
+
+        trace = self.app.config['PROFILE_TRACEMALLOC'] and self._tracemalloc_lock.acquire(blocking=False)
+        started_tracing = False
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            started_tracing = True
+        profile = cProfile.Profile()
+        try:
+            response = profile.runcall(self.run, environ, start_response)
+        finally:
+            snapshot = tracemalloc.take_snapshot() if trace else None
+            if started_tracing:
+                tracemalloc.stop()
+            if trace:
+                self._tracemalloc_lock.release()
+            self.dump(endpoint, environ.get("REQUEST_METHOD", "GET"), profile, snapshot)
+        return response
+
+    def run(self, environ, start_response):
+        # Consume and close the body inside the profile so streamed responses count too
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            return list(iterable)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    def dump(self, endpoint, method, profile, snapshot):
+        stem = os.path.join(self.directory, f"{time.time():.6f}-{os.getpid()}-{method}-{endpoint}")
+        profile.dump_stats(stem + ".prof")
+        if snapshot is not None:
+            snapshot.filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]).dump(stem + ".snap")
+        self.rotate()
+
+    def rotate(self):
+        # Oldest first: file names start with the dump time
+        files = sorted(name for name in os.listdir(self.directory) if name.endswith((".prof", ".snap")))
+        for name in files[:max(0, len(files) - self.app.config['PROFILE_KEEP'])]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass   # removed by another worker
+
+
+def list_dumps(directory, suffix, endpoint=None):
+    if not os.path.isdir(directory):
+        return []
+    pattern = re.compile(rf"^[\d.]+-\d+-[A-Z]+-{re.escape(endpoint)}{re.escape(suffix)}$") if endpoint else None
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.endswith(suffix) and (pattern is None or pattern.match(name))]
+
+
+def top_allocations(paths, limit):
+    # Sums allocated bytes per source line across snapshots
+    totals = defaultdict(lambda: [0, 0])
+    for path in paths:
+        for stat in tracemalloc.Snapshot.load(path).statistics("lineno"):
+            frame = stat.traceback[0]
+            total = totals[(frame.filename, frame.lineno)]
+            total[0] += stat.size
+            total[1] += stat.count
+    return sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+
+
+def init_profiler(app):
+    if app.config['PROFILE_ENABLED'] or app.config['PROFILE_HEADER_TOKEN']:
+        app.wsgi_app = RequestProfiler(app, app.wsgi_app)
+
+    @app.cli.command("profile-top")
+    @click.option("--endpoint", default=None, help="Only dumps for this endpoint (e.g. battle, pvp).")
+    @click.option("--sort", default="cumulative", show_default=True, help="pstats sort key (cumulative, tottime, calls...).")
+    @click.option("--limit", default=25, show_default=True)
+    @click.option("--allocations", is_flag=True, help="Show the top allocating lines from tracemalloc snapshots instead.")
+    def profile_top_command(endpoint, sort, limit, allocations):
+        """Show the hottest functions across the saved request profiles."""
+        directory = app.config['PROFILE_DIR']
+        if allocations:
+            paths = list_dumps(directory, ".snap", endpoint)
+            if not paths:
+                raise click.ClickException(f"No allocation snapshots in {directory}.")
+            click.echo(f"Top allocations across {len(paths)} snapshots:")
+            for (filename, lineno), (size, count) in top_allocations(paths, limit):
+                click.echo(f"{size / 1024:10.1f} KiB {count:8d} blocks  {filename}:{lineno}")
+            return
+        paths = list_dumps(directory, ".prof", endpoint)
+        if not paths:
+            raise click.ClickException(f"No profiles in {directory}.")
+        click.echo(f"Aggregated {len(paths)} profiles:")
+        stats = pstats.Stats(*paths)
+        stats.sort_stats(sort).print_stats(limit)
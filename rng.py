@@ -0,0 +1,93 @@
+import secrets, threading
+from collections import OrderedDict
+
+import numpy as np
+
+# -------------------------------
+# Seeded random streams
+# -------------------------------
+# Every character and every battle draws from its own stream instead of the
+# global `random` module. A stream is a PCG64 generator identified by a seed
+# and a stream number (independent sub-streams of one seed), and its position
+# is the number of values drawn so far. Those three integers are all that is
+# stored: PCG64 can jump ahead by any count in O(log n), so a stream resumes
+# exactly where it stopped in the next request, on any worker, and a replay
+# from the seed reproduces every roll.
+#
+# Values are drawn BUFFER_SIZE doubles at a time and handed out from a plain
+# list, so a roll costs a list index and a multiply instead of a call into
+# random.randint.
+
+BUFFER_SIZE = 64
+
+
+def new_seed():
+    return secrets.randbits(63)  # fits a signed 64-bit INTEGER column
+
+
+class RngStream:
+    __slots__ = ("seed", "stream", "_generator", "_buffer", "_next", "_buffered")
+
+    def __init__(self, seed, stream=0, drawn=0):
+        self.seed = seed
+        self.stream = stream
+        bit_generator = np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(stream,)))
+        if drawn:
+            bit_generator.advance(drawn)  # one double per 64-bit output
+        self._generator = np.random.Generator(bit_generator)
+        self._buffer = ()
+        self._next = 0
+        self._buffered = drawn  # values drawn before the current buffer
+
+    @property
+    def drawn(self):
+        return self._buffered + self._next
+
+    def _refill(self):
+        self._buffered += len(self._buffer)
+        self._buffer = self._generator.random(BUFFER_SIZE).tolist()
+
+    def random(self):
+        # Float in [0, 1)
+        i = self._next
+        if i == len(self._buffer):
+            self._refill()
+            i = 0
+        self._next = i + 1
+        return self._buffer[i]
+
+    def randint(self, low, high):
+        # Inclusive on both ends, like random.randint
+        i = self._next
+        if i == len(self._buffer):
+            self._refill()
+            i = 0
+        self._next = i + 1
+        return low + int(self._buffer[i] * (high - low + 1))
+
+    def randrange(self, stop):
+        return self.randint(0, stop - 1)
+
+    def state(self):
+        return [self.seed, self.stream, self.drawn]
+
+
+class StreamCache:
+    # Streams parked between requests, keyed by their saved state. Resuming a
+    # state that is parked here skips re-seeding and the jump; a stream is
+    # handed to one caller at a time (resume removes it).
+    def __init__(self, size=1024):
+        self.size = size
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resume(self, state):
+        with self._lock:
+            stream = self._streams.pop(tuple(state), None)
+        return stream if stream is not None else RngStream(*state)
+
+    def park(self, stream):
+        with self._lock:
+            self._streams[tuple(stream.state())] = stream
+            while len(self._streams) > self.size:
+                self._streams.popitem(last=False)
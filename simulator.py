@@ -0,0 +1,342 @@
+import argparse, json, time
+import numpy as np
+
+from app import RACE_STATS, STAT_VARIANCE, EVOLUTION_MAP, ABILITY_TABLE, primary_ability, race_multiplier
+
+# -------------------------------
+# Headless Monte Carlo battle simulator
+# -------------------------------
+# Every fight in a batch lives in flat NumPy arrays (one array per stat), and
+# each turn draws its random numbers for all still-running fights at once.
+# The rules mirror Character.__init__/gain_exp/evolve, generate_enemy and
+# calculate_damage in app.py, and abilities/type advantages are read straight
+# from the compiled ABILITY_TABLE and TYPE_MATRIX there.
+#
+#   python simulator.py --levels 1-20 --fights 10000
+#   python simulator.py --mode pvp --ability-rate 0.5 --json sweep.json
+
+RACES = list(RACE_STATS.keys())
+LEVEL_STATS = ("strength", "intelligence", "wisdom", "constitution")
+HP_BINS = 10
+
+
+def _randint(rng, low, high, size):
+    # Inclusive on both ends, like random.randint
+    return rng.integers(low, np.asarray(high) + 1, size)
+
+
+def _kaosborne_stats(rng, n):
+    # Vectorized calculate_kaosborne_stat (mult is never 0, so the
+    # 99999999999999 branch cannot fire)
+    mult = rng.integers(1, 102, n)
+    div = rng.integers(1, 4, n)
+    return np.where(div == 1, 100 * mult, 100 // mult)
+
+
+def _evolved_race(race):
+    return EVOLUTION_MAP[race]["race"] if race in EVOLUTION_MAP else race
+
+
+# -------------------------------
+# Vectorized character / enemy rolls
+# -------------------------------
+def roll_characters(race, level, n, rng):
+    # n characters of one race, levelled through gain_exp to `level`
+    stats = RACE_STATS[race]
+    c = {}
+    if race == "Kaosborne":
+        c["base_health"] = _kaosborne_stats(rng, n)
+        c["speed"] = _kaosborne_stats(rng, n)
+    else:
+        c["base_health"] = np.full(n, stats["base_health"], dtype=np.int64)
+        c["speed"] = np.full(n, stats["speed"], dtype=np.int64)
+    for stat in ("mana",) + LEVEL_STATS:
+        c[stat] = np.full(n, stats[stat], dtype=np.int64)
+    for stat, bounds in STAT_VARIANCE.get(race, {}).items():
+        c[stat] = c[stat] + _randint(rng, bounds[0], bounds[1], n)
+
+    # Each level-up adds +2 to the four core stats and +20 HP, then heals fully
+    gained = level - 1
+    for stat in LEVEL_STATS:
+        c[stat] = c[stat] + 2 * gained
+    c["base_health"] = c["base_health"] + 20 * gained
+    c["current_health"] = c["base_health"].copy()
+
+    ability = stats["ability"]
+    if level >= 10 and race in EVOLUTION_MAP:
+        evolution = EVOLUTION_MAP[race]
+        for stat in ("base_health", "mana", "speed") + LEVEL_STATS:
+            if race == "Kaosborne":
+                # The Kaosborne lambdas draw a fresh 0/1 each call; draw it per fight
+                c[stat] = c[stat] + rng.integers(0, 2, n) * 100
+            else:
+                c[stat] = evolution[stat](c[stat])
+        if race in ["Demon", "Angel"]:
+            # evolve() resets HP to the template at level 10; levels after it add on top
+            c["base_health"] = np.full(n, stats["base_health"] + 20 * (level - 10), dtype=np.int64)
+        if level > 10:
+            c["current_health"] = c["base_health"].copy()  # the last level-up healed fully
+        # (at exactly level 10, evolve() leaves current_health as it was)
+        ability = evolution["ability"]
+    c["race"] = _evolved_race(race) if level >= 10 else race
+    c["ability"] = ability
+    return c
+
+
+def roll_enemies(race, player_level, n, rng):
+    # Vectorized generate_enemy with the enemy race fixed
+    stats = RACE_STATS[race]
+    if race == "Kaosborne":
+        base_health = _kaosborne_stats(rng, n)
+    else:
+        base_health = np.full(n, stats["base_health"], dtype=np.int64)
+    level = _randint(rng, max(1, player_level - 1), player_level + 1, n)
+    e = {"race": race, "level": level}
+    e["base_health"] = base_health + (level - 1) * 20
+    e["current_health"] = e["base_health"].copy()
+    e["strength"] = stats["strength"] + (level - 1) * 2
+    e["constitution"] = stats["constitution"] + (level - 1) * 2
+    e["attack_min"] = e["strength"]
+    e["attack_max"] = e["strength"] + 10
+    return e
+
+
+# -------------------------------
+# Vectorized use_ability (primary ability only, like the game)
+# -------------------------------
+# ABILITY_TABLE flattened into one array per field, indexed by effect ID.
+def _column(values, dtype):
+    return np.array(values, dtype=dtype)
+
+_DMG = _column([e.damage is not None for e in ABILITY_TABLE], bool)
+_DMG_LO = _column([e.damage[0] if e.damage else 0 for e in ABILITY_TABLE], np.int64)
+_DMG_HI = _column([e.damage[1] if e.damage else 0 for e in ABILITY_TABLE], np.int64)
+_SCALE = _column([e.scale for e in ABILITY_TABLE], np.int64)
+_HEAL = _column([e.heal is not None for e in ABILITY_TABLE], bool)
+_HEAL_LO = _column([e.heal[0] if e.heal else 0 for e in ABILITY_TABLE], np.int64)
+_HEAL_HI = _column([e.heal[1] if e.heal else 0 for e in ABILITY_TABLE], np.int64)
+_HEAL_DIV = _column([e.heal_div or 0 for e in ABILITY_TABLE], np.int64)
+_MANA_COST = _column([e.mana_cost for e in ABILITY_TABLE], np.int64)
+_CHANCE = _column([-1.0 if e.chance is None else e.chance for e in ABILITY_TABLE], float)
+
+
+def _effect_id(ability):
+    return primary_ability(ability)[1].id
+
+
+def _resolve_abilities(rng, effect_ids, strength, mana):
+    # Returns (damage, heal, mana_spent) for fighters using the given effects
+    n = effect_ids.size
+    paid = mana >= _MANA_COST[effect_ids]
+    chance = _CHANCE[effect_ids]
+    strike = np.where(chance < 0, True, rng.random(n) < chance) & paid
+    mend = np.where(chance < 0, True, ~strike) & paid
+
+    roll = _randint(rng, _DMG_LO[effect_ids], _DMG_HI[effect_ids], n)
+    hits = strike & _DMG[effect_ids]
+    damage = np.where(hits, (strength + roll) * _SCALE[effect_ids], 0)
+    heal_div = _HEAL_DIV[effect_ids]
+    heal = np.where(hits & (heal_div > 0), roll // np.maximum(heal_div, 1), 0)
+    heal_roll = _randint(rng, _HEAL_LO[effect_ids], _HEAL_HI[effect_ids], n)
+    heal = np.where(mend & _HEAL[effect_ids], heal_roll, heal)
+    return damage, heal, np.where(paid, _MANA_COST[effect_ids], 0)
+
+
+# -------------------------------
+# Batch fight loops
+# -------------------------------
+def _run_pve(player, enemy, mult, rng, max_turns):
+    # battle() with the "attack" action every turn
+    n = player["current_health"].size
+    p_hp = player["current_health"].copy()
+    e_hp = enemy["current_health"].copy()
+    outcome = np.zeros(n, dtype=np.int8)   # 1 win, -1 loss, 0 unresolved
+    turns = np.full(n, max_turns, dtype=np.int64)
+    idx = np.arange(n)
+    for turn in range(1, max_turns + 1):
+        if idx.size == 0:
+            break
+        damage = ((player["strength"][idx] + _randint(rng, 1, 10, idx.size)) * mult[idx]).astype(np.int64)
+        e_hp[idx] -= damage
+        won = e_hp[idx] <= 0
+        outcome[idx[won]] = 1
+        turns[idx[won]] = turn
+        idx = idx[~won]
+
+        enemy_damage = _randint(rng, enemy["attack_min"][idx], enemy["attack_max"][idx], idx.size)
+        effective = np.maximum(1, enemy_damage - player["constitution"][idx] // 2)
+        p_hp[idx] -= effective
+        lost = p_hp[idx] <= 0
+        p_hp[idx[lost]] = 0
+        outcome[idx[lost]] = -1
+        turns[idx[lost]] = turn
+        idx = idx[~lost]
+    return outcome, turns, p_hp
+
+
+def _run_pvp(sides, abilities, ability_rate, rng, max_turns):
+    # pvp() with each side picking "ability" with probability ability_rate and
+    # "attack" otherwise. Defend flags are cleared at the end of every pvp()
+    # POST before the opponent acts, so defending never reduces damage there.
+    n = sides[0]["current_health"].size
+    hp = np.stack([sides[0]["current_health"], sides[1]["current_health"]]).astype(np.int64)
+    base = np.stack([sides[0]["base_health"], sides[1]["base_health"]])
+    strength = np.stack([sides[0]["strength"], sides[1]["strength"]])
+    mana = np.stack([sides[0]["mana"], sides[1]["mana"]]).astype(np.int64)
+    mult = np.stack([sides[0]["mult"], sides[1]["mult"]])
+    outcome = np.zeros(n, dtype=np.int8)   # 1 side 0 wins, -1 side 1 wins
+    turns = np.full(n, max_turns, dtype=np.int64)
+    idx = np.arange(n)
+    for turn in range(max_turns):
+        if idx.size == 0:
+            break
+        a, d = turn % 2, 1 - turn % 2
+        damage = np.zeros(idx.size, dtype=np.int64)
+        use = rng.random(idx.size) < ability_rate
+
+        hit = idx[~use]
+        damage[~use] = ((strength[a][hit] + _randint(rng, 1, 10, hit.size)) * mult[a][hit]).astype(np.int64)
+
+        who = idx[use]
+        dmg, heal, spent = _resolve_abilities(rng, abilities[a][who], strength[a][who], mana[a][who])
+        damage[use] = dmg
+        mana[a][who] -= spent
+        hp[a][who] = np.where(heal > 0, np.minimum(base[a][who], hp[a][who] + heal), hp[a][who])
+
+        hp[d][idx] -= damage
+        done = hp[d][idx] <= 0
+        outcome[idx[done]] = 1 if a == 0 else -1
+        turns[idx[done]] = turn + 1
+        idx = idx[~done]
+    return outcome, turns, hp[0]
+
+
+# -------------------------------
+# Sweeps and reporting
+# -------------------------------
+def _summarize(outcome, turns, hp_left, base_health, max_turns):
+    n = outcome.size
+    wins = int((outcome == 1).sum())
+    losses = int((outcome == -1).sum())
+    resolved = outcome != 0
+    fraction = np.clip(hp_left / np.maximum(base_health, 1), 0, 1)
+    histogram, _ = np.histogram(fraction[outcome == 1], bins=HP_BINS, range=(0.0, 1.0))
+    p10, p50, p90 = np.percentile(hp_left, [10, 50, 90])
+    return {
+        "fights": n,
+        "wins": wins,
+        "losses": losses,
+        "unresolved": n - wins - losses,
+        "win_rate": wins / n,
+        "mean_turns": float(turns[resolved].mean()) if resolved.any() else float(max_turns),
+        "hp_remaining": {"p10": float(p10), "p50": float(p50), "p90": float(p90)},
+        "hp_histogram": histogram.tolist(),
+    }
+
+
+def simulate_level(level, fights, rng, races=None, enemy_races=None, mode="pve",
+                   ability_rate=0.5, max_turns=1000):
+    # Every (race, enemy race) pair at one level, run as a single batch
+    races = races or RACES
+    enemy_races = enemy_races or RACES
+    pairs = [(p, e) for p in races for e in enemy_races]
+    players, opponents, mults, back_mults = [], [], [], []
+    for p, e in pairs:
+        player = roll_characters(p, level, fights, rng)
+        if mode == "pve":
+            opponent = roll_enemies(e, level, fights, rng)
+        else:
+            opponent = roll_characters(e, level, fights, rng)
+        players.append(player)
+        opponents.append(opponent)
+        mults.append(np.full(fights, race_multiplier(player["race"], opponent["race"])))
+        back_mults.append(np.full(fights, race_multiplier(opponent["race"], player["race"])))
+
+    def stack(group, stat):
+        return np.concatenate([g[stat] for g in group])
+
+    player = {s: stack(players, s) for s in ("base_health", "current_health", "strength", "constitution", "mana")}
+    player["mult"] = np.concatenate(mults)
+    if mode == "pve":
+        enemy = {s: stack(opponents, s) for s in ("current_health", "attack_min", "attack_max")}
+        outcome, turns, hp_left = _run_pve(player, enemy, player["mult"], rng, max_turns)
+    else:
+        other = {s: stack(opponents, s) for s in ("base_health", "current_health", "strength", "constitution", "mana")}
+        other["mult"] = np.concatenate(back_mults)
+        abilities = np.stack([
+            np.repeat([_effect_id(g["ability"]) for g in players], fights),
+            np.repeat([_effect_id(g["ability"]) for g in opponents], fights),
+        ])
+        outcome, turns, hp_left = _run_pvp((player, other), abilities, ability_rate, rng, max_turns)
+
+    results = []
+    for i, (p, e) in enumerate(pairs):
+        sl = slice(i * fights, (i + 1) * fights)
+        summary = _summarize(outcome[sl], turns[sl], hp_left[sl], player["base_health"][sl], max_turns)
+        results.append({"mode": mode, "level": level, "race": p, "opponent": e, **summary})
+    return results
+
+
+def sweep(levels, fights=10000, seed=None, races=None, enemy_races=None, mode="pve",
+          ability_rate=0.5, max_turns=1000):
+    rng = np.random.default_rng(seed)
+    results = []
+    for level in levels:
+        results.extend(simulate_level(level, fights, rng, races, enemy_races, mode, ability_rate, max_turns))
+    return results
+
+
+def _parse_levels(text):
+    levels = []
+    for part in text.split(","):
+        if "-" in part:
+            low, high = part.split("-")
+            levels.extend(range(int(low), int(high) + 1))
+        else:
+            levels.append(int(part))
+    return levels
+
+
+def _print_matrix(results, level):
+    rows = [r for r in results if r["level"] == level]
+    races = list(dict.fromkeys(r["race"] for r in rows))
+    opponents = list(dict.fromkeys(r["opponent"] for r in rows))
+    width = max(len(r) for r in races + opponents) + 1
+    print(f"\nLevel {level} win rate (row = player, column = opponent)")
+    print(" " * width + "".join(o[:8].rjust(9) for o in opponents))
+    lookup = {(r["race"], r["opponent"]): r for r in rows}
+    for race in races:
+        print(race.ljust(width) + "".join(f"{lookup[(race, o)]['win_rate']:9.3f}" for o in opponents))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Monte Carlo balance sweep")
+    parser.add_argument("--levels", default="1-20", help="e.g. 1-20 or 1,5,10")
+    parser.add_argument("--fights", type=int, default=10000, help="fights per race pair and level")
+    parser.add_argument("--mode", choices=["pve", "pvp"], default="pve")
+    parser.add_argument("--races", help="comma-separated player races (default: all)")
+    parser.add_argument("--opponents", help="comma-separated opponent races (default: all)")
+    parser.add_argument("--ability-rate", type=float, default=0.5, help="pvp: chance to use the ability")
+    parser.add_argument("--max-turns", type=int, default=1000)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json", help="write the full results to this file")
+    args = parser.parse_args(argv)
+
+    levels = _parse_levels(args.levels)
+    races = args.races.split(",") if args.races else None
+    opponents = args.opponents.split(",") if args.opponents else None
+    started = time.perf_counter()
+    results = sweep(levels, args.fights, args.seed, races, opponents, args.mode,
+                    args.ability_rate, args.max_turns)
+    elapsed = time.perf_counter() - started
+    for level in levels:
+        _print_matrix(results, level)
+    total = sum(r["fights"] for r in results)
+    print(f"\n{total} fights in {elapsed:.2f}s ({total / max(elapsed, 1e-9):,.0f} fights/s)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
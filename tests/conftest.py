@@ -0,0 +1,37 @@
+import os, sys, tempfile
+
+import pytest
+
+# The app reads its database and battle store locations at import, so point
+# them at a throwaway directory before any test module imports it.
+_tmpdir = tempfile.mkdtemp(prefix="rpg-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_tmpdir, "test.db")
+os.environ["BATTLE_STORE"] = "memory"
+os.environ["CHARACTER_POOL_BACKGROUND"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as game  # noqa: E402
+
+game.app.secret_key = "test-secret"
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    with game.app.app_context():
+        game.upgrade_schema()
+        game.refill_character_pool()
+        game.db.session.commit()
+
+
+@pytest.fixture
+def client():
+    return game.app.test_client()
+
+
+@pytest.fixture
+def player(client):
+    # A client with a freshly rolled character in its session
+    client.get("/roll")
+    with client.session_transaction() as session:
+        client.char_id = session["char_id"]
+    return client
@@ -0,0 +1,25 @@
+import app as game
+
+
+def _create(client):
+    created = client.post("/api/v1/characters", json={"count": 1}).get_json()["characters"][0]
+    return created["character"]["id"], {"Authorization": f"Bearer {created['token']}"}
+
+
+def test_fetch_shows_other_characters_only_as_the_leaderboards_do(client):
+    mine, headers = _create(client)
+    theirs, _ = _create(client)
+    with game.app.app_context():
+        pooled = game.db.session.scalar(game.db.select(game.CharacterPool.character_id))
+    assert pooled is not None
+    response = client.get(f"/api/v1/characters?ids={mine},{theirs},{pooled}", headers=headers)
+    assert response.status_code == 200
+    characters = {character["id"]: character for character in response.get_json()["characters"]}
+    assert set(characters) == {mine, theirs}
+    assert set(characters[mine]) == set(game.API_CHARACTER_FIELDS)
+    assert set(characters[theirs]) == set(game.API_PUBLIC_CHARACTER_FIELDS)
+
+
+def test_fetch_needs_a_token(client):
+    mine, _ = _create(client)
+    assert client.get(f"/api/v1/characters?ids={mine}").status_code == 401
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+
+import pytest
+
+import app as game
+from asgi import application
+
+
+def _paired(player, other):
+    player.post("/pvp/online/queue")
+    state = other.post("/pvp/online/queue").get_json()
+    assert state["status"] == "matched"
+    return state["match"]["match_id"]
+
+
+async def _open_stream(client, match_id):
+    # Requests the event stream through the ASGI app and returns the queue
+    # its messages arrive on, the task serving it and a way to hang up
+    cookie = "; ".join(f"{c.name}={c.value}" for c in client.cookie_jar)
+    scope = {"type": "http", "method": "GET", "path": f"/pvp/online/match/{match_id}/events",
+             "query_string": b"", "headers": [(b"cookie", cookie.encode())]}
+    requested, hung_up, sent = asyncio.Event(), asyncio.Event(), asyncio.Queue()
+
+    async def receive():
+        if not requested.is_set():
+            requested.set()
+            return {"type": "http.request", "body": b""}
+        await hung_up.wait()
+        return {"type": "http.disconnect"}
+
+    task = asyncio.ensure_future(application(scope, receive, sent.put))
+    return sent, task, hung_up.set
+
+
+async def _next_event(sent, timeout):
+    while True:
+        message = await asyncio.wait_for(sent.get(), timeout)
+        if message["type"] == "http.response.body" and message["body"].startswith(b"id: "):
+            return message["body"].decode()
+
+
+@pytest.fixture
+def opponent():
+    other = game.app.test_client()
+    other.get("/roll")
+    return other
+
+
+def test_stream_waits_on_the_loop_and_wakes_on_a_move(player, opponent, monkeypatch):
+    # With a check interval far beyond the test's timeouts, the move can
+    # only reach the stream through its per-match notification
+    monkeypatch.setitem(game.app.config, "PVP_STREAM_CHECK", 60)
+    match_id = _paired(player, opponent)
+
+    async def scenario():
+        sent, task, hang_up = await _open_stream(player, match_id)
+        first = await _next_event(sent, 5)
+        streams = [t for t in threading.enumerate() if t.name.startswith("asgi-stream")]
+        assert streams == []  # nothing pulled it on a stream thread
+        loop = asyncio.get_running_loop()
+        turn = await loop.run_in_executor(None, lambda: player.get(f"/pvp/online/match/{match_id}").get_json())
+        mover = player if turn["your_turn"] else opponent
+        await loop.run_in_executor(None, lambda: mover.post(f"/pvp/online/match/{match_id}", json={"action": "attack"}))
+        moved = await _next_event(sent, 5)
+        assert moved != first
+        hang_up()
+        await asyncio.wait_for(task, 5)
+        assert match_id not in application.pvp_moved
+
+    asyncio.run(scenario())
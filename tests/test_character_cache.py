@@ -0,0 +1,59 @@
+import app as game
+
+
+def _stored_health(char_id):
+    with game.app.app_context():
+        return game.db.session.scalar(game.db.select(game.Character.current_health)
+                                      .where(game.Character.id == char_id))
+
+
+def _expire_with_pending_health(char_id):
+    # Leaves an unwritten HP change in the cached entry and expires it
+    with game.app.test_request_context():
+        game.get_character(char_id)
+        game.db.session.commit()
+    entry = game.character_cache.entries[char_id]
+    with entry.lock:
+        entry.character.current_health -= 7
+    entry.loaded_at = 0
+    return entry
+
+
+def test_dropped_entry_comes_back_when_its_write_rolls_back(player):
+    cache = game.character_cache
+    cache.flush_interval = 0  # no background flush during the test
+    stored = _stored_health(player.char_id)
+    entry = _expire_with_pending_health(player.char_id)
+    with game.app.test_request_context():
+        game.get_character(player.char_id)  # writes the expired entry, reloads the row
+        assert cache.entries[player.char_id] is not entry
+        game.db.session.rollback()
+    assert cache.entries[player.char_id] is entry
+    assert cache.diff(entry) == {"current_health": stored - 7}
+    assert _stored_health(player.char_id) == stored
+    with game.app.app_context():
+        cache.flush()
+    assert _stored_health(player.char_id) == stored - 7
+
+
+def test_dropped_entry_stays_out_once_its_write_commits(player):
+    cache = game.character_cache
+    stored = _stored_health(player.char_id)
+    entry = _expire_with_pending_health(player.char_id)
+    with game.app.test_request_context():
+        game.get_character(player.char_id)
+        game.db.session.commit()
+    assert cache.entries[player.char_id] is not entry
+    assert _stored_health(player.char_id) == stored - 7
+
+
+def test_dropped_entry_comes_back_when_its_transaction_is_closed(player):
+    # As after an error response, which commits nothing
+    cache = game.character_cache
+    stored = _stored_health(player.char_id)
+    entry = _expire_with_pending_health(player.char_id)
+    with game.app.test_request_context():
+        game.get_character(player.char_id)
+        game.db.session.close()
+    assert cache.entries[player.char_id] is entry
+    assert _stored_health(player.char_id) == stored
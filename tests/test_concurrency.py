@@ -0,0 +1,74 @@
+import threading, uuid
+
+from flask import jsonify, session
+
+import app as game
+
+# A route that loses one compare-and-swap: on its first attempt another
+# writer saves the same character between the read and the commit point.
+# Registered at import, before the app serves its first request.
+_attempts = []
+
+
+@game.app.route("/_test/raced-gold", methods=["POST"])
+@game.retry_on_conflict
+def raced_gold():
+    character = game.get_character(session["char_id"])
+    _attempts.append(character.gold)
+    if len(_attempts) == 1:
+        with game.db.engine.begin() as conn:
+            conn.execute(game.db.update(game.Character).where(game.Character.id == character.id).values(
+                gold=game.Character.gold + 100, version=game.Character.version + 1))
+    character.gold += 1
+    return jsonify({"gold": character.gold})
+
+
+def _row(char_id):
+    with game.app.app_context():
+        return game.db.session.execute(game.db.select(game.Character.gold, game.Character.potions, game.Character.version)
+                                       .where(game.Character.id == char_id)).one()
+
+
+def test_stale_write_is_retried_on_fresh_data(player):
+    gold = _row(player.char_id).gold
+    _attempts.clear()
+    response = player.post("/_test/raced-gold")
+    assert response.status_code == 200
+    assert len(_attempts) == 2 and _attempts[1] == gold + 100  # the retry saw the other write
+    assert response.get_json()["gold"] == gold + 101
+    assert _row(player.char_id).gold == gold + 101  # neither write was lost
+
+
+def test_concurrent_purchases_neither_lose_nor_repeat(client):
+    created = client.post("/api/v1/characters", json={"count": 1}).get_json()["characters"][0]
+    char_id, token = created["character"]["id"], created["token"]
+    with game.app.app_context():
+        if game.character_cache is not None:
+            game.character_cache.invalidate([char_id])
+        game.db.session.execute(game.db.update(game.Character).where(game.Character.id == char_id).values(
+            gold=game.POTION_COST * 30, version=game.Character.version + 1))
+        game.db.session.commit()
+    start = _row(char_id)
+    keys = [uuid.uuid4().hex for _ in range(40)]
+    outcomes = {key: [] for key in keys}
+
+    def buyer(batch):
+        worker = game.app.test_client()
+        for key in batch:
+            for _ in range(2):  # every purchase is sent twice
+                response = worker.post("/api/v1/shop", json={"quantity": 1},
+                                       headers={"Authorization": f"Bearer {token}", "Idempotency-Key": key})
+                outcomes[key].append(response.status_code)
+
+    threads = [threading.Thread(target=buyer, args=(keys[i::8],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    bought = sum(200 in statuses for statuses in outcomes.values())
+    assert all(status in (200, 409) for statuses in outcomes.values() for status in statuses)
+    end = _row(char_id)
+    assert end.potions - start.potions == bought
+    assert start.gold - end.gold == bought * game.POTION_COST
+    assert end.gold >= 0
@@ -0,0 +1,21 @@
+from test_replay import _assert_replays, _latest_record
+
+
+def _play_cpu_match(player):
+    player.get("/pvp?cpu=normal")
+    for _ in range(300):
+        update = player.post("/pvp", json={"action": "attack"}).get_json()
+        if update["game_over"]:
+            return _latest_record("hotseat")
+    raise AssertionError("match did not finish")
+
+
+def test_hotseat_match_against_the_cpu_replays(player):
+    # A lucky first hit can end the match before the CPU moves; keep playing
+    # until one includes a CPU turn, which is recorded like any other
+    for _ in range(20):
+        record = _play_cpu_match(player)
+        if len(record.actions) >= 2:
+            break
+    assert len(record.actions) >= 2
+    _assert_replays(record)
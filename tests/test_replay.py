@@ -0,0 +1,36 @@
+import app as game
+
+
+def _latest_record(kind):
+    with game.app.app_context():
+        record = game.db.session.scalars(game.db.select(game.BattleRecord).where(game.BattleRecord.kind == kind)
+                                         .order_by(game.BattleRecord.id.desc())).first()
+        game.db.session.expunge_all()
+        return record
+
+
+def _assert_replays(record):
+    with game.app.app_context():
+        _, result = game.replay_fight(record)
+    assert result == record.result
+
+
+def test_pve_battle_replays_to_the_recorded_result(player):
+    for _ in range(300):
+        update = player.post("/battle", json={"action": "attack"}).get_json()
+        if update["outcome"] in ("won", "lost"):
+            break
+    record = _latest_record("pve")
+    assert record is not None and record.character_id == player.char_id
+    _assert_replays(record)
+
+
+def test_pool_rolls_are_reproducible_and_seeded_per_character():
+    def rolled(seed):
+        return [{column: value for column, value in row.items() if column != "last_seen"}
+                for row in game.roll_character_rows(500, seed)]
+
+    rows = rolled(3)
+    assert rows == rolled(3)
+    assert len({row["seed"] for row in rows}) == len(rows)
+    assert {row["race"] for row in rows} == set(game.RACE_STATS)
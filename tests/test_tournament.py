@@ -0,0 +1,33 @@
+import tournament
+from app import RACE_STATS
+
+
+def _roster(n):
+    races = list(RACE_STATS)
+    rows = []
+    for i in range(n):
+        stats = RACE_STATS[races[i % len(races)]]
+        level = 1 + i % 7
+        rows.append((i + 1, races[i % len(races)], stats["ability"], level, stats["strength"] + 2 * (level - 1),
+                     stats["base_health"] + 20 * (level - 1), stats["mana"]))
+    return tournament.Roster(rows)
+
+
+def _results(format, workers, rounds=None):
+    settings, standings, matches = tournament.run_tournament(_roster(40), format, seed=7, rounds=rounds,
+                                                             workers=workers)
+    return ({column: list(values) for column, values in matches.items()},
+            list(standings.halves), list(standings.wins), list(standings.draws))
+
+
+def test_round_robin_is_independent_of_worker_count():
+    single = _results("round-robin", 1)
+    assert len(single[0]["number"]) == 40 * 39 // 2
+    assert _results("round-robin", 3) == single
+
+
+def test_swiss_is_independent_of_worker_count():
+    single = _results("swiss", 1, rounds=5)
+    assert _results("swiss", 2, rounds=5) == single
+    pairs = {(min(a, b), max(a, b)) for a, b in zip(single[0]["p1"], single[0]["p2"])}
+    assert len(pairs) == len(single[0]["p1"])  # nobody meets the same opponent twice
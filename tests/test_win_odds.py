@@ -0,0 +1,36 @@
+import math, random
+
+import pytest
+
+import app as game
+
+TRIALS = 4000
+
+
+def _hero():
+    hero = game.Character(seed=1)
+    hero.race, hero.strength, hero.constitution, hero.potions = "Human", 15, 12, 3
+    hero.current_health = hero.base_health = 150
+    return hero
+
+
+def _foe():
+    return game.enemy_from_ref([game.ENEMY_RACES.index("Beastman"), 2, 200, 14])
+
+
+@pytest.mark.parametrize("policy", game.AUTO_BATTLE_POLICIES)
+def test_exact_odds_match_monte_carlo(policy):
+    odds = game.win_odds(_hero(), _foe(), policy, 30)
+    assert odds["win"] + odds["loss"] + odds["unfinished"] == pytest.approx(1.0, abs=1e-6)
+    rng = random.Random(11)
+    template = _hero()
+    wins = 0
+    for _ in range(TRIALS):
+        hero = game.Character.__mapper__.class_manager.new_instance()
+        for column in ("race", "strength", "constitution", "potions", "current_health", "base_health",
+                       "level", "exp", "gold", "evolved", "intelligence", "wisdom", "mana", "speed", "ability"):
+            setattr(hero, column, getattr(template, column))
+        wins += game.auto_battle(hero, _foe(), rng, policy, 30)["outcome"] == "won"
+    p = odds["win"]
+    margin = 4 * math.sqrt(max(p * (1 - p), 1e-4) / TRIALS)
+    assert abs(wins / TRIALS - p) < margin
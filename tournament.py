@@ -0,0 +1,347 @@
+import argparse, math, os, time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from app import (app, db, Character, CharacterPool, Tournament, TournamentEntry, TournamentMatch,
+                 pvp_action, primary_ability, upgrade_schema)
+from rng import RngStream, new_seed
+
+# -------------------------------
+# Tournament runner (round-robin and Swiss PvP brackets)
+# -------------------------------
+# Stored characters fight each other under the online PvP rules: pvp_action
+# with type advantages and abilities, and a defend halves the next attack
+# against the defender. Each side picks its move from the match's RNG:
+# defend with --defend-rate, its ability with --ability-rate (if it can pay
+# the mana), attack otherwise. Both start at full HP, the first mover is a
+# coin flip and a match still running after --max-turns is a draw.
+#
+# The roster is read once into one array per column (race and ability as
+# indexes into a name list), not ORM objects, and handed to every worker
+# process when it starts. The matches of a round are split into shards of
+# (number, p1, p2) arrays; a worker plays a shard with two reusable
+# __slots__ fighters and sends back arrays of winners and turns. Match k is
+# played on stream k of the tournament's seed, so results don't depend on
+# how many workers there are or which one played it. Standings are merged
+# in this process and written with the matches in one transaction.
+#
+#   python tournament.py --workers 8
+#   python tournament.py --format swiss --rounds 7 --min-level 5 --seed 42
+
+FORMATS = ["round-robin", "swiss"]
+SHARDS_PER_WORKER = 4  # smaller shards even out the load between workers
+MIN_SHARD = 32
+
+
+class Roster:
+    __slots__ = ("ids", "names", "race", "ability", "level", "strength", "base_health", "mana")
+
+    def __init__(self, rows):
+        self.names = []
+        name_ids = {}
+
+        def name_id(name):
+            if name not in name_ids:
+                name_ids[name] = len(self.names)
+                self.names.append(name)
+            return name_ids[name]
+
+        self.ids = array("q")
+        self.race = array("H")
+        self.ability = array("H")
+        self.level = array("l")
+        self.strength = array("l")
+        self.base_health = array("l")
+        self.mana = array("l")
+        for character_id, race, ability, level, strength, base_health, mana in rows:
+            self.ids.append(character_id)
+            self.race.append(name_id(race))
+            self.ability.append(name_id(ability))
+            self.level.append(level)
+            self.strength.append(strength)
+            self.base_health.append(base_health)
+            self.mana.append(mana)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Fighter:
+    # The attributes pvp_action and use_ability read and write
+    __slots__ = ("race", "ability", "strength", "base_health", "current_health", "mana")
+
+    def load(self, roster, i):
+        self.race = roster.names[roster.race[i]]
+        self.ability = roster.names[roster.ability[i]]
+        self.strength = roster.strength[i]
+        self.base_health = self.current_health = roster.base_health[i]
+        self.mana = roster.mana[i]
+
+
+def choose_action(fighter, rng, settings):
+    roll = rng.random()
+    if roll < settings["defend_rate"]:
+        return "defend"
+    if roll < settings["defend_rate"] + settings["ability_rate"]:
+        if fighter.mana >= primary_ability(fighter.ability)[1].mana_cost:
+            return "ability"
+    return "attack"
+
+
+def play_match(fighters, rng, settings):
+    # Returns (winner side 1/2 or 0 for a draw, turns played)
+    defending = [False, False]
+    side = 0 if rng.random() < 0.5 else 1
+    for turn in range(1, settings["max_turns"] + 1):
+        me, opponent = fighters[side], fighters[1 - side]
+        defending[side] = False  # a defend lasts until your own next move
+        action = choose_action(me, rng, settings)
+        pvp_action(me, opponent, action, rng, defending[1 - side])
+        if action == "defend":
+            defending[side] = True
+        if opponent.current_health <= 0:
+            return side + 1, turn
+        side = 1 - side
+    return 0, settings["max_turns"]
+
+
+# -------------------------------
+# Worker processes
+# -------------------------------
+_worker = {}
+
+
+def _init_worker(roster, seed, settings):
+    _worker.update(roster=roster, seed=seed, settings=settings, fighters=(Fighter(), Fighter()))
+
+
+def _play_shard(shard):
+    numbers, p1, p2 = shard
+    roster, seed, settings, fighters = (_worker["roster"], _worker["seed"], _worker["settings"],
+                                        _worker["fighters"])
+    winners, turns = array("b"), array("l")
+    for number, a, b in zip(numbers, p1, p2):
+        fighters[0].load(roster, a)
+        fighters[1].load(roster, b)
+        winner, played = play_match(fighters, RngStream(seed, number), settings)
+        winners.append(winner)
+        turns.append(played)
+    return numbers, winners, turns
+
+
+def _shards(numbers, p1, p2, workers):
+    size = max(MIN_SHARD, math.ceil(len(numbers) / (workers * SHARDS_PER_WORKER)))
+    for start in range(0, len(numbers), size):
+        end = start + size
+        yield numbers[start:end], p1[start:end], p2[start:end]
+
+
+# -------------------------------
+# Pairings and standings
+# -------------------------------
+def round_robin_pairings(n):
+    p1, p2 = array("l"), array("l")
+    for a in range(n):
+        for b in range(a + 1, n):
+            p1.append(a)
+            p2.append(b)
+    return p1, p2
+
+
+def swiss_pairings(order, played, had_bye):
+    # Pairs down the standings, each with the next player they haven't met
+    # (a rematch only when nobody else is left). With an odd count, the
+    # lowest-ranked player without a bye sits the round out.
+    order = list(order)
+    bye = None
+    if len(order) % 2:
+        bye = next((i for i in reversed(order) if i not in had_bye), order[-1])
+        order.remove(bye)
+    p1, p2 = array("l"), array("l")
+    while order:
+        a = order.pop(0)
+        b = next((i for i in order if (min(a, i), max(a, i)) not in played), order[0])
+        order.remove(b)
+        p1.append(a)
+        p2.append(b)
+    return p1, p2, bye
+
+
+class Standings:
+    def __init__(self, n):
+        self.halves = array("l", [0]) * n  # points in half-point units
+        self.wins = array("l", [0]) * n
+        self.losses = array("l", [0]) * n
+        self.draws = array("l", [0]) * n
+        self.opponents = [array("l") for _ in range(n)]
+
+    def add(self, a, b, winner):
+        self.opponents[a].append(b)
+        self.opponents[b].append(a)
+        if winner == 0:
+            self.draws[a] += 1
+            self.draws[b] += 1
+            self.halves[a] += 1
+            self.halves[b] += 1
+            return
+        won, lost = (a, b) if winner == 1 else (b, a)
+        self.wins[won] += 1
+        self.losses[lost] += 1
+        self.halves[won] += 2
+
+    def add_bye(self, i):
+        self.halves[i] += 2
+
+    def tiebreak(self, i):
+        return sum(self.halves[j] for j in self.opponents[i]) / 2
+
+    def order(self, roster):
+        # Best first: points, then opponents' points, then wins; ties go to the lower id
+        return sorted(range(len(roster)), key=lambda i: (-self.halves[i], -self.tiebreak(i), -self.wins[i],
+                                                         roster.ids[i]))
+
+
+# -------------------------------
+# Running and saving a tournament
+# -------------------------------
+def load_roster(ids=None, min_level=None, max_level=None, limit=None):
+    # Claimed characters only: pooled ones haven't been handed to a player yet
+    query = (db.select(Character.id, Character.race, Character.ability, Character.level, Character.strength,
+                       Character.base_health, Character.mana)
+             .where(Character.id.not_in(db.select(CharacterPool.character_id)))
+             .order_by(Character.id))
+    if ids:
+        query = query.where(Character.id.in_(ids))
+    if min_level is not None:
+        query = query.where(Character.level >= min_level)
+    if max_level is not None:
+        query = query.where(Character.level <= max_level)
+    if limit:
+        query = query.limit(limit)
+    return Roster(db.session.execute(query))
+
+
+def run_tournament(roster, format="round-robin", seed=None, rounds=None, workers=None, ability_rate=0.3,
+                   defend_rate=0.1, max_turns=200):
+    # Returns (settings, standings, matches); matches holds one array per column
+    seed = new_seed() if seed is None else seed
+    workers = workers or os.cpu_count() or 1
+    n = len(roster)
+    if format == "swiss":
+        rounds = rounds or max(1, math.ceil(math.log2(max(n, 2))))
+    else:
+        rounds = 1
+    settings = {"format": format, "seed": seed, "rounds": rounds, "ability_rate": ability_rate,
+                "defend_rate": defend_rate, "max_turns": max_turns}
+    standings = Standings(n)
+    matches = {column: array("l") for column in ("number", "round", "p1", "p2", "winner", "turns")}
+    played, had_bye = set(), set()
+
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(roster, seed, settings))
+        play = pool.map
+    else:
+        _init_worker(roster, seed, settings)
+        play = map
+    try:
+        for round_number in range(1, rounds + 1):
+            if format == "swiss":
+                p1, p2, bye = swiss_pairings(standings.order(roster), played, had_bye)
+                if bye is not None:
+                    had_bye.add(bye)
+                    standings.add_bye(bye)
+            else:
+                p1, p2 = round_robin_pairings(n)
+            first = len(matches["number"])
+            numbers = array("l", range(first, first + len(p1)))
+            results = {}
+            for shard_numbers, winners, turns in play(_play_shard, _shards(numbers, p1, p2, workers)):
+                for number, winner, played_turns in zip(shard_numbers, winners, turns):
+                    results[number] = (winner, played_turns)
+            for number, a, b in zip(numbers, p1, p2):
+                winner, played_turns = results[number]
+                standings.add(a, b, winner)
+                if format == "swiss":
+                    played.add((min(a, b), max(a, b)))
+                for column, value in (("number", number), ("round", round_number), ("p1", a), ("p2", b),
+                                      ("winner", winner), ("turns", played_turns)):
+                    matches[column].append(value)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return settings, standings, matches
+
+
+def save_tournament(roster, settings, standings, matches, started_at):
+    # One transaction for the tournament, its standings and its matches
+    tournament = Tournament(format=settings["format"], seed=settings["seed"], settings=settings,
+                            participants=len(roster), matches=len(matches["number"]),
+                            started_at=started_at, finished_at=time.time())
+    db.session.add(tournament)
+    db.session.flush()  # assigns tournament.id
+    ids = roster.ids
+    db.session.execute(db.insert(TournamentEntry), [
+        {"tournament_id": tournament.id, "character_id": ids[i], "rank": rank, "points": standings.halves[i] / 2,
+         "wins": standings.wins[i], "losses": standings.losses[i], "draws": standings.draws[i],
+         "tiebreak": standings.tiebreak(i)}
+        for rank, i in enumerate(standings.order(roster), 1)])
+    db.session.execute(db.insert(TournamentMatch), [
+        {"tournament_id": tournament.id, "number": number, "round": round_number, "p1_id": ids[a], "p2_id": ids[b],
+         "winner": winner, "turns": turns}
+        for number, round_number, a, b, winner, turns in zip(
+            matches["number"], matches["round"], matches["p1"], matches["p2"], matches["winner"], matches["turns"])])
+    db.session.commit()
+    return tournament
+
+
+def _print_standings(roster, standings, top):
+    print(f"\n{'rank':>4s} {'id':>8s} {'race':20s} {'lvl':>4s} {'pts':>6s} {'W':>5s} {'L':>5s} {'D':>4s} {'tb':>8s}")
+    for rank, i in enumerate(standings.order(roster)[:top], 1):
+        print(f"{rank:4d} {roster.ids[i]:8d} {roster.names[roster.race[i]][:20]:20s} {roster.level[i]:4d} "
+              f"{standings.halves[i] / 2:6.1f} {standings.wins[i]:5d} {standings.losses[i]:5d} "
+              f"{standings.draws[i]:4d} {standings.tiebreak(i):8.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a PvP tournament between stored characters")
+    parser.add_argument("--format", choices=FORMATS, default="round-robin")
+    parser.add_argument("--rounds", type=int, help="swiss: rounds to play (default: log2 of the field)")
+    parser.add_argument("--ids", help="comma-separated character ids (default: every claimed character)")
+    parser.add_argument("--min-level", type=int)
+    parser.add_argument("--max-level", type=int)
+    parser.add_argument("--limit", type=int, help="at most this many participants, lowest ids first")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    parser.add_argument("--ability-rate", type=float, default=0.3, help="chance to use the ability on a move")
+    parser.add_argument("--defend-rate", type=float, default=0.1, help="chance to defend on a move")
+    parser.add_argument("--max-turns", type=int, default=200, help="moves before a match is a draw")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--top", type=int, default=20, help="standings rows to print")
+    parser.add_argument("--dry-run", action="store_true", help="don't write the results")
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        upgrade_schema()
+        ids = [int(value) for value in args.ids.split(",")] if args.ids else None
+        roster = load_roster(ids, args.min_level, args.max_level, args.limit)
+        db.session.rollback()  # don't hold the read transaction while the matches run
+        if len(roster) < 2:
+            parser.error(f"{len(roster)} participants; a tournament needs at least 2")
+        started_at = time.time()
+        started = time.perf_counter()
+        settings, standings, matches = run_tournament(
+            roster, args.format, args.seed, args.rounds, args.workers, args.ability_rate, args.defend_rate,
+            args.max_turns)
+        elapsed = time.perf_counter() - started
+        total = len(matches["number"])
+        _print_standings(roster, standings, args.top)
+        print(f"\n{len(roster)} participants, {total} matches in {elapsed:.2f}s "
+              f"({total / max(elapsed, 1e-9):,.0f} matches/s, {args.workers or os.cpu_count()} workers), "
+              f"seed {settings['seed']}")
+        if not args.dry_run:
+            tournament = save_tournament(roster, settings, standings, matches, started_at)
+            print(f"Saved as tournament {tournament.id}")
+
+
+if __name__ == "__main__":
+    main()